@@ -5,7 +5,6 @@ import pandas as pd
 
 from Argoverse.argoverse_utils import read_argoverse2_data, get_lane_graph
 from scipy import interpolate as interp
-from tqdm import tqdm
 
 from data_set_template import data_set_template
 from scenario_none_pov import scenario_none_pov
@@ -145,141 +144,69 @@ class Argoverse_Interactive(data_set_template):
 
         file_path = self.path + os.sep + 'Data_sets' + os.sep + 'Argoverse' + os.sep + 'data'
 
-        graph_id = 0
-        num_saved_sampled = self.get_number_of_saved_samples()
-
         # Prepare the SceneGraph
         self.map_split_save = True
         sceneGraph_columns = ['num_nodes', 'lane_idcs', 'pre_pairs', 'suc_pairs', 'left_pairs', 'right_pairs',
                               'left_boundaries', 'right_boundaries', 'centerlines', 'lane_type', 'pre', 'suc', 'left', 'right']   
         self.SceneGraphs = pd.DataFrame(np.zeros((0, len(sceneGraph_columns)), object), index = [], columns = sceneGraph_columns)
 
-        for _, name in tqdm(enumerate(os.listdir(file_path + '/train'))):
+        # Get the scenes of the train and validation set (the graph id of a scene is its position in this list)
+        Scenes = [('train', name) for name in sorted(os.listdir(file_path + '/train'))]
+        Scenes += [('val', name) for name in sorted(os.listdir(file_path + '/val'))]
 
+        def extract_scene(graph_id, scene):
+            split, name = scene
+            
             self.num_samples += 1
-            data_path = file_path + '/train/' + name
-            if self.num_samples > num_saved_sampled:
-                data_collection = read_argoverse2_data(data_path)
+            data_path = file_path + '/' + split + '/' + name
+            data_collection = read_argoverse2_data(data_path)
 
-                domain = pd.Series(np.zeros(5, object), index = ['graph_id', 'focal_id', 'location', 'splitting', 'category'])
-                
-                domain.graph_id = int(graph_id)
-                domain.focal_id = data_collection['focal_id']
-                domain.location = data_collection['city_name']
+            domain = pd.Series(np.zeros(5, object), index = ['graph_id', 'focal_id', 'location', 'splitting', 'category'])
+            
+            domain.graph_id = int(graph_id)
+            domain.focal_id = data_collection['focal_id']
+            domain.location = data_collection['city_name']
+            if split == 'train':
                 domain.splitting = 'train'
-
-                # categories = [i[0,0] for i in data_collection['agentcategories'] if i[0,0] in [1, 2, 3]]
-                categories = []
-
-                # focal_track, focal_agent_type, focal_track_id = self.get_focal_track(data_collection)
-
-                path = pd.Series(np.empty(0, np.ndarray), index = [])
-                agent_types = pd.Series(np.zeros(0, str), index = [])     
-
-                
-                path['ego'] = np.concatenate([data_collection['trajs'][-1], data_collection['vels'][-1], data_collection['psirads'][-1]], axis = 1)
-                agent_types['ego'] = 'V'       
-
-                path, agent_types, categories = self.sort_tracks(data_collection, path, agent_types, categories)
-
-                assert 0 not in categories
-
-                categories.insert(0,1)
-                domain.category = pd.Series(categories, index = agent_types.index)
-
-                t = np.arange(0, 11, 0.1)
-
-                print('Number of agents: ' + str(len(path)))
-                print('Number of frames: ' + str(len(t)))
-                self.Path.append(path)
-                self.Type_old.append(agent_types)
-                self.T.append(t)
-                self.Domain_old.append(domain)
-
-                # Get the scene graph
-                lanegraph = get_lane_graph(data_path)
-                lanegraph_df = pd.DataFrame.from_dict(lanegraph, orient='index', dtype=object)
-                lanegraph_df.columns = [int(graph_id)]
-                self.SceneGraphs.loc[int(graph_id)] = lanegraph_df.iloc[:,0]
-
-                if self.num_samples % 5000 == 0:
-                    self.check_created_paths_for_saving(force_save=True) 
-                else:
-                    self.check_created_paths_for_saving(force_save=False)
-
-            graph_id += 1
- 
-
-        
-        for idx, name in tqdm(enumerate(os.listdir(file_path + '/val'))):
-
-            self.num_samples += 1
-            data_path = file_path + '/val/' + name
-            if self.num_samples > num_saved_sampled:
-                data_collection = read_argoverse2_data(data_path)
-
-                domain = pd.Series(np.zeros(5, object), index = ['graph_id', 'focal_id', 'location', 'splitting', 'category'])
-                
-                domain.graph_id = int(graph_id)
-                domain.focal_id = data_collection['focal_id']
-                domain.location = data_collection['city_name']
+            else:
                 domain.splitting = 'test'
 
-                # categories = [i[0,0] for i in data_collection['agentcategories'] if i[0,0] in [1, 2, 3]]
-                categories = []
-                # focal_track, focal_agent_type, focal_track_id = self.get_focal_track(data_collection)
-
-                path = pd.Series(np.empty(0, np.ndarray), index = [])
-                agent_types = pd.Series(np.zeros(0, str), index = [])
-
+            # categories = [i[0,0] for i in data_collection['agentcategories'] if i[0,0] in [1, 2, 3]]
+            categories = []
 
-                path['ego'] = np.concatenate([data_collection['trajs'][-1], data_collection['vels'][-1], data_collection['psirads'][-1]], axis = 1)
-                agent_types['ego'] = 'V'  
+            # focal_track, focal_agent_type, focal_track_id = self.get_focal_track(data_collection)
 
-                path, agent_types, categories = self.sort_tracks(data_collection, path, agent_types, categories)
+            path = pd.Series(np.empty(0, np.ndarray), index = [])
+            agent_types = pd.Series(np.zeros(0, str), index = [])     
 
-                assert 0 not in categories
-
-                categories.insert(0,1)
-                domain.category = pd.Series(categories, index = agent_types.index)
-
-                # path['tar'] = focal_track
-                # agent_types['tar'] = focal_agent_type
-                
-                # path, agent_types = self.get_other_tracks(data_collection, focal_track_id, path, agent_types)
-
-                t = np.arange(0, 11, 0.1)
+            
+            path['ego'] = np.concatenate([data_collection['trajs'][-1], data_collection['vels'][-1], data_collection['psirads'][-1]], axis = 1)
+            agent_types['ego'] = 'V'       
 
-                print('Number of agents: ' + str(len(path)))
-                print('Number of frames: ' + str(len(t)))
-                self.Path.append(path)
-                self.Type_old.append(agent_types)
-                self.T.append(t)
-                self.Domain_old.append(domain)
+            path, agent_types, categories = self.sort_tracks(data_collection, path, agent_types, categories)
 
-                # Get the scene graph
-                lanegraph = get_lane_graph(data_path)
-                lanegraph_df = pd.DataFrame.from_dict(lanegraph, orient='index', dtype=object)
-                lanegraph_df.columns = [int(graph_id)]
-                self.SceneGraphs.loc[int(graph_id)] = lanegraph_df.iloc[:,0]
+            assert 0 not in categories
 
-                if self.num_samples % 5000 == 0:
-                    self.check_created_paths_for_saving(force_save=True) 
-                else:
-                    self.check_created_paths_for_saving(force_save=False) 
+            categories.insert(0,1)
+            domain.category = pd.Series(categories, index = agent_types.index)
 
-            graph_id += 1
+            t = np.arange(0, 11, 0.1)
 
+            print('Number of agents: ' + str(len(path)))
+            print('Number of frames: ' + str(len(t)))
+            self.Path.append(path)
+            self.Type_old.append(agent_types)
+            self.T.append(t)
+            self.Domain_old.append(domain)
 
-        
-        self.check_created_paths_for_saving(last=True) 
+            # Get the scene graph
+            lanegraph = get_lane_graph(data_path)
+            lanegraph_df = pd.DataFrame.from_dict(lanegraph, orient='index', dtype=object)
+            lanegraph_df.columns = [int(graph_id)]
+            self.SceneGraphs.loc[int(graph_id)] = lanegraph_df.iloc[:,0]
 
-        
-        self.Path = pd.DataFrame(self.Path)
-        self.Type_old = pd.DataFrame(self.Type_old)
-        self.T = np.array(self.T+[()], np.ndarray)[:-1]
-        self.Domain_old = pd.DataFrame(self.Domain_old)
-        self.SceneGraphs = pd.DataFrame(self.SceneGraphs)
+        # Extract the scenes (in parallel, if multiple extraction workers are allowed)
+        self.create_path_samples_from_scenes(Scenes, extract_scene, force_save_every = 5000)
         
 
 
@@ -403,6 +403,20 @@ class CoR_left_turns(data_set_template):
         in_position = tar_x > - 3
         return in_position
         
+    def calculate_distance_batch(self, Path, T, Domain, agents):
+        # self.calculate_distance() already works on arrays with a leading dimension, 
+        # so the samples can be passed in place of the predictions
+        agents = list(agents)
+        path = pd.Series([Path[:, agents.index('ego')], Path[:, agents.index('tar')]], index = ['ego', 'tar'])
+        Dist = self.calculate_distance(path, None, None)
+        return np.stack([Dist[beh] for beh in self.Behaviors], axis = 1)
+    
+    def evaluate_scenario_batch(self, Path, D_class, T, Domain, agents):
+        tar_x = Path[:, list(agents).index('tar'), :, 0]
+        
+        in_position = tar_x > - 3
+        return in_position
+        
     def calculate_additional_distances(self, path, t, domain):
         r'''
         This function calculates other distances of the relevant agents needed for the 2D->1D transformation 
@@ -532,6 +532,80 @@ class HighD_lane_change(data_set_template):
         return in_position       
         
     
+    def calculate_distance_batch(self, Path, T, Domain, agents):
+        vehicle_length = 5 
+        
+        agents = list(agents)
+        ego_x = Path[:, agents.index('ego'), :, 0]
+        tar_x = Path[:, agents.index('tar'), :, 0]
+        tar_y = Path[:, agents.index('tar'), :, 1]
+        
+        # Get the lane markings of each sample, padded with np.nan
+        num_markings = Domain.laneMarkings.apply(len).to_numpy()
+        laneMarkings = np.full((len(Domain), num_markings.max()), np.nan, float)
+        for i, lane_markings in enumerate(Domain.laneMarkings):
+            laneMarkings[i, :len(lane_markings)] = lane_markings
+        
+        # Mirror samples going to the right
+        sign = np.where(Domain.drivingDirection.to_numpy() == 1, -1, 1).astype(ego_x.dtype)
+        ego_x        = sign[:,np.newaxis] * ego_x
+        tar_x        = sign[:,np.newaxis] * tar_x
+        tar_y        = sign[:,np.newaxis] * tar_y
+        laneMarkings = sign[:,np.newaxis] * laneMarkings
+        
+        Dc = tar_x - ego_x - vehicle_length
+        
+        ind_mark = np.argmax(laneMarkings > tar_y[:,[0]], axis = -1)
+        lane_mark = laneMarkings[np.arange(len(Domain)), ind_mark]
+        
+        # 0.75m are the assumed minimal vehicle 
+        DA = lane_mark[:,np.newaxis] - tar_y - 0.5
+        angle = np.angle(tar_x[...,1:] - tar_x[...,:-1] + 1j * (tar_y[...,1:] - tar_y[...,:-1]))
+        angle = np.concatenate((angle[...,[0]], angle), axis = -1)
+        angle = np.clip(angle, 1e-3, 0.5 * np.pi)
+        
+        # Use the second smallest angle of each sample as lower bound
+        angle_sorted = np.sort(angle, axis = -1)
+        larger = angle_sorted > angle_sorted[:,[0]]
+        angle_second = angle_sorted[np.arange(len(angle)), np.argmax(larger, axis = -1)]
+        angle_second[~larger.any(-1)] = angle_sorted[~larger.any(-1), 0]
+        
+        clip_angle = angle.max(-1) > np.float32(1e-3)
+        angle_min = np.maximum(1e-3, 0.99 * angle_second)
+        angle[clip_angle] = np.maximum(angle[clip_angle], angle_min[clip_angle, np.newaxis].astype(angle.dtype))
+        
+        mean_dt = np.mean(T[:,1:] - T[:,:-1], axis = -1)
+        n_dt = np.maximum(3, (self.dt / mean_dt).astype(int))
+        
+        for n in np.unique(n_dt):
+            use = n_dt == n
+            angle[use] = savgol_filter(angle[use], n, 1, axis = -1)
+        
+        Da = DA / np.sin(angle)
+        for n in np.unique(n_dt):
+            use = n_dt == n
+            Da[use] = savgol_filter(Da[use], n, 1, axis = -1)
+        
+        Dist = {'accepted': Da, 'rejected': Dc}
+        return np.stack([Dist[beh] for beh in self.Behaviors], axis = 1)
+    
+    
+    def evaluate_scenario_batch(self, Path, D_class, T, Domain, agents):
+        agents = list(agents)
+        tar_x = Path[:, agents.index('tar'), :, 0]
+        v_1_x = Path[:, agents.index('v_1'), :, 0]
+        
+        # Mirror samples going to the right
+        sign = np.where(Domain.drivingDirection.to_numpy() == 1, -1, 1).astype(tar_x.dtype)[:,np.newaxis]
+        tar_x = sign * tar_x
+        v_1_x = sign * v_1_x
+        
+        v_1_exists = np.isfinite(Path[:, agents.index('v_1')]).any((1,2))
+        
+        in_position = (v_1_x >= tar_x + 5) | ~v_1_exists[:,np.newaxis]
+        return in_position
+    
+    
     def calculate_additional_distances(self, path, t, domain):
         r'''
         This function calculates other distances of the relevant agents needed for the 2D->1D transformation 
@@ -78,23 +78,31 @@ class Lyft_interactive(data_set_template):
                             'left_boundaries', 'right_boundaries', 'centerlines', 'lane_type', 'pre', 'suc', 'left', 'right']  
         self.SceneGraphs = pd.DataFrame(np.zeros((0, len(sceneGraph_columns)), object), columns = sceneGraph_columns)
 
-        # Get allready saved samples
-        num_samples_saved = self.get_number_of_saved_samples()
-        ii = 0
+        # Get the scenes of all parts of the dataset
+        Datasets = {}
+        Scenes = []
+        map_api = MapAPI(Path(cache_path))
+        
+        def get_dataset(part):
+            # Only keep the dataset of one part open at a time (as the scenes are ordered by part,
+            # each part is only opened once during a serial extraction or in each shard)
+            if part not in Datasets.keys():
+                Datasets.clear()
+                
+                lyft_string = 'lyft_' + part
+                Datasets[part] = UnifiedDataset(desired_data   = [lyft_string],
+                                                data_dirs      = {lyft_string:     scenes_path + part + '.zarr'},
+                                                cache_location = cache_path,
+                                                verbose = True)
+            return Datasets[part]
+        
         # Treat the separate parts of the dataset separately
         for part in ['sample', 'val', 'train', 'train_full']: # 'train_full' could be added
             self.path = os.path.dirname(os.path.abspath(__file__))
 
-            lyft_string = 'lyft_' + part
-
-            dataset = UnifiedDataset(desired_data   = [lyft_string],
-                                     data_dirs      = {lyft_string:     scenes_path + part + '.zarr'},
-                                     cache_location = cache_path,
-                                     verbose = True)
+            dataset = get_dataset(part)
             
             ################################################################################
-            
-            map_api = MapAPI(Path(cache_path))
 
             # Go over scenes to collect maps
             for i, scene in enumerate(dataset.scenes()):
@@ -119,92 +127,92 @@ class Lyft_interactive(data_set_template):
                         img *= 255.0
                            
                     self.Images.loc[map_key] = [img.astype(np.uint8), 1 / px_per_meter] 
-
-            # Go over scenes
-            for i, scene in enumerate(dataset.scenes()):
-                # Count saved scenes
-                if ii < num_samples_saved:
-                    continue
-                ii += 1
-                
-                print('')
-                print('Scene ' + str(i + 1) + ': ' + scene.name)
-                print('Number of frames: ' + str(scene.length_timesteps) + ' ({:0.1f} s)'.format(scene.length_seconds()))
-                
-                # Get map
-                map_id = scene.env_name + ':' + scene.location
-                map_api.get_map(map_id)
             
-                # Get map offset
-                min_x, min_y, _, _, _, _ = map_api.maps[map_id].extent 
-                
-                Cache = DataFrameCache(cache_path = dataset.cache_path, scene = scene)
-                
-                scene_agents = np.array([[agent.name, agent.type.name] for agent in scene.agents if agent.type != AgentType.UNKNOWN])
-                
-                # Extract position data
-                scene_data = Cache.scene_data_df[['x', 'y', 'vx', 'vy', 'heading', 'length', 'width']]
-                scene_data = scene_data.loc[scene_agents[:,0]]
-                
-                # Set indices
-                sort_index = np.argsort(scene_agents[:,0])
-                agent_index_names = scene_data.index.get_level_values(0).to_numpy()
-                agent_index = sort_index[np.searchsorted(scene_agents[sort_index,0], agent_index_names)]
-                times_index = scene_data.index.get_level_values(1).to_numpy()
-                
-                # Set trajectories
-                trajectories = np.ones((len(scene_agents), scene.length_timesteps, 2), dtype = np.float32) * np.nan
-                trajectories[agent_index, times_index] = scene_data[['x', 'y', 'vx', 'vy', 'heading']].to_numpy()
-
-                # Get aveage sizes
-                sizes = np.ones((len(scene_agents), scene.length_timesteps, 2), dtype = np.float32) * np.nan
-                sizes[agent_index, times_index] = scene_data[['length', 'width']].to_numpy()
-                sizes = np.nanmax(sizes, axis = 1)
-                
-                # Adjust to map
-                trajectories -= np.array([[[min_x, min_y, 0, 0, 0]]])
-                trajectories[...,1] *= -1 # mirror y_position
-                trajectories[...,3] *= -1 # mirror y_velocity
-                trajectories[...,4] *= -1 # mirror heading
-                
-                # Get agent names
-                assert scene_agents[0,0] == 'ego'
-                Index = ['ego'] + ['v_' + str(i) for i in range(1, len(scene_agents))]
-                
-                # Set path and agent types
-                path = pd.Series(list(trajectories.astype(np.float32)), dtype = object, index = Index)
-                agent_types = pd.Series(scene_agents[:,1].astype('<U1'), index = Index)
-                agent_sizes = pd.Series(list(sizes), index = Index)
-                
-                # Get timesteps
-                t = np.arange(scene.length_timesteps) * scene.dt
-                
-                # Set domain
-                domain = pd.Series(np.zeros(4, object), index = ['location', 'scene', 'image_id', 'splitting'])
-                domain.location = scene.env_name
-                domain.scene = scene.name 
-                domain.image_id = map_id
-                
-                # Get sample purpose
-                if scene.env_name in testing_env_names:
-                    domain.splitting = 'test'
-                else:
-                    domain.splitting = 'train'
-                
-                print('Number of agents: ' + str(len(path)))
-                self.num_samples += 1
-                self.Path.append(path)
-                self.Type_old.append(agent_types)
-                self.Size_old.append(agent_sizes)
-                self.T.append(t)
-                self.Domain_old.append(domain) 
-                
-                # Chcek if data can be saved
-                self.check_created_paths_for_saving()
+            Scenes += [(part, scene_idx) for scene_idx in range(dataset.num_scenes())]
+            del dataset
+
+        # Go over scenes
+        def extract_scene(i, scene_key):
+            part, scene_idx = scene_key
+            dataset = get_dataset(part)
+            scene = dataset.get_scene(scene_idx)
+            
+            print('')
+            print('Scene ' + str(i + 1) + ': ' + scene.name)
+            print('Number of frames: ' + str(scene.length_timesteps) + ' ({:0.1f} s)'.format(scene.length_seconds()))
+            
+            # Get map
+            map_id = scene.env_name + ':' + scene.location
+            map_api.get_map(map_id)
+        
+            # Get map offset
+            min_x, min_y, _, _, _, _ = map_api.maps[map_id].extent 
+            
+            Cache = DataFrameCache(cache_path = dataset.cache_path, scene = scene)
+            
+            scene_agents = np.array([[agent.name, agent.type.name] for agent in scene.agents if agent.type != AgentType.UNKNOWN])
+            
+            # Extract position data
+            scene_data = Cache.scene_data_df[['x', 'y', 'vx', 'vy', 'heading', 'length', 'width']]
+            scene_data = scene_data.loc[scene_agents[:,0]]
             
-            del dataset, scene_data, Cache, map_api
+            # Set indices
+            sort_index = np.argsort(scene_agents[:,0])
+            agent_index_names = scene_data.index.get_level_values(0).to_numpy()
+            agent_index = sort_index[np.searchsorted(scene_agents[sort_index,0], agent_index_names)]
+            times_index = scene_data.index.get_level_values(1).to_numpy()
+            
+            # Set trajectories
+            trajectories = np.ones((len(scene_agents), scene.length_timesteps, 2), dtype = np.float32) * np.nan
+            trajectories[agent_index, times_index] = scene_data[['x', 'y', 'vx', 'vy', 'heading']].to_numpy()
+
+            # Get aveage sizes
+            sizes = np.ones((len(scene_agents), scene.length_timesteps, 2), dtype = np.float32) * np.nan
+            sizes[agent_index, times_index] = scene_data[['length', 'width']].to_numpy()
+            sizes = np.nanmax(sizes, axis = 1)
+            
+            # Adjust to map
+            trajectories -= np.array([[[min_x, min_y, 0, 0, 0]]])
+            trajectories[...,1] *= -1 # mirror y_position
+            trajectories[...,3] *= -1 # mirror y_velocity
+            trajectories[...,4] *= -1 # mirror heading
+            
+            # Get agent names
+            assert scene_agents[0,0] == 'ego'
+            Index = ['ego'] + ['v_' + str(i) for i in range(1, len(scene_agents))]
+            
+            # Set path and agent types
+            path = pd.Series(list(trajectories.astype(np.float32)), dtype = object, index = Index)
+            agent_types = pd.Series(scene_agents[:,1].astype('<U1'), index = Index)
+            agent_sizes = pd.Series(list(sizes), index = Index)
+            
+            # Get timesteps
+            t = np.arange(scene.length_timesteps) * scene.dt
+            
+            # Set domain
+            domain = pd.Series(np.zeros(4, object), index = ['location', 'scene', 'image_id', 'splitting'])
+            domain.location = scene.env_name
+            domain.scene = scene.name 
+            domain.image_id = map_id
+            
+            # Get sample purpose
+            if scene.env_name in testing_env_names:
+                domain.splitting = 'test'
+            else:
+                domain.splitting = 'train'
+            
+            print('Number of agents: ' + str(len(path)))
+            self.num_samples += 1
+            self.Path.append(path)
+            self.Type_old.append(agent_types)
+            self.Size_old.append(agent_sizes)
+            self.T.append(t)
+            self.Domain_old.append(domain) 
+        
+        # Extract the scenes (in parallel, if multiple extraction workers are allowed)
+        self.create_path_samples_from_scenes(Scenes, extract_scene)
         
-        self.check_created_paths_for_saving(last = True)    
+        del Datasets, map_api
 
         # delete cached data
         shutil.rmtree(cache_path)
@@ -127,13 +127,21 @@ class NuScenes_interactive(data_set_template):
         with open(pred_file, 'r') as f:
             pred_data = json.load(f)
 
-        for data_idx, scene_record in enumerate(data_obj.scene):
+        # Only scenes sorted into the train or testing split are used
+        Scenes = []
+        for scene_record in data_obj.scene:
+            if scene_record['name'] in train or scene_record['name'] in val:
+                Scenes.append(scene_record)
+            else:
+                print('Scene ' + scene_record['name'] + ' is not sorted into train or testing split.')
+
+        def extract_scene(data_idx, scene_record):
             scene_name = scene_record['name']
             scene_desc = scene_record['description']
             scene_location = data_obj.get('log', scene_record['log_token'])['location']
             scene_length = scene_record['nbr_samples']
 
-            print('Scene ' + str(data_idx + 1) + ' of ' + str(len(data_obj.scene)) +
+            print('Scene ' + str(data_idx + 1) + ' of ' + str(len(Scenes)) +
                   ': ' + scene_name + ' (' + scene_desc + ')')
             
             try:
@@ -262,11 +270,8 @@ class NuScenes_interactive(data_set_template):
             
             if scene_name in train:
                 domain.splitting = 'train'
-            elif scene_name in val:
-                domain.splitting = 'test'
             else:
-                print('This Scene is not sorted into train or testing split.')
-                continue
+                domain.splitting = 'test'
             
             print('Number of agents: ' + str(len(path)))
             print('Number of frames: ' + str(len(t)))
@@ -278,11 +283,8 @@ class NuScenes_interactive(data_set_template):
             self.T.append(t)
             self.Domain_old.append(domain)
         
-        self.Path = pd.DataFrame(self.Path)
-        self.Type_old = pd.DataFrame(self.Type_old)
-        self.T = np.array(self.T+[()], np.ndarray)[:-1]
-        self.Domain_old = pd.DataFrame(self.Domain_old)
-        self.Size_old = pd.DataFrame(self.Size_old)
+        # Extract the scenes (in parallel, if multiple extraction workers are allowed)
+        self.create_path_samples_from_scenes(Scenes, extract_scene)
         
     
 
@@ -877,6 +877,115 @@ class RounD_round_about(data_set_template):
                 in_position = np.invert(out_of_position) & (D1 > D_class['rejected'] + Le)
         return in_position
         
+    def unwrap_angle_batch(self, a, frame_0):
+        # Switches from the second to the fourth quadrant before frame_0 are moved down by 2 pi, 
+        # later ones move the following angles up by 2 pi (as in the per sample unwrapping)
+        ind = np.arange(a.shape[-1])[np.newaxis]
+        Change = np.zeros(a.shape, bool)
+        Change[:,1:] = (a[:,1:] < np.pi * 0.5) & (a[:,:-1] > np.pi * 0.5)
+        
+        Change_before = Change & (ind < frame_0[:,np.newaxis])
+        Change_after  = Change & (ind >= frame_0[:,np.newaxis])
+        
+        num_before = Change_before.sum(-1, keepdims = True) - np.cumsum(Change_before, axis = -1)
+        num_after  = np.cumsum(Change_after, axis = -1)
+        return a + 2 * np.pi * (num_after - num_before)
+    
+    def get_frame_0_batch(self, r, a, R):
+        # Equivalent to np.nanargmin, but returning 0 for fully unobserved agents
+        frame_value = np.abs(a) + (r > R) * 2 * np.pi
+        frame_value[np.isnan(frame_value)] = np.inf
+        return np.argmin(frame_value, axis = -1)
+    
+    def calculate_distance_batch(self, Path, T, Domain, agents):
+        lane_width = 3.5
+        vehicle_length = 5 
+        
+        agents = list(agents)
+        ego = Path[:, agents.index('ego')]
+        tar = Path[:, agents.index('tar')]
+        
+        ego_r = np.sqrt(ego[...,0] ** 2 + ego[...,1] ** 2)
+        ego_a = np.angle(ego[...,0] + ego[...,1] * 1j)
+        tar_r = np.sqrt(tar[...,0] ** 2 + tar[...,1] ** 2)
+        tar_a = np.angle(tar[...,0] + tar[...,1] * 1j)
+        
+        # From location data
+        R = self.Loc_data.R.loc[Domain.image_id].to_numpy()[:,np.newaxis]
+        
+        ego_frame_0 = self.get_frame_0_batch(ego_r, ego_a, R)
+        ego_a = self.unwrap_angle_batch(ego_a, ego_frame_0)
+
+        Rl = R - 0.5 * lane_width
+        
+        D_ego = np.log(1 / (1 + np.exp(ego_r - Rl))) * np.tanh(5 * ego_a) - Rl * ego_a
+        
+        Dc = D_ego - 0.5 * vehicle_length
+        
+        # As in self.calculate_distance(), which gets a single prediction per sample, the angle of 
+        # the target vehicle is not unwrapped here
+        DR_tar = np.log((1 + np.exp(tar_r - R))) * np.tanh(5 * (np.pi * 0.25 - tar_a)) - np.log(2)
+        Da = DR_tar - Rl * (tar_a - lane_width / R) * (1 - np.exp(np.minimum(0,5 * DR_tar))) ** 2
+        
+        Dist = {'accepted': Da, 'rejected': Dc}
+        return np.stack([Dist[beh] for beh in self.Behaviors], axis = 1)
+    
+    def evaluate_scenario_batch(self, Path, D_class, T, Domain, agents):
+        lane_width = 3.5
+        vehicle_length = 5 
+        
+        agents = list(agents)
+        ego = Path[:, agents.index('ego')]
+        v_1 = Path[:, agents.index('v_1')]
+        v_2 = Path[:, agents.index('v_2')]
+        
+        ego_r = np.sqrt(ego[...,0] ** 2 + ego[...,1] ** 2)
+        ego_a = np.angle(ego[...,0] + ego[...,1] * 1j)
+        
+        # From location data
+        R = self.Loc_data.R.loc[Domain.image_id].to_numpy()[:,np.newaxis]
+        
+        ego_frame_0 = self.get_frame_0_batch(ego_r, ego_a, R)
+        ego_a = self.unwrap_angle_batch(ego_a, ego_frame_0)
+        
+        # Check which of the agents actually exist
+        v_1_exists = np.isfinite(v_1).any((1,2))
+        v_2_exists = np.isfinite(v_2).any((1,2))
+        
+        v_1_r = np.sqrt(v_1[...,0] ** 2 + v_1[...,1] ** 2)
+        v_1_a = np.angle(v_1[...,0] + v_1[...,1] * 1j)
+        v_1_frame_0 = self.get_frame_0_batch(v_1_r, v_1_a, R)
+        v_1_a = self.unwrap_angle_batch(v_1_a, v_1_frame_0)
+        
+        v_2_r = np.sqrt(v_2[...,0] ** 2 + v_2[...,1] ** 2)
+        v_2_a = np.angle(v_2[...,0] + v_2[...,1] * 1j)
+        v_2_frame_0 = self.get_frame_0_batch(v_2_r, v_2_a, R)
+        
+        # This is an error flag designed to catch vehicles, whose roll is wrongly classified
+        some_error = ((v_1_exists & ~(v_1_frame_0 < ego_frame_0)) | 
+                      (v_2_exists & ~(v_2_frame_0 > ego_frame_0)))
+        
+        Rl = R - 0.5 * lane_width
+        
+        # Without v_1, only the position of ego matters
+        in_position_wo_v_1 = np.invert((ego_r > R) | (ego_r < R - 2 * lane_width))
+        
+        D_ego = np.log(1 / (1 + np.exp(ego_r - Rl))) * np.tanh(5 * ego_a) - Rl * ego_a
+        D_v_1 = np.log(1 / (1 + np.exp(v_1_r - Rl))) * np.tanh(5 * v_1_a) - Rl * v_1_a
+        
+        D1 = D_ego - D_v_1 - vehicle_length
+        
+        out_of_position = ((ego_r > R) | (ego_r < R - 2 * lane_width)  |
+                           (v_1_a < 0) | 
+                           ((v_1_a < 0.5 * np.pi) & (v_1[...,1] < lane_width + 0.5 * vehicle_length)))
+        
+        D_rejected = D_class[:, list(self.Behaviors).index('rejected')]
+        in_position_wi_v_1 = np.invert(out_of_position) & (D1 > D_rejected + lane_width)
+        
+        in_position = np.where(v_1_exists[:,np.newaxis], in_position_wi_v_1, in_position_wo_v_1)
+        in_position &= ~some_error[:,np.newaxis]
+        return in_position
+        
     def calculate_additional_distances(self, path, t, domain):
         r'''
         This function calculates other distances of the relevant agents needed for the 2D->1D transformation 
@@ -111,13 +111,9 @@ class Waymo_interactive(data_set_template):
                 self.Images.loc[map_key] = [img.astype(np.uint8), 1 / px_per_meter] 
 
         
-        # Get allready saved samples
-        num_samples_saved = self.get_number_of_saved_samples()
-        
         # Go over scenes
-        for i, scene in enumerate(dataset.scenes()):
-            if i < num_samples_saved:
-                continue
+        def extract_scene(i, scene_idx):
+            scene = dataset.get_scene(scene_idx)
             
             print('')
             print('Scene ' + str(i + 1) + ': ' + scene.name)
@@ -191,11 +187,9 @@ class Waymo_interactive(data_set_template):
             self.Size_old.append(agent_sizes)
             self.T.append(t)
             self.Domain_old.append(domain)
-            
-            # Chcek if data can be saved
-            self.check_created_paths_for_saving()
-    
-        self.check_created_paths_for_saving(last = True) 
+        
+        # Extract the scenes (in parallel, if multiple extraction workers are allowed)
+        self.create_path_samples_from_scenes(np.arange(dataset.num_scenes()), extract_scene)
 
         # deletet cached data
         shutil.rmtree(cache_path)
@@ -3,13 +3,50 @@ import pandas as pd
 import importlib
 import psutil
 import os
+import hashlib
 import warnings
-import networkx as nx
 import scipy as sp
 from utils.memory_utils import get_total_memory, get_used_memory
+from utils.file_utils import save_atomic
+from utils.kde_scoring_utils import kde_scoring_engine
+from utils.input_grouping_utils import group_identical_samples
+from utils.evaluation_context_utils import evaluation_cache
 
 from rome.ROME import ROME
 
+# Version of the chunk level summaries, has to be increased if their computation changes
+CHUNK_CACHE_VERSION = 1
+
+
+def get_chunk_cache_file(chunk_file, cache_name):
+    # Get the files the cached data is derived from
+    source_files = [chunk_file + '_data.npy', chunk_file + '_AM.npy', chunk_file + '_domain.npy']
+    
+    # Get the content address of the cached data, which changes with the underlying files
+    cache_key = [cache_name, str(CHUNK_CACHE_VERSION), os.path.basename(chunk_file)]
+    for source_file in source_files:
+        if os.path.isfile(source_file):
+            file_stats = os.stat(source_file)
+            cache_key += [str(file_stats.st_size), str(file_stats.st_mtime_ns)]
+    
+    cache_hash = hashlib.sha1('--'.join(cache_key).encode()).hexdigest()
+    
+    cache_directory = os.path.dirname(chunk_file) + os.sep + 'Chunk_cache'
+    return cache_directory + os.sep + os.path.basename(chunk_file) + '--' + cache_name + '_' + cache_hash + '.npy'
+
+
+def save_chunk_cache_file(cache_file, cache_data):
+    # Remove outdated caches of the same data for this chunk, which belong to older versions of its files
+    cache_directory = os.path.dirname(cache_file)
+    os.makedirs(cache_directory, exist_ok = True)
+    cache_file_start = os.path.basename(cache_file)[:-44]
+    for f in os.listdir(cache_directory):
+        if f.startswith(cache_file_start) and f.endswith('.npy'):
+            os.remove(cache_directory + os.sep + f)
+    
+    save_atomic(cache_file, cache_data)
+
+
 class data_interface(object):
     def __init__(self, data_set_dict, parameters):
         # Initialize path
@@ -39,6 +76,7 @@ class data_interface(object):
         # Initialize datasets
         self.Datasets = {}
         self.Latex_names = []
+        KDE_tolerances = []
         for i_data, data_dict in enumerate(data_set_dict):
             assert isinstance(data_dict, dict), "Dataset is not provided as a dictionary."
             assert 'scenario' in data_dict.keys(), "Dataset name is missing  (required key: 'scenario')."
@@ -81,6 +119,21 @@ class data_interface(object):
             else:
                 max_num_agents = None
             
+            if 'num_extraction_workers' in data_dict.keys():
+                num_extraction_workers = data_dict['num_extraction_workers']
+                assert isinstance(num_extraction_workers, int), "the number of extraction workers must be an integer."
+            else:
+                num_extraction_workers = 1
+            
+            if 'kde_tolerance' in data_dict.keys():
+                kde_tolerance = data_dict['kde_tolerance']
+                if kde_tolerance is not None:
+                    assert isinstance(kde_tolerance, (int, float)), "the KDE tolerance must be either None or a number."
+                    kde_tolerance = float(kde_tolerance)
+            else:
+                kde_tolerance = None
+            KDE_tolerances.append(kde_tolerance)
+            
             if t0_type in Comp_t0_types:
                 T0_type_compare = list(Comp_t0_types).remove(t0_type)
             else:
@@ -92,7 +145,7 @@ class data_interface(object):
             parameters_pass = [parameters[i] for i in range(len(parameters) - 1)] + [self.total_memory]
             data_set = data_set_class(Perturbation, *parameters_pass)
 
-            data_set.set_extraction_parameters(t0_type, T0_type_compare, max_num_agents)
+            data_set.set_extraction_parameters(t0_type, T0_type_compare, max_num_agents, num_extraction_workers)
             
             latex_name = data_set.get_name()['latex']
             if latex_name[:6] == r'\emph{' and latex_name[-1] == r'}':
@@ -109,6 +162,11 @@ class data_interface(object):
         self.num_datasets   = len(self.Datasets.values())
         self.single_dataset = self.num_datasets <= 1    
         
+        # Get the engine for evaluating KDEs (which is shared by all combined datasets)
+        assert len(set(KDE_tolerances)) == 1, "Combined datasets must use the same KDE tolerance."
+        self.kde_tolerance = KDE_tolerances[0]
+        self.KDE_scoring = kde_scoring_engine(self.total_memory, self.kde_tolerance)
+        
         # Get relevant scenario information
         scenario_names = []
         scenario_general_input = []
@@ -210,6 +268,8 @@ class data_interface(object):
             del self.Y_orig
         if hasattr(self, 'orig_file_index'):
             del self.orig_file_index
+        if hasattr(self, 'Orig_trajectories_cache'):
+            del self.Orig_trajectories_cache
         
         if hasattr(self, 'Pred_agents_eval_all') and hasattr(self, 'Pred_agents_pred_all'):
             del self.Pred_agents_eval_all
@@ -242,6 +302,13 @@ class data_interface(object):
         return self.data_set_under.determine_required_timesteps(num_timesteps)
     
     
+    def get_KDE_file_addon(self):
+        # Results depending on KDEs are saved seperately if they are only approximated
+        if self.kde_tolerance is None:
+            return ''
+        return '_KDE_tol{:g}'.format(self.kde_tolerance)
+    
+    
     def set_data_file(self, dt, num_timesteps_in, num_timesteps_out):
         (self.num_timesteps_in_real, 
         self.num_timesteps_in_need)  = self.determine_required_timesteps(num_timesteps_in)
@@ -573,7 +640,8 @@ class data_interface(object):
     
     
     def return_batch_images(self, domain, center, rot_angle, target_width, target_height, 
-                            grayscale = False, return_resolution = False, print_progress = False):
+                            grayscale = False, return_resolution = False, print_progress = False,
+                            target_m_per_px = None):
         
         if target_height is None:
             target_height = 1250
@@ -621,9 +689,12 @@ class data_interface(object):
                 Index_use = np.where(Use)[0]
                 Imgs = data_set.return_batch_images(domain.iloc[Use], center_use, rot_angle_use, 
                                                     target_width, target_height, grayscale, 
-                                                    Imgs, Index_use, print_progress)
+                                                    Imgs, Index_use, print_progress, target_m_per_px)
                 if return_resolution:
-                    Imgs_m_per_px[Use] = data_set.Images.Target_MeterPerPx.loc[domain.image_id.iloc[Use]]
+                    if target_m_per_px is None:
+                        Imgs_m_per_px[Use] = data_set.Images.Target_MeterPerPx.loc[domain.image_id.iloc[Use]]
+                    else:
+                        Imgs_m_per_px[Use] = target_m_per_px
         if return_resolution:
             return Imgs, Imgs_m_per_px
         else:
@@ -889,8 +960,42 @@ class data_interface(object):
         else:
             assert not hasattr(self, 'orig_file_index'), 'Original trajectories have been extracted for unknown file index.'
         
+        # Prepare the storage of allready extracted files, where the least recently used ones are removed first
+        if not hasattr(self, 'Orig_trajectories_cache'):
+            orig_memory = 0.25 * max(self.total_memory - get_used_memory(), 2 ** 28)
+            self.Orig_trajectories_cache = evaluation_cache(orig_memory)
+        
+        Orig_trajectories = self.Orig_trajectories_cache.get(file_index, lambda: self._load_original_trajectories(file_index))
+        
         self.orig_file_index = file_index
-            
+        
+        self.N_O_data_orig      = Orig_trajectories['N_O_data_orig']
+        self.N_O_pred_orig      = Orig_trajectories['N_O_pred_orig']
+        self.Output_A_file      = Orig_trajectories['Output_A_file']
+        self.Used_samples       = Orig_trajectories['Used_samples']
+        self.Used_agents        = Orig_trajectories['Used_agents']
+        self.sparse_matrix_orig = Orig_trajectories['sparse_matrix_orig']
+        self.X_orig             = Orig_trajectories['X_orig']
+        self.Y_orig             = Orig_trajectories['Y_orig']
+    
+    
+    def _load_original_trajectories(self, file_index):
+        r'''
+        This function loads the original trajectories of all samples in a file, as needed by
+        **self._extract_original_trajectories**. Its results are stored in **self.Orig_trajectories_cache**,
+        whose attributes *num_hits* and *num_misses* count how often a file did not have to be loaded again.
+
+        Parameters
+        ----------
+        file_index : int
+            The index of the file in **self.Files**.
+
+        Returns
+        -------
+        Orig_trajectories : dict
+            A dictionary with the keys *N_O_data_orig*, *N_O_pred_orig*, *Output_A_file*, *Used_samples*, 
+            *Used_agents*, *sparse_matrix_orig*, *X_orig*, and *Y_orig*.
+        '''
         # Load the specific file
         if self.data_in_one_piece:
             Input_path    = self.Input_path
@@ -920,53 +1025,121 @@ class data_interface(object):
             
             
         # Get the number of prediction time steps
-        self.N_O_data_orig = np.array([len(Output_T[i_sample]) for i_sample in range(len(Output_T))], int)
-        self.N_O_pred_orig = np.array([len(Output_T_pred[i_sample]) for i_sample in range(len(Output_T_pred))], int)
-
-        self.Output_A_file = Output_A
+        N_O_data_orig = np.array([len(Output_T[i_sample]) for i_sample in range(len(Output_T))], int)
+        N_O_pred_orig = np.array([len(Output_T_pred[i_sample]) for i_sample in range(len(Output_T_pred))], int)
 
         # Useful agents
-        Used_agents = Input_path.notna()
-
-        self.Used_samples, self.Used_agents = np.where(Used_agents)
+        Used_samples, Used_agents_input = np.where(Input_path.notna().to_numpy())
 
         # Transform the agent indices to correspond with self.Agents
         Agent_index = self.get_indices_1D(Input_path.columns.to_numpy(), np.array(self.Agents))
-        self.Used_agents = Agent_index[self.Used_agents]
+        Used_agents = Agent_index[Used_agents_input]
 
         # Get corresponding sparse matrix
         sparse_matrix_shape = (len(Input_path), len(self.Agents))
-        sparse_matrix_data = np.arange(len(self.Used_samples), dtype=int) + 1
+        sparse_matrix_data = np.arange(len(Used_samples), dtype=int) + 1
                 
-        sparse_matrix = sp.sparse.coo_matrix((sparse_matrix_data, (self.Used_samples, self.Used_agents)),
+        sparse_matrix = sp.sparse.coo_matrix((sparse_matrix_data, (Used_samples, Used_agents)),
                                              shape = sparse_matrix_shape)
         
-        # Convert to csr for more efficient lookup
-        self.sparse_matrix_orig = sparse_matrix.tocsr()
-
         # Transform paths into numpy
-        self.X_orig = np.ones([len(self.Used_samples), self.num_timesteps_in_real, len(input_path_type)], dtype = np.float32) * np.nan
-        self.Y_orig = np.ones([len(self.Used_samples), self.N_O_data_orig.max(), len(input_path_type)], dtype = np.float32) * np.nan
+        X_orig = np.full([len(Used_samples), self.num_timesteps_in_real, len(input_path_type)], np.nan, dtype = np.float32)
+        Y_orig = np.full([len(Used_samples), N_O_data_orig.max(), len(input_path_type)], np.nan, dtype = np.float32)
 
-        # Extract data from original number a samples
-        for i in range(len(self.Used_samples)):
-            # get specific indices
-            i_sample = self.Used_samples[i]
-            i_agent  = self.Used_agents[i]
+        if len(Used_samples) > 0:
+            # Get the paths of all used agents (with the output agents in the same order as the input agents)
+            Input_cells  = Input_path.to_numpy()[Used_samples, Used_agents_input]
+            Output_cells = Output_path[Input_path.columns].to_numpy()[Used_samples, Used_agents_input]
 
-            # Get corresponding agent name
-            agent = self.Agents[i_agent]
-
-            # Check for accurate performance
-            assert agent in Input_path.columns, 'Transform of agent indices failed.'
-            assert isinstance(Input_path[agent].iloc[i_sample], np.ndarray), 'Input path is not a numpy array, nonna() failed' 
-
-            # Transfare the data to numpy array
-            n_time = self.N_O_data_orig[i_sample]
-            self.X_orig[i] = Input_path[agent].iloc[i_sample].astype(np.float32)
-            self.Y_orig[i, :n_time] = Output_path[agent].iloc[i_sample][:n_time].astype(np.float32)
+            X_orig[:] = np.stack(Input_cells, 0)
             
+            # Stack the outputs of all agents with the same number of output timesteps at once
+            N_time = N_O_data_orig[Used_samples]
+            for n_time in np.unique(N_time):
+                used = np.where(N_time == n_time)[0]
+                Y_orig[used, :n_time] = np.stack([output_cell[:n_time] for output_cell in Output_cells[used]], 0)
             
+        Orig_trajectories = {'N_O_data_orig': N_O_data_orig,
+                             'N_O_pred_orig': N_O_pred_orig,
+                             'Output_A_file': Output_A,
+                             'Used_samples': Used_samples,
+                             'Used_agents': Used_agents,
+                             'sparse_matrix_orig': sparse_matrix.tocsr(), # Convert to csr for more efficient lookup
+                             'X_orig': X_orig,
+                             'Y_orig': Y_orig}
+        return Orig_trajectories
+
+
+
+    def _get_chunk_cache_file(self, file_index, cache_name):
+        return get_chunk_cache_file(self.Files[file_index], cache_name)
+    
+    
+    def _get_agent_file_summary(self, file_index):
+        r'''
+        This function returns the agent information of a single saved chunk of a dataset
+        that is needed for assembling the data. As this only depends on the content of the
+        chunk, it is cached on the disk, so that it is only recomputed if the chunk changes.
+
+        Parameters
+        ----------
+        file_index : int
+            The index of the chunk in **self.Files**.
+
+        Returns
+        -------
+        Type_local : pandas.DataFrame
+            The types of the agents in all samples of the chunk.
+        Allowable_local : pandas.DataFrame
+            A boolean dataframe with the same shape, which is true if an agent is fully
+            observed in the future timesteps of a sample.
+        '''
+        cache_file = self._get_chunk_cache_file(file_index, 'agent_summary')
+        if os.path.isfile(cache_file):
+            [Type_local, Allowable_local, _] = np.load(cache_file, allow_pickle = True)
+            return Type_local, Allowable_local
+        
+        # Get corresponding agent files
+        agent_file = self.Files[file_index] + '_AM.npy'
+        data_file = self.Files[file_index] + '_data.npy'
+        
+        # Load the agent files
+        Agent_data = np.load(agent_file, allow_pickle=True)
+        if len(Agent_data) == 3:
+            [Type_local, Recorded_local, _] = Agent_data
+        else:
+            assert len(Agent_data) == 4, 'Agent data should have 3 or 4 entries.'
+            [Type_local, _, Recorded_local, _] = Agent_data
+
+        # Load Output_T
+        [_, _, _, _, Output_T, _, _, _, _] = np.load(data_file, allow_pickle=True)
+        Output_T = Output_T[Recorded_local.index]
+        
+        Allowable_local = np.zeros(Recorded_local.shape, bool)
+
+        # Get the number of timesteps in each sample
+        N_O_data = np.array([len(output_T) for output_T in Output_T])
+        
+        # Go through unique number of output timesteps
+        for n_o in np.unique(N_O_data):
+            use_samples = np.where(N_O_data == n_o)[0]
+            use_recorded = Recorded_local.iloc[use_samples]
+
+            # Get the non nan cells
+            use_rec_index, use_rec_agent = np.where(use_recorded.notna())
+
+            # Get agent that are fully observed
+            Allowable = np.stack(use_recorded.to_numpy()[use_rec_index, use_rec_agent], 0).all(-1)
+            Allowable_local[use_samples[use_rec_index], use_rec_agent] = Allowable
+        
+        Allowable_local = pd.DataFrame(Allowable_local, index = Recorded_local.index, columns = Recorded_local.columns)
+        Type_local = Type_local[Recorded_local.columns]
+        
+        # Save the summary
+        save_chunk_cache_file(cache_file, np.array([Type_local, Allowable_local, 0], object))
+        
+        return Type_local, Allowable_local
+    
     
     def _determine_pred_agents_unchecked(self):
         ## NOTE: Method has been adjusted for large datasets
@@ -1024,45 +1197,19 @@ class data_interface(object):
                         used = self.Domain.file_index == file_index
                         used_index = np.where(used)[0]
                         
-                        # Get corresponding agent files
-                        agent_file = self.Files[file_index] + '_AM.npy'
-                        data_file = self.Files[file_index] + '_data.npy'
-                        
-                        # Load the agent files
-                        Agent_data = np.load(agent_file, allow_pickle=True)
-                        if len(Agent_data) == 3:
-                            [Type_local, Recorded_local, _] = Agent_data
-                        else:
-                            assert len(Agent_data) == 4, 'Agent data should have 3 or 4 entries.'
-                            [Type_local, _, Recorded_local, _] = Agent_data
-
-                        # Load Output_T
-                        [_, _, _, _, Output_T, _, _, _, _] = np.load(data_file, allow_pickle=True)
-
+                        # Get the summary of the agents in this file
+                        Type_local, Allowable_local = self._get_agent_file_summary(file_index)
                         
                         # Get the corresponding indices
                         ind_saved = self.Domain[used].Index_saved
-                        Type_local     = Type_local.loc[ind_saved]
-                        Recorded_local = Recorded_local.loc[ind_saved]
-                        Output_T       = Output_T[ind_saved]
+                        Type_local      = Type_local.loc[ind_saved]
+                        Allowable_local = Allowable_local.loc[ind_saved]
 
                         # Get the agent indices
                         agent_index = self.get_indices_1D(Type_local.columns.to_numpy(), np.array(self.Agents))
-
-                        # Get the number of timesteps in each sample
-                        N_O_data = np.array([len(output_T) for output_T in Output_T])
                         
-                        # Go through unique number of output timesteps
-                        for n_o in np.unique(N_O_data):
-                            use_samples = np.where(N_O_data == n_o)[0]
-                            use_recorded = Recorded_local.iloc[use_samples]
-
-                            # Get the non nan cells
-                            use_rec_index, use_rec_agent = np.where(use_recorded.notna())
-
-                            # Get agent that are fully observed
-                            Allowable = np.stack(use_recorded.to_numpy()[use_rec_index, use_rec_agent], 0).all(-1)
-                            Recorded_agents[used_index[use_samples[use_rec_index]], agent_index[use_rec_agent]] = Allowable
+                        # Get agent that are fully observed
+                        Recorded_agents[used_index[:,np.newaxis], agent_index[np.newaxis]] = Allowable_local.to_numpy()
                      
                         used_2D = np.tile(used_index[:, np.newaxis], (1, len(agent_index)))
                         agent_index_2D = np.tile(agent_index[np.newaxis], (len(used_index), 1))
@@ -1116,45 +1263,19 @@ class data_interface(object):
                         used = self.Domain.file_index == file_index
                         used_index = np.where(used)[0]
                         
-                        # Get corresponding agent files
-                        agent_file = self.Files[file_index] + '_AM.npy'
-                        data_file = self.Files[file_index] + '_data.npy'
-                        
-                        # Load the agent files
-                        Agent_data = np.load(agent_file, allow_pickle=True)
-                        if len(Agent_data) == 3:
-                            [Type_local, Recorded_local, _] = Agent_data
-                        else:
-                            assert len(Agent_data) == 4, 'Agent data should have 3 or 4 entries.'
-                            [Type_local, _, Recorded_local, _] = Agent_data
-
-                        # Load Output_T
-                        [_, _, _, _, Output_T, _, _, _, _] = np.load(data_file, allow_pickle=True)
-
+                        # Get the summary of the agents in this file
+                        Type_local, Allowable_local = self._get_agent_file_summary(file_index)
                         
                         # Get the corresponding indices
                         ind_saved = self.Domain[used].Index_saved
-                        Type_local     = Type_local.loc[ind_saved]
-                        Recorded_local = Recorded_local.loc[ind_saved]
-                        Output_T       = Output_T[ind_saved]
+                        Type_local      = Type_local.loc[ind_saved]
+                        Allowable_local = Allowable_local.loc[ind_saved]
 
                         # Get the agent indices
                         agent_index = self.get_indices_1D(Type_local.columns.to_numpy(), np.array(self.Agents))
-
-                        # Get the number of timesteps in each sample
-                        N_O_data = np.array([len(output_T) for output_T in Output_T])
                         
-                        # Go through unique number of output timesteps
-                        for n_o in np.unique(N_O_data):
-                            use_samples = np.where(N_O_data == n_o)[0]
-                            use_recorded = Recorded_local.iloc[use_samples]
-
-                            # Get the non nan cells
-                            use_rec_index, use_rec_agent = np.where(use_recorded.notna())
-
-                            # Get agent that are fully observed
-                            Allowable = np.stack(use_recorded.to_numpy()[use_rec_index, use_rec_agent], 0).all(-1)
-                            Recorded_agents[used_index[use_samples[use_rec_index]], agent_index[use_rec_agent]] = Allowable
+                        # Get agent that are fully observed
+                        Recorded_agents[used_index[:,np.newaxis], agent_index[np.newaxis]] = Allowable_local.to_numpy()
                 
                 # Get predefined predicted agents for NuScenes
                 Pred_agents_N = np.zeros(Needed_agents.shape, bool)
@@ -1313,34 +1434,12 @@ class data_interface(object):
 
                         X[index_inverse[used_orig_samples], useful_agents_inverse[used_orig_agents]] = self.X_orig[use_X_orig,...,:2]
                         
-                        # Get maximum number of samples comparable to all samples (assume 2GB RAM useage)
-                        max_num = np.floor(2 ** 29 / np.prod(X.shape))
+                        # Group the samples with identical inputs
+                        Labels = group_identical_samples(X, tolerance = 1e-3)
+                        self.Subgroups[index] = Labels + subgroup_index
                         
-                        # Prepare maximum differences
-                        D_max = np.zeros((len(index), len(index)), np.float32)
-                        
-                        # Calculate differences
-                        for i in range(int(np.ceil(len(index) / max_num))):
-                            d_index = np.arange(max_num * i, min(max_num * (i + 1), len(index)), dtype = int) 
-                            D = np.abs(X[d_index, np.newaxis] - X[np.newaxis])
-                            D_max[d_index] = np.nanmax(D, (2,3,4))
-
-                        # Find identical trajectories
-                        Identical = D_max < 1e-3
-                        
-                        # Remove self references
-                        Identical[np.arange(len(index)), np.arange(len(index))] = False
-
-                        # Get graph
-                        G = nx.Graph(Identical)
-                        unconnected_subgraphs = list(nx.connected_components(G))
-                        
-                        for subgraph in unconnected_subgraphs:
-                            # Set subgraph
-                            self.Subgroups[index[list(subgraph)]] = subgroup_index
-                            
-                            # Update parameters
-                            subgroup_index += 1
+                        # Update parameters
+                        subgroup_index += Labels.max() + 1
                         
                         
             else:
@@ -1430,34 +1529,12 @@ class data_interface(object):
                         X[index_inverse[used_orig_samples], useful_agents_inverse[used_orig_agents]] = self.X_orig[use_X_orig,...,:2]
 
                         
-                        # Get maximum number of samples comparable to all samples (assume 2GB RAM useage)
-                        max_num = np.floor(2 ** 29 / np.prod(X.shape))
-                        
-                        # Prepare maximum differences
-                        D_max = np.zeros((len(index), len(index)), np.float32)
+                        # Group the samples with identical inputs
+                        Labels = group_identical_samples(X, tolerance = 1e-3)
+                        Subgroups[index] = Labels + subgroup_index
                         
-                        # Calculate differences
-                        for i in range(int(np.ceil(len(index) / max_num))):
-                            d_index = np.arange(max_num * i, min(max_num * (i + 1), len(index)), dtype = int) 
-                            D = np.abs(X[d_index, np.newaxis] - X[np.newaxis])
-                            D_max[d_index] = np.nanmax(D, (2,3,4))
-
-                        # Find identical trajectories
-                        Identical = D_max < 1e-3
-                        
-                        # Remove self references
-                        Identical[np.arange(len(index)), np.arange(len(index))] = False
-
-                        # Get graph
-                        G = nx.Graph(Identical)
-                        unconnected_subgraphs = list(nx.connected_components(G))
-                        
-                        for subgraph in unconnected_subgraphs:
-                            # Set subgraph
-                            Subgroups[index[list(subgraph)]] = subgroup_index
-                            
-                            # Update parameters
-                            subgroup_index += 1   
+                        # Update parameters
+                        subgroup_index += Labels.max() + 1
                     
                     # Assemble complete subgroups
                     self.Subgroups[used_index] = Subgroups
@@ -1560,7 +1637,7 @@ class data_interface(object):
             file_addon += 'wo_pov'
         else:
             file_addon += 'wi_pov'
-        file_addon += '_FI_' + str(file_index)
+        file_addon += '_FI_' + str(file_index) + self.get_KDE_file_addon()
 
         safe_file = self.change_result_directory(self.assembled_data_file, 'Predictions', file_addon)
 
@@ -1578,6 +1655,7 @@ class data_interface(object):
         print('Calculate joint PDF on ground truth probabilities.', flush = True)
         for i_subgroup, subgroup in enumerate(self.unique_subgroups):
             print('    Subgroup {:5.0f}/{:5.0f}'.format(i_subgroup + 1, len(self.unique_subgroups)), flush = True)
+            timer = self.KDE_scoring.start_timing('joint_gt', subgroup)
             s_ind = np.where(self.Subgroups_file == subgroup)[0]
             
             assert len(np.unique(self.Pred_agents_eval_sorted[s_ind], axis = 0)) == 1
@@ -1621,10 +1699,12 @@ class data_interface(object):
                     kde_data = {'cluster_labels': kde.labels_}
                     self.KDE_joint_data[subgroup][nto] = kde_data
 
-                log_prob_true = kde.score_samples(paths_true_comp)
+                log_prob_true = self.KDE_scoring.score_samples(kde, paths_true_comp, len(paths_true_comp))
                 
                 self.KDE_joint[subgroup][nto] = kde
                 self.Log_prob_true_joint[nto_index] = log_prob_true
+            
+            self.KDE_scoring.stop_timing(timer)
 
         # Save the KDE models
         if (not clustering_loaded) and self.save_predictions:
@@ -1653,7 +1733,7 @@ class data_interface(object):
         # Independent KDEs do not need to be saved for different pov settings,
         # as the agents are saved individually
         file_addon = 'indep_gt_KDE' 
-        file_addon += '_FI_' + str(file_index)
+        file_addon += '_FI_' + str(file_index) + self.get_KDE_file_addon()
 
         safe_file = self.change_result_directory(self.assembled_data_file, 'Predictions', file_addon)
 
@@ -1671,6 +1751,7 @@ class data_interface(object):
         print('Calculate indep PDF on ground truth probabilities.', flush = True)
         for i_subgroup, subgroup in enumerate(self.unique_subgroups):
             print('    Subgroup {:5.0f}/{:5.0f}'.format(i_subgroup + 1, len(self.unique_subgroups)), flush = True)
+            timer = self.KDE_scoring.start_timing('indep_gt', subgroup)
             s_ind = np.where(self.Subgroups_file == subgroup)[0]
             
             assert len(np.unique(self.Pred_agents_eval_sorted[s_ind], axis = 0)) == 1
@@ -1731,10 +1812,12 @@ class data_interface(object):
                         kde_data = {'cluster_labels': kde.labels_}
                         self.KDE_indep_data[subgroup][nto][agent] = kde_data
 
-                    log_prob_true_agent = kde.score_samples(paths_true_agent_comp)
+                    log_prob_true_agent = self.KDE_scoring.score_samples(kde, paths_true_agent_comp, len(paths_true_agent_comp))
                     
                     self.KDE_indep[subgroup][nto][agent] = kde
                     self.Log_prob_true_indep[nto_index,i_agent_orig] = log_prob_true_agent
+            
+            self.KDE_scoring.stop_timing(timer)
         
         # Save the KDE models
         if self.save_predictions:
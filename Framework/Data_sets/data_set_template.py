@@ -2,12 +2,33 @@ import pandas as pd
 import numpy as np
 import scipy as sp
 import os
+import shutil
+import hashlib
 import torch
 import psutil
 import networkx as nx
-from data_interface import data_interface
+import multiprocessing as mp
+from data_interface import data_interface, get_chunk_cache_file, save_chunk_cache_file
 from inspect import signature
 from utils.memory_utils import get_total_memory, get_used_memory
+from utils.file_utils import save_atomic
+from utils.columnar_path_utils import (COLUMNAR_MARKER, columnar_path_data, build_columnar_path_data,
+                                       columnar_path_data_from_dataframe, save_columnar_path_data, 
+                                       load_columnar_path_data, get_dense_path_samples)
+from utils.map_raster_utils import (get_map_raster_directory, get_number_of_pyramid_levels, save_map_rasters,
+                                    map_rasters_are_up_to_date, map_raster_store)
+
+# Dataset shared with forked worker processes during parallel extraction
+_parallel_extraction_data_set = None
+
+def _extract_orig_path_file_worker(i_orig_path):
+    _parallel_extraction_data_set.extract_orig_path_file(i_orig_path)
+    return i_orig_path
+
+def _extract_scene_shard_worker(i_shard):
+    _parallel_extraction_data_set.extract_scene_shard(i_shard)
+    return i_shard
+
 
 class data_set_template():
     # %% Implement the provision of data
@@ -412,13 +433,8 @@ class data_set_template():
                 Path_check_sparse = self.get_sparse_path_data(Path_check, T_check)
                 
                 # Save the results
-                os.makedirs(os.path.dirname(file_path_save), exist_ok=True)
-
-                if Size_old_check is None:
-                    test_data = np.array([Path_check_sparse, Type_old_check, T_check, Domain_old_check, num_samples_check], object)
-                else:
-                    test_data = np.array([Path_check_sparse, Type_old_check, Size_old_check, T_check, Domain_old_check, num_samples_check], object)
-                np.save(file_path_save, test_data)
+                self.save_orig_path_file(file_path_save, Path_check_sparse, Type_old_check, Size_old_check, 
+                                         T_check, Domain_old_check, num_samples_check)
                 
                 # Reset the data to empty lists
                 self.Path = []
@@ -477,6 +493,12 @@ class data_set_template():
             # Rename the file
             os.rename(file_overwrite_old, file_overwrite_new)
 
+            # Rename the corresponding columnar path data
+            columnar_overwrite_old = self.get_columnar_path_directory(file_overwrite_old)
+            if os.path.isdir(columnar_overwrite_old):
+                columnar_overwrite_new = self.get_columnar_path_directory(file_overwrite_new)
+                os.rename(columnar_overwrite_old, columnar_overwrite_new)
+
         if last:
             self.saved_last_orig_paths = True
                 
@@ -484,9 +506,12 @@ class data_set_template():
     def get_sparse_path_data(self, Path, T):
         # Check identical length of inputs
         assert len(Path) == len(T), "Input lengths should be the same"
-        # Prepare sparse pandas dataframe
-        Path_helper = pd.DataFrame(np.zeros((0, 3 + len(self.path_data_info())), object), 
-                                   columns = ['sample_index', 'agent_index', 'time_index'] + self.path_data_info())
+        
+        # Collect the sparse columns
+        Sample_index = []
+        Agent_index  = []
+        Time_index   = []
+        Data         = []
         
         # Get num timesteps
         Num_timesteps = np.array([len(t) for t in T])
@@ -504,69 +529,151 @@ class data_set_template():
             
             # Get the actually existing agents
             Sample_id, Agent_id = np.where(Path_samples_non_nan) # num_agents
+            if len(Sample_id) == 0:
+                continue
             Sample_id_global = used_samples[Sample_id]
             
-            # TODO: Check this line for potential correction
             Paths_useful = np.stack(list(Path_samples.values[Sample_id, Agent_id]), axis = 0) # num_agents x num_timesteps x num_data
             
             # Get existing timesteps of existing agents 
             useful_agents, useful_timesteps = np.where(np.isfinite(Paths_useful).any(-1))
             
             # Transform useful_agents_id onto oringinal sample/agent ids
-            sample_id = Sample_id_global[useful_agents]
-            agent_id  = Agent_id[useful_agents]
-            
-            # get num recordings
-            num_recordings = len(useful_timesteps)
-            locs = len(Path_helper) + np.arange(num_recordings)
-            
-            # Initialize new columns
-            Path_helper = Path_helper.reindex(np.concatenate([Path_helper.index, locs]))
-            
-            # Write in the specific indices
-            Path_helper.loc[locs, 'sample_index'] = sample_id
-            Path_helper.loc[locs, 'agent_index'] = agent_id
-            Path_helper.loc[locs, 'time_index'] = useful_timesteps
-            
-            # Write in the specific data
-            Path_helper.loc[locs, self.path_data_info()] = Paths_useful[useful_agents, useful_timesteps]
+            Sample_index.append(Sample_id_global[useful_agents])
+            Agent_index.append(Agent_id[useful_agents])
+            Time_index.append(useful_timesteps)
+            Data.append(Paths_useful[useful_agents, useful_timesteps].astype(np.float32))
+        
+        num_data = len(self.path_data_info())
+        if len(Data) == 0:
+            Data = np.zeros((0, num_data), np.float32)
+            Sample_index, Agent_index, Time_index = np.zeros((3, 0), np.int32)
+        else:
+            Data         = np.concatenate(Data, axis = 0)
+            Sample_index = np.concatenate(Sample_index, axis = 0)
+            Agent_index  = np.concatenate(Agent_index, axis = 0)
+            Time_index   = np.concatenate(Time_index, axis = 0)
+
+        # Build the sorted columns and the sample offset table
+        Path_sparse = build_columnar_path_data(Data, Sample_index, Agent_index, Time_index, len(Path), self.path_data_info())
         
         print("Transformed paths to sparse format", flush=True)
-        return Path_helper
+        return Path_sparse
     
     def get_multiindex_path(self, Path):
-        # Get max number of agents
-        max_agents = Path['agent_index'].max() + 1
-        max_timesteps = Path['time_index'].max() + 1
-        id = Path['sample_index'] + Path['agent_index'] / max_agents + Path['time_index'] / max_agents / max_timesteps
-
-        id_sort = np.argsort(id)
-        Path_sparse = Path.iloc[id_sort].set_index(['sample_index', 'agent_index', 'time_index'])
-        return Path_sparse
-
-    def get_dense_path_sample(self, Path_sparse, sample_index, agent_name_array, num_timesteps):
-        path_sparse = Path_sparse.loc[sample_index]
-
-        # Get pandas dataframe
-        path_data_dense = np.full((len(agent_name_array), num_timesteps, len(self.path_data_info())), np.nan, dtype = np.float32)
-
-        # Transform sparse data to dense data
-        path_data_sparse = path_sparse.to_numpy().astype(np.float32) # num_useful x n_data
-        agent_ind, time_ind = path_sparse.index.get_level_values(0), path_sparse.index.get_level_values(1)
-        path_data_dense[agent_ind, time_ind] = path_data_sparse
-
-        # Map onto pandas series
-        used_agents = np.unique(agent_ind)
+        # The columnar format is allready sorted by sample, agent and time
+        if isinstance(Path, columnar_path_data):
+            return Path
+        
+        # Transform sparse data frames of older framework versions
+        assert isinstance(Path, pd.DataFrame), "Sparse path data should be a pandas dataframe or in the columnar format."
+        num_samples = int(Path['sample_index'].max()) + 1 if len(Path) > 0 else 0
+        return columnar_path_data_from_dataframe(Path, num_samples, self.path_data_info())
+
+    def get_dense_path_samples(self, Path_sparse, sample_indices, agent_name_array, num_timesteps):
+        # Transform a whole batch of samples at once into a (num_samples, num_agents, num_timesteps, num_data) block
+        Path_sparse = self.get_multiindex_path(Path_sparse)
+        return get_dense_path_samples(Path_sparse, sample_indices, len(agent_name_array), num_timesteps)
+    
+    
+    def dense_path_to_series(self, path_data_dense, agent_name_array):
+        # Only agents with at least one recording are assigned a path
+        used_agents = np.where(np.isfinite(path_data_dense).any((1,2)))[0]
         used_agents_name = agent_name_array[used_agents]
         path_data_dense_used = list(path_data_dense[used_agents])
 
         # Transform to pandads series
-        path = pd.Series(path_data_dense_used, index = used_agents_name)
+        path = pd.Series(path_data_dense_used, index = used_agents_name, dtype = object)
         
         # Add missing agents
         path = path.reindex(agent_name_array)
-
         return path
+    
+
+    def get_dense_path_sample(self, Path_sparse, sample_index, agent_name_array, num_timesteps):
+        path_data_dense = self.get_dense_path_samples(Path_sparse, [sample_index], agent_name_array, num_timesteps)[0]
+        return self.dense_path_to_series(path_data_dense, agent_name_array)
+    
+    
+    def iterate_dense_path_batches(self, Path_sparse, sample_indices, agent_name_array, Num_timesteps):
+        r'''
+        This function yields the indices, the dense path data (as in *self.get_dense_path_samples()*), 
+        and the number of timesteps of memory bounded batches of the given samples in the given order.
+
+        Parameters
+        ----------
+        Path_sparse : columnar_path_data
+            The sparse path data.
+        sample_indices : np.ndarray
+            The indices of the samples that should be extracted.
+        agent_name_array : np.ndarray
+            The names of the agents.
+        Num_timesteps : np.ndarray
+            The number of timesteps of each sample in sample_indices.
+        '''
+        Path_sparse = self.get_multiindex_path(Path_sparse)
+        sample_indices = np.asarray(sample_indices, int)
+        Num_timesteps = np.asarray(Num_timesteps, int)
+        assert len(sample_indices) == len(Num_timesteps), "Each sample needs a number of timesteps."
+
+        if len(sample_indices) == 0:
+            return
+        
+        # Use at most 5% of the available memory for one dense block
+        available_memory = max(self.total_memory - get_used_memory(), 100 * 2**20)
+        memory_per_sample = 4 * len(agent_name_array) * Num_timesteps.max() * len(self.path_data_info())
+        batch_size = int(np.clip(0.05 * available_memory / max(1, memory_per_sample), 1, 10000))
+
+        for i_start in range(0, len(sample_indices), batch_size):
+            batch_indices = sample_indices[i_start:i_start + batch_size]
+            batch_num_timesteps = Num_timesteps[i_start:i_start + batch_size]
+            Path_dense = self.get_dense_path_samples(Path_sparse, batch_indices, agent_name_array, batch_num_timesteps.max())
+            yield batch_indices, Path_dense, batch_num_timesteps
+    
+    
+    def iterate_dense_path_samples(self, Path_sparse, sample_indices, agent_name_array, Num_timesteps):
+        r'''
+        This function yields the paths of the given samples (as in *self.get_dense_path_sample()*) 
+        in the given order, while transforming them from the sparse format in memory bounded batches.
+
+        Parameters
+        ----------
+        Path_sparse : columnar_path_data
+            The sparse path data.
+        sample_indices : np.ndarray
+            The indices of the samples that should be extracted.
+        agent_name_array : np.ndarray
+            The names of the agents.
+        Num_timesteps : np.ndarray
+            The number of timesteps of each sample in sample_indices.
+        '''
+        for _, Path_dense, batch_num_timesteps in self.iterate_dense_path_batches(Path_sparse, sample_indices, 
+                                                                                  agent_name_array, Num_timesteps):
+            for path_data_dense, num_timesteps in zip(Path_dense, batch_num_timesteps):
+                yield self.dense_path_to_series(path_data_dense[:, :num_timesteps], agent_name_array)
+    
+
+    def get_columnar_path_directory(self, path_file):
+        # The columnar data of --all_orig_paths_XXX.npy is saved in the directory --all_orig_columns_XXX
+        assert path_file.endswith('.npy'), "The original path file should be a .npy file."
+        path_file_name = os.path.basename(path_file)
+        assert '--all_orig_paths' in path_file_name, "The file is not an original path file."
+        columnar_name = path_file_name[:-4].replace('--all_orig_paths', '--all_orig_columns')
+        return os.path.dirname(path_file) + os.sep + columnar_name
+    
+    
+    def save_orig_path_file(self, path_file, Path_sparse, Type_old, Size_old, T, Domain_old, num_samples):
+        os.makedirs(os.path.dirname(path_file), exist_ok=True)
+
+        # Save the path data in the memory mappable columnar format
+        save_columnar_path_data(Path_sparse, self.get_columnar_path_directory(path_file))
+        
+        # Save the remaining data, replacing the path data with the marker
+        if Size_old is None:
+            test_data = np.array([COLUMNAR_MARKER, Type_old, T, Domain_old, num_samples], object)
+        else:
+            test_data = np.array([COLUMNAR_MARKER, Type_old, Size_old, T, Domain_old, num_samples], object)
+        np.save(path_file, test_data)
 
 
     def get_number_of_saved_samples(self):
@@ -602,6 +709,184 @@ class data_set_template():
             
         
     
+    def create_path_samples_from_scenes(self, Scenes, extract_scene, force_save_every = None):
+        r'''
+        This function can be used inside *self.create_path_samples()* for datasets consisting of independent 
+        scenes, where each scene results in exactly one sample. It goes through all scenes that have not 
+        been saved yet, and saves the extracted samples with *self.check_created_paths_for_saving()*.
+        
+        If more than one extraction worker is allowed (see *self.set_extraction_parameters()*), the scenes 
+        are split into consecutive shards, which are extracted by forked worker processes into their own
+        original path files. Those are afterwards merged in the order of the shards, so the resulting samples 
+        are the same as in a serial extraction. An interrupted extraction is resumed at the first unsaved 
+        scene of each unfinished shard.
+
+        Parameters
+        ----------
+        Scenes : list
+            The scenes of the dataset, in a deterministic order. As they are shared with forked processes,
+            they do not need to be picklable, but their string representation should not change between 
+            runs, as it is used to check that a resumed extraction uses the same scenes.
+        extract_scene : callable
+            A function with the arguments *(i_scene, scene)*, which appends the sample of this scene to
+            **self.Path**, **self.Type_old**, **self.T**, and **self.Domain_old** (as well as **self.Size_old**,
+            if this is used, and **self.Images** and **self.SceneGraphs**, if **self.map_split_save** is set).
+        force_save_every : int
+            If given, the samples are saved every *force_save_every* scenes, regardless of the memory usage.
+        '''
+        num_workers = self.get_number_of_scene_extraction_workers(len(Scenes))
+        if num_workers > 1:
+            self.extract_scene_shards_parallel(Scenes, extract_scene, num_workers, force_save_every)
+        else:
+            self.extract_scene_range(Scenes, extract_scene, 0, len(Scenes), force_save_every)
+    
+    
+    def extract_scene_range(self, Scenes, extract_scene, i_start, i_end, force_save_every = None):
+        # Get allready saved samples (each scene results in exactly one sample)
+        num_samples_saved = self.get_number_of_saved_samples()
+        
+        for i_scene in range(i_start + num_samples_saved, i_end):
+            extract_scene(i_scene, Scenes[i_scene])
+            
+            # Chcek if data can be saved
+            force_save = (force_save_every is not None) and (np.mod(i_scene + 1, force_save_every) == 0)
+            self.check_created_paths_for_saving(force_save = force_save)
+            
+        self.check_created_paths_for_saving(last = True)
+    
+    
+    def get_number_of_scene_extraction_workers(self, num_scenes):
+        num_extraction_workers = getattr(self, 'num_extraction_workers', 1)
+        if num_extraction_workers <= 1 or num_scenes <= 1:
+            return 1
+        
+        # The workers inherit the dataset object, which is only possible when forking
+        if not 'fork' in mp.get_all_start_methods():
+            return 1
+        
+        # A serial extraction that was interrupted is continued serially
+        if (not os.path.isdir(self.get_scene_shard_directory())) and self.get_number_of_saved_samples() > 0:
+            return 1
+        
+        return min(num_extraction_workers, num_scenes, os.cpu_count())
+    
+    
+    def get_scene_shard_directory(self):
+        return self.file_path + '--Scene_shards'
+    
+    
+    def get_scene_shard_file_path(self, i_shard):
+        # Replaces self.file_path during the extraction of a shard
+        return self.get_scene_shard_directory() + os.sep + os.path.basename(self.file_path) + '--Shard_' + str(i_shard).zfill(3)
+    
+    
+    def extract_scene_shard(self, i_shard):
+        # This is run in a forked process, so changing the attributes does not affect the main process
+        Scenes, extract_scene, Shard_bounds, force_save_every = self.scene_shard_extraction
+        self.file_path = self.get_scene_shard_file_path(i_shard)
+        
+        print('Extract scenes {} to {} (shard {})'.format(Shard_bounds[i_shard] + 1, Shard_bounds[i_shard + 1], i_shard + 1), flush = True)
+        self.extract_scene_range(Scenes, extract_scene, Shard_bounds[i_shard], Shard_bounds[i_shard + 1], force_save_every)
+    
+    
+    def extract_scene_shards_parallel(self, Scenes, extract_scene, num_workers, force_save_every = None):
+        global _parallel_extraction_data_set
+        shard_directory = self.get_scene_shard_directory()
+        os.makedirs(shard_directory, exist_ok = True)
+        
+        # Get the shards, which have to stay the same when resuming with a different number of workers
+        plan_file = shard_directory + os.sep + os.path.basename(self.file_path) + '--Shard_plan.npy'
+        scenes_hash = hashlib.sha1(repr(list(Scenes)).encode()).hexdigest()
+        if os.path.isfile(plan_file):
+            [Shard_bounds, num_scenes, scenes_hash_saved, _] = np.load(plan_file, allow_pickle = True)
+            assert num_scenes == len(Scenes), "The number of scenes changed since the shards were planned."
+            assert scenes_hash_saved == scenes_hash, "The scenes or their order changed since the shards were planned."
+        else:
+            num_shards = min(len(Scenes), 4 * num_workers)
+            Shard_bounds = np.linspace(0, len(Scenes), num_shards + 1).astype(int)
+            np.save(plan_file, np.array([Shard_bounds, len(Scenes), scenes_hash, 0], object))
+        num_shards = len(Shard_bounds) - 1
+        
+        # Get the shards that are not yet completely saved (none, if merging the shards was interrupted)
+        Shards_needed = []
+        index_file = shard_directory + os.sep + os.path.basename(self.file_path) + '--Shard_index.npy'
+        for i_shard in range(num_shards):
+            if os.path.isfile(index_file):
+                break
+            if not os.path.isfile(self.get_scene_shard_file_path(i_shard) + '--all_orig_paths_LLL.npy'):
+                Shards_needed.append(i_shard)
+        
+        print('Extract {} of {} scene shards using {} processes'.format(len(Shards_needed), num_shards, num_workers), flush = True)
+        
+        # Split the available RAM space between the workers, so that they save their data early enough
+        available_memory_creation = self.available_memory_creation
+        self.available_memory_creation = (self.total_memory - get_used_memory()) / num_workers
+        
+        # Share the dataset object and the scenes with the forked workers
+        self.scene_shard_extraction = [Scenes, extract_scene, Shard_bounds, force_save_every]
+        _parallel_extraction_data_set = self
+        try:
+            if len(Shards_needed) > 0:
+                ctx = mp.get_context('fork')
+                # Use a new process for each shard to free up the memory afterwards
+                with ctx.Pool(min(num_workers, len(Shards_needed)), maxtasksperchild = 1) as pool:
+                    pool.map(_extract_scene_shard_worker, Shards_needed, chunksize = 1)
+        finally:
+            _parallel_extraction_data_set = None
+            del self.scene_shard_extraction
+            self.available_memory_creation = available_memory_creation
+        
+        self.merge_scene_shards(num_shards)
+    
+    
+    def merge_scene_shards(self, num_shards):
+        r'''
+        This function moves the files saved for each shard by *self.extract_scene_shards_parallel()* to
+        the original path files of the dataset, numbered in the order of the shards.
+        '''
+        shard_directory = self.get_scene_shard_directory()
+        index_file = shard_directory + os.sep + os.path.basename(self.file_path) + '--Shard_index.npy'
+        
+        # Get the index of the merged files first, so that an interrupted merge can be completed
+        if os.path.isfile(index_file):
+            [Shard_index, _] = np.load(index_file, allow_pickle = True)
+        else:
+            Shard_files = []
+            for i_shard in range(num_shards):
+                shard_file_path = self.get_scene_shard_file_path(i_shard)
+                file_path_test_name = os.path.basename(shard_file_path + '--all_orig_paths')
+                files = [f for f in os.listdir(shard_directory) if f.startswith(file_path_test_name)]
+                
+                # Get the attached numbers, with the last file at the end
+                file_numbers = [f[len(file_path_test_name):-4] for f in files]
+                file_numbers.sort(key = lambda path_addition: 1000 if path_addition == '_LLL' else int(path_addition[1:]))
+                Shard_files += [(shard_file_path, path_addition) for path_addition in file_numbers]
+            
+            if len(Shard_files) > 1000:
+                raise AttributeError("Too many files have been saved.")
+            
+            Shard_index = []
+            for file_number, (shard_file_path, path_addition) in enumerate(Shard_files):
+                if file_number == len(Shard_files) - 1:
+                    path_addition_new = '_LLL'
+                else:
+                    path_addition_new = '_' + str(file_number).zfill(3)
+                Shard_index.append((shard_file_path, path_addition, path_addition_new))
+            
+            np.save(index_file, np.array([Shard_index, 0], object))
+        
+        # Move the files (with the final file being moved last)
+        for shard_file_path, path_addition, path_addition_new in Shard_index:
+            for file_type, file_ending in [('--all_orig_columns', ''), ('--Images', '.npy'), ('--SceneGraphs', '.npy'), ('--all_orig_paths', '.npy')]:
+                file_old = shard_file_path + file_type + path_addition + file_ending
+                file_new = self.file_path + file_type + path_addition_new + file_ending
+                if os.path.exists(file_old):
+                    os.replace(file_old, file_new)
+        
+        shutil.rmtree(shard_directory)
+        print('Merged {} scene shards into {} original path files'.format(num_shards, len(Shard_index)), flush = True)
+    
+    
     def get_number_of_original_path_files(self):
         # Get name of final file
         test_file = self.file_path + '--all_orig_paths_LLL.npy'
@@ -619,7 +904,7 @@ class data_set_template():
         return num_files
     
 
-    def extract_loaded_data(self, Loaded_data):
+    def extract_loaded_data(self, Loaded_data, path_file = None):
         if len(Loaded_data) == 5:
             [Path, Type_old, T, Domain_old, num_samples] = Loaded_data
             Size_old = None
@@ -627,6 +912,13 @@ class data_set_template():
             assert len(Loaded_data) == 6, "The loaded data should have 5 or 6 elements."
             [Path, Type_old, Size_old, T, Domain_old, num_samples] = Loaded_data
 
+        # Check if path data is saved in the columnar format
+        if isinstance(Path, str):
+            assert Path == COLUMNAR_MARKER, "The path data marker is unknown."
+            assert path_file is not None, "The file name is needed to load columnar path data."
+            Path = load_columnar_path_data(self.get_columnar_path_directory(path_file))
+            return Path, Type_old, Size_old, T, Domain_old, num_samples
+
         # Make backwards compatible:
         # Check if Path is sparse
         sparse_columns = ['sample_index', 'agent_index', 'time_index'] + self.path_data_info()
@@ -640,6 +932,8 @@ class data_set_template():
 
         if dense:
             Path = self.get_sparse_path_data(Path, T)
+        else:
+            Path = columnar_path_data_from_dataframe(Path, num_samples, self.path_data_info())
         
         return Path, Type_old, Size_old, T, Domain_old, num_samples
 
@@ -668,7 +962,7 @@ class data_set_template():
                 if self.number_original_path_files == 1:
                     # Allready load samples for higher efficiency
                     Loaded_data = np.load(test_file, allow_pickle=True)
-                    self.Path, self.Type_old, self.Size_old, self.T, self.Domain_old, self.num_samples = self.extract_loaded_data(Loaded_data)
+                    self.Path, self.Type_old, self.Size_old, self.T, self.Domain_old, self.num_samples = self.extract_loaded_data(Loaded_data, test_file)
             else:
                 if not all([hasattr(self, attr) for attr in ['create_path_samples']]):
                     raise AttributeError("The raw data cannot be loaded.")
@@ -684,7 +978,7 @@ class data_set_template():
                     # If there is only one file, load the data
                     if self.number_original_path_files == 1:
                         Loaded_data = np.load(test_file, allow_pickle=True)
-                        self.Path, self.Type_old, self.Size_old, self.T, self.Domain_old, self.num_samples = self.extract_loaded_data(Loaded_data)
+                        self.Path, self.Type_old, self.Size_old, self.T, self.Domain_old, self.num_samples = self.extract_loaded_data(Loaded_data, test_file)
                     
                 else:
                     # Check that no other save files exists
@@ -706,16 +1000,10 @@ class data_set_template():
                     self.check_path_samples(self.Path, self.Type_old, self.T, self.Domain_old, self.num_samples, self.Size_old)
                 
                     # save the results
-                    os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
-
                     self.Path = self.get_sparse_path_data(self.Path, self.T)
                     
-                    if self.Size_old is None:
-                        test_data = np.array([self.Path, self.Type_old, self.T, self.Domain_old, self.num_samples], object)
-                    else:
-                        test_data = np.array([self.Path, self.Type_old, self.Size_old, self.T, self.Domain_old, self.num_samples], object)
-                    
-                    np.save(test_file, test_data)
+                    self.save_orig_path_file(test_file, self.Path, self.Type_old, self.Size_old, 
+                                             self.T, self.Domain_old, self.num_samples)
                 
                 # Check if data needs to be saved:
                 if (not hasattr(self, 'map_split_save')) or (not self.map_split_save):
@@ -767,13 +1055,35 @@ class data_set_template():
 
             if test_1_exists:
                 if not hasattr(self, 'Images'):
-                    [self.Images, _] = np.load(image_file_test_1, allow_pickle=True)
+                    self.load_map_rasters(image_file_test_1)
             else:
                 assert path_addition is not None, "The path addition is needed to load the correct file."
                 image_file = self.file_path + '--Images' + path_addition + '.npy'
-                [self.Images, _] = np.load(image_file, allow_pickle=True)
+                self.load_map_rasters(image_file)
 
             self.path_addition_image_old = path_addition
+    
+    
+    def load_map_rasters(self, image_file):
+        r'''
+        This function loads the images saved in *image_file* as read-only memory maps, which
+        are shared between all processes on the same node. The memory mappable map rasters
+        (including the downsampled maps used by *self.get_image_pyramid_level()*) are created 
+        once from the pickled images if they do not exist yet or are outdated.
+        '''
+        map_raster_directory = get_map_raster_directory(image_file)
+        
+        if not map_rasters_are_up_to_date(map_raster_directory, image_file):
+            [Images, _] = np.load(image_file, allow_pickle=True)
+            self.check_image_samples(Images)
+            save_map_rasters(Images, map_raster_directory, image_file)
+            del Images
+        
+        self.Map_rasters = map_raster_store(map_raster_directory)
+        self.Images = self.Map_rasters.Images
+        
+        # Reset the downsampled maps of the previous images
+        self.Image_pyramids = {}
 
 
     def load_raw_sceneGraphs(self, path_addition = None):
@@ -801,15 +1111,41 @@ class data_set_template():
             assert test_1_exists != test_2_exists, "Only one of the two sceneGraph files should exist."
 
             if test_1_exists:
+                sceneGraph_file = sceneGraph_file_test_1
                 if not hasattr(self, 'SceneGraphs'):
-                    [self.SceneGraphs, _] = np.load(sceneGraph_file_test_1, allow_pickle=True)
+                    [self.SceneGraphs, _] = np.load(sceneGraph_file, allow_pickle=True)
             else:
                 assert path_addition is not None, "The path addition is needed to load the correct file."
                 sceneGraph_file = self.file_path + '--SceneGraphs' + path_addition + '.npy'
                 [self.SceneGraphs, _] = np.load(sceneGraph_file, allow_pickle=True)
             
+            # Get the spatial indices of the scene graphs
+            self.load_sceneGraph_indices(sceneGraph_file)
+            
             self.path_addition_scenegraph_old = path_addition
 
+
+    def load_sceneGraph_indices(self, sceneGraph_file):
+        # Check if the indices are already loaded
+        if hasattr(self, 'SceneGraph_indices_file'):
+            if self.SceneGraph_indices_file == sceneGraph_file:
+                return
+        
+        index_file = sceneGraph_file[:-4].replace('--SceneGraphs', '--SceneGraph_indices') + '.npy'
+        
+        # Check if the cached indices exist and are up to date
+        if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(sceneGraph_file):
+            [self.SceneGraph_indices, _] = np.load(index_file, allow_pickle=True)
+        else:
+            self.SceneGraph_indices = pd.Series(np.empty(len(self.SceneGraphs), object), index = self.SceneGraphs.index)
+            for location in self.SceneGraphs.index:
+                self.SceneGraph_indices.loc[location] = self.get_sceneGraph_index(self.SceneGraphs.loc[location])
+            
+            sceneGraph_index_data = np.array([self.SceneGraph_indices, 0], object)
+            save_atomic(index_file, sceneGraph_index_data)
+        
+        self.SceneGraph_indices_file = sceneGraph_file
+
     
     def reset(self):
         self.data_loaded = False
@@ -1292,7 +1628,7 @@ class data_set_template():
         return center_pts, left_pts, right_pts
 
 
-    def add_node_connections(self, graph, scales = [2, 4, 8, 16, 32], cross_dist = 6, cross_angle = 0.5 * np.pi, device = 'cpu'):
+    def add_node_connections(self, graph, scales = [2, 4, 8, 16, 32], cross_dist = 6, cross_angle = 0.5 * np.pi, device = 'cpu', sparse = False):
         '''
         This function adds node connections to the graph. 
         
@@ -1351,6 +1687,12 @@ class data_set_template():
         device : str or torch.device
             The device on which the data should be stored. It can be either 'cpu' or a torch.device object.
 
+        sparse : bool
+            If True, the left and right node connections are found by searching for close nodes in a k-d tree,
+            with the connected lane segments being stored as sparse matrices. This gives the same connections,
+            but avoids the dense matrices over all lane segments and nodes, which might not fit into memory for 
+            the scene graphs of whole maps. In this case, **device** is not used.
+
 
         Returns
         -------
@@ -1447,11 +1789,14 @@ class data_set_template():
         ctrs  = np.zeros((graph.num_nodes, 2), np.float32)
         feats = np.zeros((graph.num_nodes, 2), np.float32)
 
-        node_idcs = []
+        # Get the nodes of each lane segment (in ascending order)
+        node_order = np.argsort(graph.lane_idcs, kind = 'stable')
+        node_splits = np.searchsorted(graph.lane_idcs[node_order], unique_lane_segments[1:])
+        node_idcs = np.split(node_order, node_splits)
+        segment_position = {lane_segment: i for i, lane_segment in enumerate(unique_lane_segments)}
 
         for i, lane_segment in enumerate(unique_lane_segments):  
-            lane_ind = np.where(graph.lane_idcs == lane_segment)[0]
-            node_idcs.append(lane_ind)
+            lane_ind = node_idcs[i]
 
             centerline = graph.centerlines[lane_segment]
 
@@ -1481,8 +1826,8 @@ class data_set_template():
             # Get lane predecessores
             lane_pre = graph.pre_pairs[graph.pre_pairs[:, 0] == lane_segment, 1]
             for lane_segment_pre in lane_pre:
-                if lane_segment_pre in unique_lane_segments:
-                    idcs_pre = node_idcs[unique_lane_segments.index(lane_segment_pre)]
+                if lane_segment_pre in segment_position:
+                    idcs_pre = node_idcs[segment_position[lane_segment_pre]]
                     pre['u'].append(idcs[0])
                     pre['v'].append(idcs_pre[-1])
 
@@ -1493,8 +1838,8 @@ class data_set_template():
             # Get lane successors
             lane_suc = graph.suc_pairs[graph.suc_pairs[:, 0] == lane_segment, 1]
             for lane_segment_suc in lane_suc:
-                if lane_segment_suc in unique_lane_segments:
-                    idcs_suc = node_idcs[unique_lane_segments.index(lane_segment_suc)]
+                if lane_segment_suc in segment_position:
+                    idcs_suc = node_idcs[segment_position[lane_segment_suc]]
                     suc['u'].append(idcs[-1])
                     suc['v'].append(idcs_suc[0])
         
@@ -1548,6 +1893,10 @@ class data_set_template():
         ##################################################################################
         # Add left and right node connections                                            #
         ##################################################################################
+        if sparse:
+            graph['left'], graph['right'] = self._get_cross_node_connections_sparse(graph, ctrs, feats, cross_dist, cross_angle)
+            return graph
+        
         # like pre and sec, but for left and right nodes
         left, right = dict(), dict()
         left['u'], left['v'] = [], []
@@ -1720,6 +2069,76 @@ class data_set_template():
 
         return graph
     
+    
+    def _get_cross_node_connections_sparse(self, graph, ctrs, feats, cross_dist, cross_angle):
+        # Get the left and right node connections as in self.add_node_connections, but only compare
+        # nodes closer than cross_dist, which are found with a k-d tree
+        num_lanes = graph.lane_idcs.max() + 1
+        lane_indices = np.asarray(graph.lane_idcs, int)
+        ctrs = np.asarray(ctrs, np.float32)
+        feats = np.asarray(feats, np.float32)
+        
+        # get angle along lane
+        t_nodes = np.arctan2(feats[:, 1], feats[:, 0])
+        
+        def get_lane_matrix(pairs):
+            pairs = np.asarray(pairs, int).reshape(-1, 2)
+            data = np.ones(len(pairs), np.float32)
+            return sp.sparse.csr_matrix((data, (pairs[:, 0], pairs[:, 1])), shape = (num_lanes, num_lanes))
+        
+        pre = get_lane_matrix(graph['pre_pairs'])
+        suc = get_lane_matrix(graph['suc_pairs'])
+        
+        # Get all pairs of close nodes (in both directions, and including each node itself)
+        Pairs = sp.spatial.cKDTree(ctrs).query_pairs(cross_dist, output_type = 'ndarray')
+        U = np.concatenate((Pairs[:, 0], Pairs[:, 1], np.arange(graph.num_nodes)))
+        V = np.concatenate((Pairs[:, 1], Pairs[:, 0], np.arange(graph.num_nodes)))
+        
+        # Use the same precision as self.add_node_connections
+        dist = np.sqrt(((ctrs[U] - ctrs[V]) ** 2).sum(-1))
+        useful = dist < cross_dist
+        U, V, dist = U[useful], V[useful], dist[useful]
+        
+        if cross_angle is not None:
+            # Get the difference in angle
+            f2 = ctrs[V] - ctrs[U]
+            dt = np.arctan2(f2[:, 1], f2[:, 0]) - t_nodes[U]
+            
+            # Roll around angles
+            dt -= (dt > (2 * np.pi)) * (2 * np.pi)
+            dt += (dt < (-2 * np.pi)) * (2 * np.pi)
+        
+        Connections = []
+        for pairs, angle_sign in [(graph['left_pairs'], 1), (graph['right_pairs'], -1)]:
+            # Extend the neighboring lanes to include the predecessors and successors of those lanes
+            mat = get_lane_matrix(pairs)
+            mat = ((mat @ pre + mat @ suc + mat) > 0.5).tocsr()
+            
+            # Check if the lane of v is a neighbor of the lane of u
+            mask = np.asarray(mat[lane_indices[U], lane_indices[V]]).reshape(-1) > 0
+            if cross_angle is not None:
+                mask &= (angle_sign * dt > 0) & (angle_sign * dt < cross_angle)
+            
+            u, v, d = U[mask], V[mask], dist[mask]
+            
+            # Find for each node the nearest valid neighbor (with the lowest index for ties)
+            order = np.lexsort((v, d, u))
+            u, v = u[order], v[order]
+            first = np.concatenate(([True], u[1:] != u[:-1]))
+            u, v = u[first], v[first]
+            
+            # Check if nodes are aligned enough
+            dt_nodes = np.abs(t_nodes[u] - t_nodes[v])
+            dt_nodes = np.where(dt_nodes > np.pi, np.abs(dt_nodes - 2 * np.pi), dt_nodes)
+            m = dt_nodes < 0.25 * np.pi
+            
+            nbr = dict()
+            nbr['u'] = u[m].astype(np.int64)
+            nbr['v'] = v[m].astype(np.int64)
+            Connections.append([nbr])
+        
+        return Connections
+    
 
 
 
@@ -1816,6 +2235,125 @@ class data_set_template():
             
             return None, in_position, self.behavior_default, None, None
 
+    def classify_path_batch(self, Path, T, Domain, agents):
+        r'''
+        This function classifies the trajectories of a batch of samples, equivalently to applying 
+        *self.classify_path()* to each sample.
+
+        Parameters
+        ----------
+        Path : np.ndarray
+            The dense trajectories of the samples, in the form of a 
+            :math:`\{N_{samples} \times N_{agents} \times |t| \times N_{data}\}` dimensional numpy array.
+            Agents that are not observed in a sample are filled with np.nan values.
+        T : np.ndarray
+            The corresponding timesteps of each sample, in the form of a :math:`\{N_{samples} \times |t|\}`
+            dimensional numpy array. All samples must therefore have the same number of timesteps.
+        Domain : pandas.DataFrame
+            The metadata of the samples, with :math:`N_{samples}` rows.
+        agents : np.ndarray
+            The names of the :math:`N_{agents}` agents in **Path**.
+
+        Returns
+        -------
+        Dist : np.ndarray
+            The distances to the classification markers, as a :math:`\{N_{samples} \times N_{classes} \times |t|\}` 
+            dimensional numpy array (None if classification is not useful).
+        in_position : np.ndarray
+            A :math:`\{N_{samples} \times |t|\}` dimensional boolean array, which is true if all agents are
+            in a position where the scenario is valid.
+        Class : np.ndarray
+            The class name of the behavior in each sample, in the form of a :math:`N_{samples}` dimensional array.
+        T_D : np.ndarray
+            The predicted time until each classification criteria will be met, as a 
+            :math:`\{N_{samples} \times N_{classes} \times |t|\}` dimensional numpy array 
+            (None if classification is not useful).
+        T_class : np.ndarray
+            The time at which each classification criteria is met, as a 
+            :math:`\{N_{samples} \times N_{classes}\}` dimensional numpy array (None if classification is not useful).
+        '''
+        num_samples, N_T = T.shape
+
+        if self.classification_useful:
+            Dist = self.calculate_distance_batch(Path, T, Domain, agents) # Shape (N_samples, N_classes, N_T)
+            in_position = self.evaluate_scenario_batch(Path, Dist, T, Domain, agents) # Shape (N_samples, N_T)
+
+            mean_dt = np.mean(T[:, 1:] - T[:, :-1], axis = 1)
+            n_dt = np.maximum(5, (0.75 * self.dt / mean_dt).astype(int))
+            n_dt = np.minimum(n_dt, N_T - 1)[:, np.newaxis]
+
+            # Get the rate of change of the distances over n_dt timesteps (the first n_dt timesteps use the first rate)
+            ind_1 = np.maximum(np.arange(N_T)[np.newaxis], n_dt) # Shape (N_samples, N_T)
+            ind_0 = ind_1 - n_dt
+            Dist_dt = ((np.take_along_axis(Dist, ind_1[:, np.newaxis], -1) - np.take_along_axis(Dist, ind_0[:, np.newaxis], -1)) / 
+                       (np.take_along_axis(T, ind_1, -1) - np.take_along_axis(T, ind_0, -1))[:, np.newaxis])
+            
+            T_D = Dist / np.maximum(- Dist_dt, 1e-7) # Shape (N_samples, N_classes, N_T)
+
+            # Move the timesteps where the agents are in position to the front
+            num_position = in_position.sum(1)
+            order = np.argsort(~in_position, axis = 1, kind = 'stable')
+            t_position = np.take_along_axis(T, order, -1) # Shape (N_samples, N_T)
+            T_D_position = np.take_along_axis(T_D, order[:, np.newaxis], -1) # Shape (N_samples, N_classes, N_T)
+
+            Valid = np.arange(N_T)[np.newaxis] < num_position[:, np.newaxis]
+            T_D_position = np.where(Valid[:, np.newaxis], T_D_position, np.nan)
+
+            # Find the first time where the predicted time switches from positive to negative
+            time_change = (T_D_position[..., :-1] > 0) & (T_D_position[..., 1:] <= 0) # Shape (N_samples, N_classes, N_T - 1)
+            ind = time_change.argmax(-1)[..., np.newaxis]
+
+            D_0 = np.take_along_axis(T_D_position, ind, -1)[..., 0]
+            D_1 = np.take_along_axis(T_D_position, ind + 1, -1)[..., 0]
+            t_0 = np.take_along_axis(t_position[:, np.newaxis], ind, -1)[..., 0]
+            t_1 = np.take_along_axis(t_position[:, np.newaxis], ind + 1, -1)[..., 0]
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                T_change = (t_1 * D_0 - t_0 * D_1) / (D_0 - D_1)
+
+            # Otherwise, extrapolate from the first or last timestep in position
+            ind_last = np.maximum(num_position - 1, 0)[:, np.newaxis, np.newaxis]
+            D_first = T_D_position[..., 0]
+            D_last  = np.take_along_axis(T_D_position, ind_last, -1)[..., 0]
+            t_first = t_position[:, [0]]
+            t_last  = np.take_along_axis(t_position, ind_last[:, 0], -1)
+            T_no_change = np.where(D_first <= 0, D_first + t_first, D_last + t_last)
+
+            T_class = np.where(time_change.any(-1), T_change, T_no_change) # Shape (N_samples, N_classes)
+            T_class[num_position == 0] = T[num_position == 0, -1, np.newaxis] + 1
+
+            # Check if classification is possible
+            t_position_max = np.where(in_position, T, -np.inf).max(1)
+            Class = np.array(self.Behaviors, object)[T_class.argmin(axis = 1)]
+            Class[(num_position > 0) & (T_class.min(axis = 1) > t_position_max)] = self.behavior_default
+            
+            return Dist, in_position, Class, T_D, T_class
+        else:
+            in_position = self.evaluate_scenario_batch(Path, None, T, Domain, agents)
+            Class = np.full(num_samples, self.behavior_default, object)
+            return None, in_position, Class, None, None
+    
+    
+    def _classify_dense_paths(self, Path_dense, T_list, Domain, agents):
+        # Classify the samples, with those with the same number of timesteps being processed together
+        num_timesteps = np.array([len(t) for t in T_list], int)
+        Output = [None] * len(T_list)
+        for n_T in np.unique(num_timesteps):
+            use = np.where(num_timesteps == n_T)[0]
+            T = np.stack([np.asarray(T_list[i], float) for i in use], 0)
+            Dist, in_position, Class, T_D, T_class = self.classify_path_batch(Path_dense[use, :, :n_T], T, 
+                                                                              Domain.iloc[use], agents)
+            
+            # Transform into the output format of self.classify_path()
+            for j, i in enumerate(use):
+                if self.classification_useful:
+                    Output[i] = [pd.Series(list(Dist[j]), index = self.Behaviors), in_position[j], Class[j],
+                                 pd.Series(list(T_D[j]), index = self.Behaviors), 
+                                 pd.Series(T_class[j], index = self.Behaviors)]
+                else:
+                    Output[i] = [None, in_position[j], Class[j], None, None]
+        return Output
+    
+    
     def increase_path_dim(self, path):
         path_out = path.copy(deep=True)
         for index in path_out.index:
@@ -1903,77 +2441,82 @@ class data_set_template():
             local_t_crit = []
 
             agent_name_array = np.array(Type.columns)
-            Path_sparse = self.get_multiindex_path(Path)
-            for i_sample in range(num_samples):
-                if np.mod(i_sample, 100) == 0:
-                    print('path ' + str(i_sample).rjust(len(str(num_samples))) + '/{} divided'.format(num_samples))
-
-                domain = Domain_old.iloc[i_sample]
-                t = np.array(T[i_sample])
-                path = self.get_dense_path_sample(Path_sparse, i_sample, agent_name_array, len(t))
-
-                # Get the corresponding class
-                d_class, in_position, behavior, t_D_class, t_class = self.classify_path(path, t, domain)
-
-                # Check if scenario is fulfilled
-                if not in_position.any():
-                    continue
+            Num_timesteps = np.array([len(T[i_sample]) for i_sample in range(num_samples)], int)
+            Batch_iterator = self.iterate_dense_path_batches(Path, np.arange(num_samples), agent_name_array, Num_timesteps)
+            for batch_indices, Path_dense, _ in Batch_iterator:
+                # Classify all samples in the batch at once
+                Classifications = self._classify_dense_paths(Path_dense, [T[i_sample] for i_sample in batch_indices],
+                                                             Domain_old.iloc[batch_indices], agent_name_array)
+                for i_batch, i_sample in enumerate(batch_indices):
+                    if np.mod(i_sample, 100) == 0:
+                        print('path ' + str(i_sample).rjust(len(str(num_samples))) + '/{} divided'.format(num_samples))
+
+                    domain = Domain_old.iloc[i_sample]
+                    t = np.array(T[i_sample])
+
+                    # Get the corresponding class
+                    d_class, in_position, behavior, t_D_class, t_class = Classifications[i_batch]
+
+                    # Check if scenario is fulfilled
+                    if not in_position.any():
+                        continue
                 
-                # Get decision time
-                if self.classification_useful:
-                    t_decision = t_class.to_numpy().min()
-                else:
-                    t_decision = t[in_position][-1]
+                    # Get decision time
+                    if self.classification_useful:
+                        t_decision = t_class.to_numpy().min()
+                    else:
+                        t_decision = t[in_position][-1]
 
-                # check if decision can be observed
-                if t_decision > t[in_position].max():
-                    continue
+                    # check if decision can be observed
+                    if t_decision > t[in_position].max():
+                        continue
 
-                ts_allowed = in_position & (t <= t_decision)
-                try:
-                    ind_possible = np.where(ts_allowed)[0]
+                    ts_allowed = in_position & (t <= t_decision)
                     try:
-                        ind_start = np.where(np.invert(ts_allowed[:ind_possible[-1]]))[0][-1] + 1
-                    except:
-                        ind_start = ind_possible[0]
+                        ind_possible = np.where(ts_allowed)[0]
+                        try:
+                            ind_start = np.where(np.invert(ts_allowed[:ind_possible[-1]]))[0][-1] + 1
+                        except:
+                            ind_start = ind_possible[0]
 
-                    t_start = t[ind_start]
-                except:
-                    # there never was as starting point here in the first place
-                    continue
+                        t_start = t[ind_start]
+                    except:
+                        # there never was as starting point here in the first place
+                        continue
 
-                # Determine tcrit
-                if self.classification_useful and (self.pov_agent is not None):
-                    t_D_default = np.minimum(1000, t_D_class[self.behavior_default])
+                    # Determine tcrit
+                    if self.classification_useful and (self.pov_agent is not None):
+                        t_D_default = np.minimum(1000, t_D_class[self.behavior_default])
                     
-                    t_D_useful = self.scenario.calculate_safe_action(d_class, t_D_class, self, path, t, domain)
-                    try:
-                        Delta_tD = t_D_default - t_D_useful
-                        critical = (t > t_start) & (t < t_decision) & (Delta_tD < 0)
-                        ind_crit = np.where(critical)[0][0]
-                        if Delta_tD[ind_crit - 1] < 0:
-                            t_crit = t_start
-                        else:
-                            # Gap starts uncritical
-                            fac_crit = Delta_tD[ind_crit] / (Delta_tD[ind_crit] - Delta_tD[ind_crit - 1])
-                            t_crit = t[ind_crit - 1] * fac_crit + t[ind_crit] * (1 - fac_crit)
-                    except:
-                        if t_D_default[ind_start + 1] < 0:
-                            t_crit = t_start
-                        else:
-                            t_crit = t_decision + 0.01
-                else:
-                    t_crit = t_decision + 0.01
+                        path = self.dense_path_to_series(Path_dense[i_batch, :, :len(t)], agent_name_array)
+                        t_D_useful = self.scenario.calculate_safe_action(d_class, t_D_class, self, path, t, domain)
+                        try:
+                            Delta_tD = t_D_default - t_D_useful
+                            critical = (t > t_start) & (t < t_decision) & (Delta_tD < 0)
+                            ind_crit = np.where(critical)[0][0]
+                            if Delta_tD[ind_crit - 1] < 0:
+                                t_crit = t_start
+                            else:
+                                # Gap starts uncritical
+                                fac_crit = Delta_tD[ind_crit] / (Delta_tD[ind_crit] - Delta_tD[ind_crit - 1])
+                                t_crit = t[ind_crit - 1] * fac_crit + t[ind_crit] * (1 - fac_crit)
+                        except:
+                            if t_D_default[ind_start + 1] < 0:
+                                t_crit = t_start
+                            else:
+                                t_crit = t_decision + 0.01
+                    else:
+                        t_crit = t_decision + 0.01
                 
-                local_id.append(i_sample)
-                local_t.append(t.astype(float))
-                local_D_class.append(d_class)
-                local_behavior.append(behavior)
-                local_T_D_class.append(t_D_class)
-                local_T_class.append(t_class)
-                local_t_start.append(t_start)
-                local_t_decision.append(t_decision)
-                local_t_crit.append(t_crit)
+                    local_id.append(i_sample)
+                    local_t.append(t.astype(float))
+                    local_D_class.append(d_class)
+                    local_behavior.append(behavior)
+                    local_T_D_class.append(t_D_class)
+                    local_T_class.append(t_class)
+                    local_t_start.append(t_start)
+                    local_t_decision.append(t_decision)
+                    local_t_crit.append(t_crit)
 
             # Prevent problem if all t should have same length
             local_t.append([])
@@ -2054,7 +2597,7 @@ class data_set_template():
                         
                         # Load the data
                         Loaded_data = np.load(path_file, allow_pickle=True)
-                        Path_loaded, Type_loaded, _, T_loaded, Domain_old_loaded, num_samples_loaded = self.extract_loaded_data(Loaded_data)
+                        Path_loaded, Type_loaded, _, T_loaded, Domain_old_loaded, num_samples_loaded = self.extract_loaded_data(Loaded_data, path_file)
                 
                     # Load extracted time points
                     [
@@ -2196,11 +2739,14 @@ class data_set_template():
             
         return num_timesteps_real, num_timesteps_need
     
-    def set_extraction_parameters(self, t0_type, T0_type_compare, max_num_agents):
+    def set_extraction_parameters(self, t0_type, T0_type_compare, max_num_agents, num_extraction_workers = 1):
         assert isinstance(t0_type, str), "Prediction time method has to be a string."
         assert isinstance(T0_type_compare, list), "Prediction time constraints have to be in a list."
         for t in T0_type_compare:
             assert isinstance(t, str), "Prediction time constraints must come in the form of strings."
+        assert isinstance(num_extraction_workers, int), "The number of extraction workers has to be an integer."
+        
+        self.num_extraction_workers = max(1, num_extraction_workers)
         
         self.t0_type = t0_type
         self.T0_type_compare = T0_type_compare
@@ -2403,8 +2949,9 @@ class data_set_template():
         predicted_saving_length = 0
 
         agent_name_array = np.array(Type_old.columns)
-
-        Path_sparse = self.get_multiindex_path(Path)
+        
+        Num_timesteps = np.array([len(t) for t in local_t], int)
+        Path_iterator = self.iterate_dense_path_samples(Path, local_id, agent_name_array, Num_timesteps)
         for i in range(local_num_samples):
             # print progress
             if np.mod(i, 1) == 0:
@@ -2414,7 +2961,7 @@ class data_set_template():
             # load extracted data
             i_path = local_id[i]
             t = local_t[i]
-            path = self.get_dense_path_sample(Path_sparse, i_path, agent_name_array, len(t))
+            path = next(Path_iterator)
 
             behavior = local_behavior[i]
             t_start = local_t_start[i]
@@ -3306,6 +3853,104 @@ class data_set_template():
             return memory_used / (0.4 * self.available_memory_data_extraction)
         
     
+    def get_orig_path_file(self, i_orig_path):
+        # Get path name adjustment
+        path_file = self.file_path + '--all_orig_paths'
+        
+        # Get path file adjustment
+        if self.number_original_path_files == 1:
+            # Get path name adjustment
+            path_file_adjust = '_LLL'
+        else:
+            # Get path name adjustment
+            if i_orig_path < self.number_original_path_files - 1:
+                path_file_adjust = '_' + str(i_orig_path).zfill(3)
+            else:
+                path_file_adjust = '_LLL'
+                
+        path_file += path_file_adjust + '.npy'
+        return path_file, path_file_adjust
+    
+    
+    def extract_orig_path_file(self, i_orig_path):
+        path_file, path_file_adjust = self.get_orig_path_file(i_orig_path)
+        
+        # Get path data
+        if self.number_original_path_files == 1:
+            # Get the allready loaded data
+            Path_loaded = self.Path
+            Type_old_loaded = self.Type_old
+            Size_old_loaded = self.Size_old
+            T_loaded = self.T
+            Domain_old_loaded = self.Domain_old
+            num_samples_loaded = self.num_samples
+    
+        else:
+            # Load the data
+            Loaded_data = np.load(path_file, allow_pickle=True)
+            Path_loaded, Type_old_loaded, Size_old_loaded, T_loaded, Domain_old_loaded, num_samples_loaded = self.extract_loaded_data(Loaded_data, path_file)
+
+        # Adjust base data file name accordingly
+        self.get_data_from_orig_path(Path_loaded, Type_old_loaded, Size_old_loaded, T_loaded, Domain_old_loaded, num_samples_loaded, path_file, path_file_adjust)
+    
+    
+    def get_number_of_extraction_workers(self, Orig_path_indices):
+        # Check if parallel extraction is wanted and possible
+        if self.num_extraction_workers <= 1 or len(Orig_path_indices) <= 1:
+            return 1
+        
+        # Perturbations might require the GPU, and are therefore applied serially
+        if self.is_perturbed:
+            return 1
+        
+        # The workers inherit the dataset object, which is only possible when forking
+        if not 'fork' in mp.get_all_start_methods():
+            return 1
+        
+        num_workers = min(self.num_extraction_workers, len(Orig_path_indices), os.cpu_count())
+
+        # Get the currently available RAM space
+        total_memory = get_total_memory(print_output = False)
+        if total_memory is None:
+            total_memory = self.total_memory
+        available_memory = total_memory - get_used_memory()
+
+        # Estimate the memory needed for the extraction of the largest original path file
+        max_file_size = 0
+        for i_orig_path in Orig_path_indices:
+            path_file, _ = self.get_orig_path_file(i_orig_path)
+            file_size = os.path.getsize(path_file)
+            columnar_directory = self.get_columnar_path_directory(path_file)
+            if os.path.isdir(columnar_directory):
+                file_size += sum([os.path.getsize(columnar_directory + os.sep + f) for f in os.listdir(columnar_directory)])
+            max_file_size = max(max_file_size, file_size)
+        
+        # Loaded data, dense paths and extracted samples take multiple times the file size
+        memory_per_worker = 5 * max_file_size + 500 * 2**20
+        num_workers = min(num_workers, int(0.8 * available_memory / memory_per_worker))
+        return max(1, num_workers)
+    
+    
+    def extract_orig_path_files_parallel(self, Orig_path_indices, num_workers):
+        global _parallel_extraction_data_set
+        print('Extract {} original path files using {} processes'.format(len(Orig_path_indices), num_workers), flush = True)
+
+        # Split the available RAM space between the workers, so that they save their data early enough
+        self.available_memory_data_extraction = (self.total_memory - get_used_memory()) / num_workers
+        
+        # Share the dataset object with the forked workers
+        _parallel_extraction_data_set = self
+        try:
+            ctx = mp.get_context('fork')
+            # Use a new process for each file to free up the memory afterwards
+            with ctx.Pool(num_workers, maxtasksperchild = 1) as pool:
+                pool.map(_extract_orig_path_file_worker, Orig_path_indices, chunksize = 1)
+        finally:
+            _parallel_extraction_data_set = None
+        
+        print('Extracted {} original path files'.format(len(Orig_path_indices)), flush = True)
+
+    
     def get_data(self, dt, num_timesteps_in, num_timesteps_out):
         '''
         Parameters
@@ -3335,52 +3980,26 @@ class data_set_template():
                 ('col_equal' in [t0_type_extra[:9] for t0_type_extra in self.T0_type_compare])):
                 self.determine_dtc_boundary()
             
-            # Go through original data
+            # Find the original path files that still have to be extracted
+            Orig_path_indices = []
             for i_orig_path in range(self.number_original_path_files):
-                # Get path name adjustment
-                path_file = self.file_path + '--all_orig_paths'
-                
-                # Get path file adjustment
-                if self.number_original_path_files == 1:
-                    # Get path name adjustment
-                    path_file_adjust = '_LLL'
-                else:
-                    # Get path name adjustment
-                    if i_orig_path < self.number_original_path_files - 1:
-                        path_file_adjust = '_' + str(i_orig_path).zfill(3)
-                    else:
-                        path_file_adjust = '_LLL'
-                        
-                path_file += path_file_adjust + '.npy'
-                
+                _, path_file_adjust = self.get_orig_path_file(i_orig_path)
+
                 # Check if data is allready completely extracted, making renew extraction unnecessary
                 data_file_test = self.data_file[:-4] + path_file_adjust + '_LLL_data.npy'
-                
-                if os.path.isfile(data_file_test):
-                    continue
-                
+                if not os.path.isfile(data_file_test):
+                    Orig_path_indices.append(i_orig_path)
             
+            # Go through original data
+            num_workers = self.get_number_of_extraction_workers(Orig_path_indices)
+            if num_workers > 1:
+                self.extract_orig_path_files_parallel(Orig_path_indices, num_workers)
+            else:
+                for i_orig_path in Orig_path_indices:
+                    # Get the currently available RAM space
+                    self.available_memory_data_extraction = self.total_memory - get_used_memory()
                     
-                # Get path data
-                if self.number_original_path_files == 1:
-                    # Get the allready loaded data
-                    Path_loaded = self.Path
-                    Type_old_loaded = self.Type_old
-                    Size_old_loaded = self.Size_old
-                    T_loaded = self.T
-                    Domain_old_loaded = self.Domain_old
-                    num_samples_loaded = self.num_samples
-            
-                else:
-                    # Load the data
-                    Loaded_data = np.load(path_file, allow_pickle=True)
-                    Path_loaded, Type_old_loaded, Size_old_loaded, T_loaded, Domain_old_loaded, num_samples_loaded = self.extract_loaded_data(Loaded_data)
-
-                # Get the currently available RAM space
-                self.available_memory_data_extraction = self.total_memory - get_used_memory()
-
-                # Adjust base data file name accordingly
-                self.get_data_from_orig_path(Path_loaded, Type_old_loaded, Size_old_loaded, T_loaded, Domain_old_loaded, num_samples_loaded, path_file, path_file_adjust)
+                    self.extract_orig_path_file(i_orig_path)
                 
         
         # Get the number of files
@@ -3428,8 +4047,8 @@ class data_set_template():
             self.Recorded = None
             
             # Combine the Domains, Output_T_pred and number of behaviors
-            self.Domain = pd.DataFrame(np.zeros((0,0), np.ndarray))
-            self.Output_T_pred = np.zeros(0, object)
+            Domains = [pd.DataFrame(np.zeros((0,0), np.ndarray))]
+            Output_T_preds = [np.zeros(0, object)]
             
             self.num_behaviors     = np.zeros(len(self.Behaviors), int)
             self.num_behaviors_out = np.zeros(len(self.Behaviors), int)
@@ -3438,20 +4057,17 @@ class data_set_template():
             
             # Get needed data files 
             for domain_file in domain_files:
-                Domain, num_behaviors, num_behaviors_out, Agents, _ = np.load(domain_file, allow_pickle=True) 
+                Domain, num_behaviors, num_behaviors_out, Agents, Output_T_pred = self.get_domain_file_summary(domain_file)
                 
-                self.Domain = pd.concat([self.Domain, Domain], axis = 0)
+                Domains.append(Domain)
+                Output_T_preds.append(Output_T_pred)
                 self.num_behaviors     += num_behaviors
                 self.num_behaviors_out += num_behaviors_out
 
-                # load Output_T_pred
-                Output_T_pred = np.load(domain_file[:-11] + '_data.npy', allow_pickle=True)[5]
-
-                # Make sure to use the right index
-                Output_T_pred = Output_T_pred[Domain.Index_saved.to_numpy()]
-                self.Output_T_pred = np.concatenate([self.Output_T_pred, Output_T_pred], 0)
-
                 self.Agents += Agents
+            
+            self.Domain = pd.concat(Domains, axis = 0)
+            self.Output_T_pred = np.concatenate(Output_T_preds, 0)
                 
         self.Agents, index = np.unique(self.Agents, return_index = True)
         # Sort the agents, so that the entry appearing first is the one that is kept first
@@ -3489,6 +4105,51 @@ class data_set_template():
 
         
     
+    def get_domain_file_summary(self, domain_file):
+        r'''
+        This function returns the information of a single saved chunk of the dataset that is 
+        needed for assembling the data. As getting Output_T_pred requires loading the whole data
+        file of the chunk, this is cached on the disk, so that it is only recomputed if the chunk changes
+        (the cache is keyed on the size and modification time of the chunk files, and older caches of
+        the chunk are removed).
+
+        Parameters
+        ----------
+        domain_file : str
+            The path of the *_domain.npy* file of the chunk.
+
+        Returns
+        -------
+        Domain : pandas.DataFrame
+            The domain of the samples in the chunk.
+        num_behaviors : np.ndarray
+            The number of samples of each behavior in the chunk.
+        num_behaviors_out : np.ndarray
+            The number of samples of each behavior in the chunk, which are observed until the end.
+        Agents : list
+            The agents in the chunk.
+        Output_T_pred : np.ndarray
+            The prediction timesteps of each sample in the chunk, in the order of Domain.
+        '''
+        chunk_file = domain_file[:-11]
+        cache_file = get_chunk_cache_file(chunk_file, 'domain_summary')
+        if os.path.isfile(cache_file):
+            [Domain, num_behaviors, num_behaviors_out, Agents, Output_T_pred, _] = np.load(cache_file, allow_pickle = True)
+            return Domain, num_behaviors, num_behaviors_out, Agents, Output_T_pred
+        
+        Domain, num_behaviors, num_behaviors_out, Agents, _ = np.load(domain_file, allow_pickle=True) 
+        
+        # load Output_T_pred
+        Output_T_pred = np.load(chunk_file + '_data.npy', allow_pickle=True)[5]
+
+        # Make sure to use the right index
+        Output_T_pred = Output_T_pred[Domain.Index_saved.to_numpy()]
+        
+        summary_data = np.array([Domain, num_behaviors, num_behaviors_out, Agents, Output_T_pred, 0], object)
+        save_chunk_cache_file(cache_file, summary_data)
+        return Domain, num_behaviors, num_behaviors_out, Agents, Output_T_pred
+    
+    
     def change_agent_name(self, old_name, new_name, domain_file):
         assert isinstance(old_name, str), "The old name has to be a string."
         assert isinstance(new_name, str), "The new name has to be a string."
@@ -3579,42 +4240,160 @@ class data_set_template():
     
     
     def _interpolate_image(self, imgs_rot, pos_old, image):
+        # imgs_rot: Preallocated output images, with shape num_samples x height x width x num_channels
+        # pos_old: Pixel positions in the map that are sampled, with shape num_samples x height x width x 2
+        # image: The map as a float tensor, with shape 1 x num_channels_map x height_map x width_map
+        num_samples, height, width, _ = pos_old.shape
+        height_map, width_map = image.shape[2:]
+        
+        useful = ((0 <= pos_old[...,0]) & (pos_old[...,0] <= width_map - 1) &
+                  (0 <= pos_old[...,1]) & (pos_old[...,1] <= height_map - 1))
+        
+        # Normalize the positions, where -1 and 1 correspond to the outer pixel centers
+        grid = torch.stack([2 * pos_old[...,0] / max(width_map - 1, 1) - 1,
+                            2 * pos_old[...,1] / max(height_map - 1, 1) - 1], -1)
+        
+        # Sample all images in one bilinear interpolation by stacking them along the height
+        grid = grid.reshape(1, num_samples * height, width, 2)
+        imgs_rot_v = torch.nn.functional.grid_sample(image, grid, mode = 'bilinear', 
+                                                     padding_mode = 'zeros', align_corners = True)
+        del grid
+        
+        imgs_rot_v = imgs_rot_v[0].permute(1,2,0).reshape(num_samples, height, width, -1)
+        
+        if imgs_rot.shape[-1] == 1:
+            imgs_rot_v = imgs_rot_v.mean(-1, keepdims = True)
+        
+        imgs_rot[useful] = imgs_rot_v[useful].to(dtype = imgs_rot.dtype)
+        
+        return imgs_rot
+    
+    
+    def _get_image_window(self, image, pos_old, device):
+        # image: The map (possibly a memory map), with shape height_map x width_map x num_channels
+        # pos_old: Pixel positions in the map that are sampled, with shape num_samples x height x width x 2
+        height_map, width_map = image.shape[:2]
+        
+        inside = ((0 <= pos_old[...,0]) & (pos_old[...,0] <= width_map - 1) &
+                  (0 <= pos_old[...,1]) & (pos_old[...,1] <= height_map - 1))
+        
+        if not bool(inside.any()):
+            return None, pos_old
+        
+        # Get the smallest window that contains all neighboring pixels of the sampled positions,
+        # so that interpolating in the window is the same as interpolating in the whole map
+        pos_inside = pos_old[inside]
+        x_min = int(np.floor(pos_inside[:,0].min().item()))
+        y_min = int(np.floor(pos_inside[:,1].min().item()))
+        x_max = min(int(np.ceil(pos_inside[:,0].max().item())) + 1, width_map)
+        y_max = min(int(np.ceil(pos_inside[:,1].max().item())) + 1, height_map)
+        del inside, pos_inside
+        
+        window = np.ascontiguousarray(image[y_min:y_max, x_min:x_max])
+        window = torch.from_numpy(window).to(device = device, dtype = torch.float32)
+        window = window.permute(2,0,1).unsqueeze(0)
+        
+        pos_old = pos_old - torch.tensor([x_min, y_min], dtype = pos_old.dtype, device = pos_old.device)
+        return window, pos_old
+    
+    
+    def get_image_pyramid_level(self, location, target_m_per_px = None):
+        r'''
+        This function returns the version of a map that should be sampled to get images of the
+        desired resolution. For this, downsampled versions of the maps (each halving the 
+        resolution of the previous one) are taken from the map rasters (see *self.load_map_rasters()*),
+        or, if the images were not loaded from there, computed once per map and kept in memory
+        (in the data type of the map, with integer maps being rounded to the nearest value).
+
+        Parameters
+        ----------
+        location : int or str
+            The image_id of the map in **self.Images**.
+        target_m_per_px : float, optional
+            The resolution of the images that will be extracted from the map. If it is None,
+            the full resolution map is returned. The default is None.
+
+        Returns
+        -------
+        image : np.ndarray
+            The map at the selected resolution, with shape :math:`\{H_{map} \times W_{map} \times C\}`.
+        level_m_per_px : float
+            The resolution of the returned map in meters per pixel.
+        level_offset : float
+            The position of the first pixel of the returned map, in pixels of the full resolution map.
+        '''
+        image = self.Images.Image.loc[location]
+        m_per_px = float(self.Images.Target_MeterPerPx.loc[location])
         
-        useful = ((0 <= pos_old[...,0]) & (pos_old[...,0] <= image.shape[1] - 1) &
-                  (0 <= pos_old[...,1]) & (pos_old[...,1] <= image.shape[0] - 1))
+        if target_m_per_px is None:
+            return image, m_per_px, 0.0
         
-        useful_ind, useful_row, useful_col = torch.where(useful)
-        pos_old = pos_old[useful_ind, useful_row, useful_col,:]
+        # Get the coarsest level that still has at least the desired resolution
+        num_levels = int(np.floor(np.log2(max(target_m_per_px / m_per_px, 1.0)) + 1e-6))
+        num_levels = min(num_levels, get_number_of_pyramid_levels(image.shape))
+        if num_levels == 0:
+            return image, m_per_px, 0.0
         
-        pos_up  = torch.ceil(pos_old).to(dtype = torch.int64)
-        pos_low = torch.floor(pos_old).to(dtype = torch.int64)
+        level_fac = 2 ** num_levels
+        level_offset = (level_fac - 1) / 2
         
-        imgs_rot_uu = image[pos_up[:,1],  pos_up[:,0]]
-        imgs_rot_ul = image[pos_up[:,1],  pos_low[:,0]]
-        imgs_rot_lu = image[pos_low[:,1], pos_up[:,0]]
-        imgs_rot_ll = image[pos_low[:,1], pos_low[:,0]]
+        # Use the precomputed downsampled maps, if the images were loaded from the map rasters
+        if hasattr(self, 'Map_rasters') and (self.Map_rasters.Images is self.Images):
+            return self.Map_rasters.get_level(location, num_levels), m_per_px * level_fac, level_offset
         
-        del pos_up, pos_low
+        if not hasattr(self, 'Image_pyramids'):
+            self.Image_pyramids = {}
         
-        pos_fac = torch.remainder(pos_old, 1)
+        if location not in self.Image_pyramids.keys():
+            self.Image_pyramids[location] = []
         
-        imgs_rot_u = imgs_rot_uu * (pos_fac[:,[0]]) + imgs_rot_ul * (1 - pos_fac[:,[0]])
-        imgs_rot_l = imgs_rot_lu * (pos_fac[:,[0]]) + imgs_rot_ll * (1 - pos_fac[:,[0]])
+        # Keep the levels in the data type of the map (e.g., uint8), as they are only converted to float
+        # for the sampled windows (see *self._get_image_window()*)
+        if np.issubdtype(image.dtype, np.number) and image.dtype != bool:
+            level_dtype = image.dtype
+        else:
+            level_dtype = np.float32
         
-        del imgs_rot_uu, imgs_rot_ul, imgs_rot_lu, imgs_rot_ll
+        Pyramid = self.Image_pyramids[location]
+        while len(Pyramid) < num_levels:
+            if len(Pyramid) == 0:
+                image_prev = image
+            else:
+                image_prev = Pyramid[-1]
+            
+            # Average over blocks of 2 x 2 pixels, processing chunks of rows so that the float version
+            # of the map is never held in memory completely
+            height_new, width_new = image_prev.shape[0] // 2, image_prev.shape[1] // 2
+            image_new = np.empty((height_new, width_new) + image_prev.shape[2:], level_dtype)
+            
+            rows_per_chunk = max(1, int(2 ** 24 / max(1, image_prev[:1].size)))
+            for i_start in range(0, height_new, rows_per_chunk):
+                i_end = min(i_start + rows_per_chunk, height_new)
+                chunk = np.asarray(image_prev[2 * i_start:2 * i_end, :2 * width_new]).astype(np.float32)
+                chunk = chunk.reshape((i_end - i_start, 2, width_new, 2) + image_prev.shape[2:]).mean((1,3))
+                if np.issubdtype(level_dtype, np.integer):
+                    chunk = np.rint(chunk)
+                image_new[i_start:i_end] = chunk
+            
+            Pyramid.append(image_new)
         
-        imgs_rot_v = imgs_rot_u * (pos_fac[:,[1]]) + imgs_rot_l * (1 - pos_fac[:,[1]])
+        return Pyramid[num_levels - 1], m_per_px * level_fac, level_offset
+    
+    
+    def get_image_batch_size(self, target_width, target_height, num_channels, device):
+        # Estimate the memory needed per image (sampling grids, float results and final output)
+        required_memory = target_width * target_height * (2 * 4 * 3 + num_channels * 4 * 3 + 3)
         
-        if imgs_rot.shape[-1] == 1:
-            imgs_rot[useful] = imgs_rot_v.mean(-1, keepdims = True).to(dtype = image.dtype)
+        if device.type == 'cuda':
+            available_memory = torch.cuda.mem_get_info(device)[0]
         else:
-            imgs_rot[useful] = imgs_rot_v.to(dtype = image.dtype)
+            available_memory = self.total_memory - get_used_memory()
         
-        return imgs_rot
+        return max(1, int(0.25 * available_memory / required_memory))
     
     
     def return_batch_images(self, domain, center, rot_angle, target_width, target_height, grayscale,
-                            Imgs_rot, Imgs_index, print_progress = False):
+                            Imgs_rot, Imgs_index, print_progress = False, target_m_per_px = None):
         if self.includes_images():
             if print_progress:
                 print('')
@@ -3624,7 +4403,6 @@ class data_set_template():
             # Find the gpu
             if not torch.cuda.is_available():
                 device = torch.device('cpu')
-                raise TypeError("The GPU has gone and fucked itself")
             else:
                 if torch.cuda.device_count() == 1:
                     # If you have CUDA_VISIBLE_DEVICES set, which you should,
@@ -3644,10 +4422,15 @@ class data_set_template():
                 print('')
                 print('Extract rotation matrix', flush = True)
             
-            # check if images are float
-            if self.Images.Image.iloc[0].max() > 1:
+            # check if images are float (using the saved value range of map rasters, to avoid reading the whole map)
+            if hasattr(self, 'Map_rasters') and (self.Map_rasters.Images is self.Images):
+                image_max = self.Map_rasters.Max_values.iloc[0]
+            else:
+                image_max = self.Images.Image.iloc[0].max()
+            
+            if image_max > 1:
                 rgb = True
-                assert self.Images.Image.iloc[0].max() < 256
+                assert image_max < 256
             else:
                 rgb = False
             
@@ -3669,21 +4452,28 @@ class data_set_template():
             else: 
                 second_stage = False
             
+            # Combine both stages into one affine transformation per sample (pos_new = pos_old * A + b)
+            Affine_matrix = np.tile(np.eye(2)[np.newaxis], (len(domain), 1, 1))
+            Affine_offset = np.zeros((len(domain), 2))
+            
             if first_stage:
                 # Get rotation matrix (R * x is from orignal to current)
                 Rot_matrix = np.array([[np.cos(rot_angle), np.sin(rot_angle)],
                                        [-np.sin(rot_angle), np.cos(rot_angle)]]).transpose(2,0,1)
-            
-                Rot_matrix = torch.from_numpy(Rot_matrix).float().to(device = device)
-                center     = torch.from_numpy(center).float().to(device = device)
+                
+                Affine_matrix = Rot_matrix
+                Affine_offset = np.asarray(center, float)
                 
             if second_stage:
                 Rot_matrix_old = np.array([[np.cos(domain.rot_angle), np.sin(domain.rot_angle)],
                                            [-np.sin(domain.rot_angle), np.cos(domain.rot_angle)]]).transpose(2,0,1)
                 center_old = np.stack([domain.x_center, domain.y_center], -1)
+                
+                Affine_matrix = np.matmul(Affine_matrix, Rot_matrix_old)
+                Affine_offset = np.matmul(Affine_offset[:,np.newaxis], Rot_matrix_old)[:,0] + center_old
         
-                Rot_matrix_old = torch.from_numpy(Rot_matrix_old).float().to(device = device)
-                center_old     = torch.from_numpy(center_old).float().to(device = device)
+            Affine_matrix = torch.from_numpy(Affine_matrix).float().to(device = device)
+            Affine_offset = torch.from_numpy(Affine_offset).float().to(device = device)
             
             # setup meshgrid
             height_fac = (target_height - 1) / 2 
@@ -3697,7 +4487,9 @@ class data_set_template():
             Pos_old[...,1] *= -1
             # Pos_old: Position in goal coordinate system in Px.
 
-            n = 250
+            # Get the number of images that can be rotated at once
+            num_channels = 1 if grayscale else 3
+            n = self.get_image_batch_size(target_width, target_height, num_channels, device)
             image_num = 0
 
             # Go through unique path_additions
@@ -3712,10 +4504,20 @@ class data_set_template():
                 for location in np.unique(Locations_unique_path):
                     loc_indices = np.where(Locations_unique_path == location)[0]
                     
-                    loc_Image = torch.from_numpy(self.Images.Image.loc[location]).to(device = device)
+                    # Get the map with the resolution closest to the desired one
+                    loc_image, level_M2px, level_offset = self.get_image_pyramid_level(location, target_m_per_px)
+                    loc_dtype = torch.from_numpy(np.array(self.Images.Image.loc[location][:1,:1])).dtype
                     loc_M2px  = float(self.Images.Target_MeterPerPx.loc[location])
+                    
+                    # The size of the pixels of the rotated images
+                    if target_m_per_px is None:
+                        out_M2px = loc_M2px
+                    else:
+                        out_M2px = float(target_m_per_px)
+                    
                     for i in range(0, len(loc_indices), n):
-                        torch.cuda.empty_cache()
+                        if device.type == 'cuda':
+                            torch.cuda.empty_cache()
                         Index_local = np.arange(i, min(i + n, len(loc_indices)))
                         Index = path_indices[loc_indices[Index_local]]
                         
@@ -3725,39 +4527,36 @@ class data_set_template():
                         image_num = image_num + len(Index)
                         Index_torch = torch.from_numpy(Index).to(device = device, dtype = torch.int64)
                         
-                        # Position in goal coordinate system in Px.
-                        pos_old = Pos_old * loc_M2px
-                        
-                        # Get position in the coordinate system in self.paths
-                        if first_stage:
-                            pos_old = torch.matmul(pos_old, Rot_matrix[Index_torch].unsqueeze(1))
-                            pos_old = pos_old + center[Index_torch,:].unsqueeze(1).unsqueeze(1)
+                        # Position in goal coordinate system in meters.
+                        pos_old = Pos_old * out_M2px
                         
                         # Get position im Image aligned coordinate system
-                        if second_stage:
-                            pos_old = torch.matmul(pos_old, Rot_matrix_old[Index_torch].unsqueeze(1))
-                            pos_old = pos_old + center_old[Index_torch,:].unsqueeze(1).unsqueeze(1)
+                        pos_old = torch.matmul(pos_old, Affine_matrix[Index_torch].unsqueeze(1))
+                        pos_old = pos_old + Affine_offset[Index_torch,:].unsqueeze(1).unsqueeze(1)
                         
                         # Get pixel position in Image
                         pos_old = pos_old / loc_M2px
                         pos_old[...,1] *= -1
                         
-                        torch.cuda.empty_cache()
+                        # Get pixel position in the downsampled image
+                        pos_old = (pos_old - level_offset) * (loc_M2px / level_M2px)
                         
                         # Enforce grayscale here using the gpu
-                        if grayscale:
-                            imgs_rot = torch.zeros((len(Index), target_height, target_width, 1), dtype = loc_Image.dtype, device = device)
-                        else:
-                            imgs_rot = torch.zeros((len(Index), target_height, target_width, 3), dtype = loc_Image.dtype, device = device)
-                        
+                        imgs_rot = torch.zeros((len(Index), target_height, target_width, num_channels), dtype = loc_dtype, device = device)
                         
-                        imgs_rot = self._interpolate_image(imgs_rot, pos_old, loc_Image)
+                        # Only copy the part of the map that is sampled for this batch
+                        loc_Image, pos_old = self._get_image_window(loc_image, pos_old, device)
+                        if loc_Image is not None:
+                            imgs_rot = self._interpolate_image(imgs_rot, pos_old, loc_Image)
+                        del pos_old, loc_Image
                         
                         if not rgb:
                             imgs_rot = 255 * imgs_rot
                             
-                        torch.cuda.empty_cache()
                         Imgs_rot[Imgs_index[Index]] = imgs_rot.detach().cpu().numpy().astype('uint8')
+                    
+                    if device.type == 'cuda':
+                        torch.cuda.empty_cache()
         
             return Imgs_rot
         else:
@@ -3765,47 +4564,207 @@ class data_set_template():
             
 
 
-    def cut_sceneGraph(self, loc_Graph, X, radius, wave_length = 1.0):
+    def get_sceneGraph_index(self, loc_Graph):
+        r'''
+        This function builds a spatial index over the centerlines of a scene graph, which
+        allows to find the lane segments close to a set of agents without going through all
+        lane segments of the location.
+
+        Parameters
+        ----------
+        loc_Graph : pandas.Series
+            The scene graph of a location (i.e., one row of **self.SceneGraphs**).
+
+        Returns
+        -------
+        loc_Graph_index : dict
+            This dictionary contains the following keys:
+                lane_ids          - The ids of the :math:`N_{lanes}` lane segments, in the order of loc_Graph.centerlines.
+                lane_node_offsets - The :math:`N_{lanes} + 1` offsets of the nodes of each lane segment in loc_Graph.lane_idcs.
+                tree              - A scipy.spatial.cKDTree over all finite centerline points.
+                point_lane        - The position of the lane segment each point in the tree belongs to.
+        '''
+        lane_idcs = loc_Graph.lane_idcs
+        
+        # Get original lane id range, using
+        new_lane = np.where(lane_idcs[1:] != lane_idcs[:-1])[0] + 1
+        lane_ids = np.concatenate((lane_idcs[[0]], lane_idcs[new_lane]), 0)
+        assert len(lane_ids) == len(loc_Graph.centerlines), "Lane ids are not correct."
+        
+        # Check that pair ids are within lane_ids
+        assert np.all(np.isin(loc_Graph.pre_pairs.flatten(), lane_ids)), "Predecessor pair ids are not within lane_ids."
+        assert np.all(np.isin(loc_Graph.suc_pairs.flatten(), lane_ids)), "Successor pair ids are not within lane_ids."
+        assert np.all(np.isin(loc_Graph.left_pairs.flatten(), lane_ids)), "Left pair ids are not within lane_ids."
+        assert np.all(np.isin(loc_Graph.right_pairs.flatten(), lane_ids)), "Right pair ids are not within lane_ids."
+        
+        # Get the nodes belonging to each lane (lane_idcs is sorted into blocks by the check above)
+        lane_node_offsets = np.concatenate(([0], new_lane, [len(lane_idcs)])).astype(int)
+        
+        # Only lanes with close centerline points are kept during cutting, so only those are indexed
+        centerline_points = [np.asarray(centerline, float).reshape(-1, 2) for centerline in loc_Graph.centerlines]
+        point_lane = np.repeat(np.arange(len(centerline_points)), [len(centerline) for centerline in centerline_points])
+        if len(centerline_points) > 0:
+            points = np.concatenate(centerline_points, 0)
+        else:
+            points = np.zeros((0, 2), float)
+        
+        useful_points = np.isfinite(points).all(-1)
+        
+        loc_Graph_index = {'lane_ids': lane_ids,
+                           'lane_node_offsets': lane_node_offsets,
+                           'tree': sp.spatial.cKDTree(points[useful_points]),
+                           'point_lane': point_lane[useful_points]}
+        return loc_Graph_index
+    
+    
+    def get_sceneGraph_candidate_lanes(self, loc_Graph_index, X_a, radius):
+        # Get all centerline points within the radius around any agent
+        points_close = loc_Graph_index['tree'].query_ball_point(X_a, radius)
+        points_close = np.unique(np.concatenate([np.array(points, int) for points in points_close] + [np.zeros(0, int)]))
+        
+        # Lanes with less than two close centerline points are not kept
+        num_lanes = len(loc_Graph_index['lane_ids'])
+        num_points_close = np.bincount(loc_Graph_index['point_lane'][points_close], minlength = num_lanes)
+        return np.where(num_points_close >= 2)[0]
+    
+    
+    def get_sceneGraph_connections(self, loc_Graph, loc_Graph_index, wave_length = 1.0):
+        r'''
+        This function returns the node connections (see self.add_node_connections) of the whole scene graph
+        of a location, after its centerlines were thinned out to roughly one point per wave length. As those
+        are expensive to calculate, this is only done once per location and wave length, with the results being
+        stored in the spatial index of the location. Cut scene graphs can then be derived from them by slicing.
+
+        As the centerlines are thinned out before they are cut, the kept points are counted from the start of 
+        each lane segment, instead of from the first point within the cut radius. The nodes of a cut scene graph
+        can therefore be shifted by up to one wave length compared to thinning the cut centerlines.
+
+        Parameters
+        ----------
+        loc_Graph : pandas.Series
+            The scene graph of a location (i.e., one row of **self.SceneGraphs**).
+        loc_Graph_index : dict
+            The spatial index of the location (see self.get_sceneGraph_index).
+        wave_length : float
+            The approximate distance between two consecutive centerline points.
+
+        Returns
+        -------
+        loc_Graph_connections : dict
+            This dictionary contains the following keys:
+                graph             - The thinned scene graph with the added node connections. Only lane segments with
+                                    at least two centerline points are included.
+                centerlines       - The :math:`N_{lanes}` thinned centerlines, in the order of loc_Graph.centerlines.
+                lane_node_offsets - The :math:`N_{lanes} + 1` offsets of the nodes of each lane segment in graph.lane_idcs.
+                node_lanes        - The position of the lane segment each node of the graph belongs to.
+        '''
+        if 'connections' not in loc_Graph_index.keys():
+            loc_Graph_index['connections'] = {}
+        
+        if wave_length in loc_Graph_index['connections'].keys():
+            return loc_Graph_index['connections'][wave_length]
+        
+        lane_ids = loc_Graph_index['lane_ids']
+        num_lanes = len(lane_ids)
+        
+        # Thin out the centerlines, so that the consecutive points are roughly one wave length apart
+        centerlines = np.empty(num_lanes, object)
+        num_lane_nodes = np.zeros(num_lanes, int)
+        for i_lane in range(num_lanes):
+            centerline_pts = np.asarray(loc_Graph.centerlines[i_lane], float).reshape(-1, 2)
+            centerline_pts = centerline_pts[np.isfinite(centerline_pts).all(-1)]
+            
+            # Cumulative distance
+            dist_cons_center = np.linalg.norm(centerline_pts[1:] - centerline_pts[:-1], axis = 1)
+            cum_dist_center = np.concatenate([[0], np.cumsum(dist_cons_center / wave_length)]).astype(int)
+            
+            # get points that are unnecessary
+            remove_center = np.zeros(len(centerline_pts), bool)
+            remove_center[1:-1] = cum_dist_center[1:-1] == cum_dist_center[:-2]
+            
+            centerlines[i_lane] = centerline_pts[~remove_center]
+            num_lane_nodes[i_lane] = max(len(centerlines[i_lane]) - 1, 0)
+        
+        # Lane segments without nodes can never be kept during cutting
+        useful_lanes = num_lane_nodes > 0
+        
+        lane_id_map = np.full((lane_ids.max() + 1,), -1, dtype = int)
+        lane_id_map[lane_ids[useful_lanes]] = np.arange(useful_lanes.sum())
+        
+        Pairs = []
+        for pairs in [loc_Graph.pre_pairs, loc_Graph.suc_pairs, loc_Graph.left_pairs, loc_Graph.right_pairs]:
+            pairs = lane_id_map[np.asarray(pairs, int).reshape(-1, 2)]
+            Pairs.append(pairs[(pairs >= 0).all(1)])
+        
+        lane_idcs = np.repeat(np.arange(useful_lanes.sum()), num_lane_nodes[useful_lanes])
+        lane_type = [loc_Graph.lane_type[i] for i in np.where(useful_lanes)[0]]
+        
+        # Assemble thinned graph (boundaries are not needed for the node connections)
+        graph = pd.Series([len(lane_idcs), lane_idcs, *Pairs, 
+                           centerlines[useful_lanes], centerlines[useful_lanes], centerlines[useful_lanes], lane_type],
+                          index = ['num_nodes', 'lane_idcs', 'pre_pairs', 'suc_pairs', 'left_pairs', 'right_pairs',
+                                   'left_boundaries', 'right_boundaries', 'centerlines', 'lane_type'])
+        
+        # The dense matrices over all lane segments and nodes used otherwise might not fit into memory for whole maps
+        graph = self.add_node_connections(graph, sparse = True)
+        
+        loc_Graph_connections = {'graph': graph,
+                                 'centerlines': centerlines,
+                                 'lane_node_offsets': np.concatenate(([0], np.cumsum(num_lane_nodes))).astype(int),
+                                 'node_lanes': np.repeat(np.arange(num_lanes), num_lane_nodes)}
+        
+        loc_Graph_index['connections'][wave_length] = loc_Graph_connections
+        return loc_Graph_connections
+    
+    
+    def cut_sceneGraph(self, loc_Graph, X, radius, wave_length = 1.0, loc_Graph_index = None):
         # loc_Graph: SceneGraph of the location, as a pandas dataframe
         # X: Position of the agents in the location, with shape num_agents x 2
         # radius: Radius of the scene graph, in meters
+        # loc_Graph_index: Spatial index of the location (see self.get_sceneGraph_index)
 
         # Only keep non nan agents
         X_a = X[np.isfinite(X).all(-1)]
         assert len(X_a) > 0, "There are no agents in the scene."
+        
+        # Get the spatial index of the scene graph
+        if loc_Graph_index is None:
+            loc_Graph_index = self.get_sceneGraph_index(loc_Graph)
+        
+        # Get the lanes that might be close enough to the agents
+        candidate_lanes = self.get_sceneGraph_candidate_lanes(loc_Graph_index, X_a, radius)
+        
         X_a = X_a[np.newaxis, :] # shape = (1, num_agents, 2)
         
-
-        # Get contents of loc_Graph
-        num_nodes = loc_Graph.num_nodes + 0 # Number of nodes in the scene graph
-        lane_idcs = loc_Graph.lane_idcs.copy() # Lane indices of the nodes
-        pre_pairs = loc_Graph.pre_pairs.copy() # Predecessor pairs of the nodes, array of shape (num_pre_pairs, 2)
-        suc_pairs = loc_Graph.suc_pairs.copy() # Successor pairs of the nodes, array of shape (num_suc_pairs, 2)
-        left_pairs = loc_Graph.left_pairs.copy() # Left pairs of the nodes, array of shape (num_left_pairs, 2)
-        right_pairs = loc_Graph.right_pairs.copy() # Right pairs of the nodes, array of shape (num_right_pairs, 2)
-        left_boundaries = np.array(list(loc_Graph.left_boundaries) + [0], object)[:-1] # Left boundaries of the nodes, array of shape (num_segments), with each element being an array of shape (num_points, 2)
-        right_boundaries = np.array(list(loc_Graph.right_boundaries) + [0], object)[:-1] # Right boundaries of the nodes, array of shape (num_segments), with each element being an array of shape (num_points, 2)
-        centerlines = np.array(list(loc_Graph.centerlines) + [0], object)[:-1] # Centerlines of the nodes, array of shape (num_segments), with each element being an array of shape (num_points, 2)
-
-        # Go through segments
-        Keep_segments = np.zeros(len(left_boundaries), bool)
-        Keep_nodes = np.zeros(num_nodes, bool)
+        # Get the node connections of the whole location (the cut graph is an induced subgraph of it)
+        loc_Graph_connections = self.get_sceneGraph_connections(loc_Graph, loc_Graph_index, wave_length)
+        loc_Graph_full = loc_Graph_connections['graph']
+        full_centerlines = loc_Graph_connections['centerlines']
+        full_lane_node_offsets = loc_Graph_connections['lane_node_offsets']
         
-        # Get original lane id range, using
-        new_lane = np.where(lane_idcs[1:] != lane_idcs[:-1])[0] + 1
-        lane_ids = np.concatenate((lane_idcs[[0]], lane_idcs[new_lane]), 0)
-        assert len(lane_ids) == len(centerlines), "Lane ids are not correct."
+        # Get contents of loc_Graph (arrays are only read, so no copies are needed)
+        pre_pairs = loc_Graph.pre_pairs # Predecessor pairs of the nodes, array of shape (num_pre_pairs, 2)
+        suc_pairs = loc_Graph.suc_pairs # Successor pairs of the nodes, array of shape (num_suc_pairs, 2)
+        left_pairs = loc_Graph.left_pairs # Left pairs of the nodes, array of shape (num_left_pairs, 2)
+        right_pairs = loc_Graph.right_pairs # Right pairs of the nodes, array of shape (num_right_pairs, 2)
         
-        # Check that pair ids are within lane_ids
-        assert np.all(np.isin(pre_pairs.flatten(), lane_ids)), "Predecessor pair ids are not within lane_ids."
-        assert np.all(np.isin(suc_pairs.flatten(), lane_ids)), "Successor pair ids are not within lane_ids."
-        assert np.all(np.isin(left_pairs.flatten(), lane_ids)), "Left pair ids are not within lane_ids."
-        assert np.all(np.isin(right_pairs.flatten(), lane_ids)), "Right pair ids are not within lane_ids."
+        # Get original lane id range
+        lane_ids = loc_Graph_index['lane_ids']
+        
+        # Prepare the cut lane segments, only filled for kept segments
+        left_boundaries = np.empty(len(lane_ids), object) # Left boundaries of the nodes, array of shape (num_segments), with each element being an array of shape (num_points, 2)
+        right_boundaries = np.empty(len(lane_ids), object) # Right boundaries of the nodes, array of shape (num_segments), with each element being an array of shape (num_points, 2)
+        centerlines = np.empty(len(lane_ids), object) # Centerlines of the nodes, array of shape (num_segments), with each element being an array of shape (num_points, 2)
+
+        # Go through segments
+        Keep_segments = np.zeros(len(lane_ids), bool)
+        Keep_nodes = np.zeros(loc_Graph_full.num_nodes, bool)
 
-        for i_lane, lane_id in enumerate(lane_ids):
-            left_pts = left_boundaries[i_lane] # shape = (num_points, 2)
-            right_pts = right_boundaries[i_lane] # shape = (num_points, 2)
-            centerline_pts = centerlines[i_lane] # shape = (num_points, 2)
+        for i_lane in candidate_lanes:
+            lane_id = lane_ids[i_lane]
+            left_pts = loc_Graph.left_boundaries[i_lane] # shape = (num_points, 2)
+            right_pts = loc_Graph.right_boundaries[i_lane] # shape = (num_points, 2)
+            centerline_pts = full_centerlines[i_lane] # shape = (num_points, 2), allready thinned out
 
             # Get distance to agents (nanmin over the agents)
             dist_left   = np.nanmin(np.linalg.norm(left_pts[:,np.newaxis] - X_a, axis = -1), axis = 1)
@@ -3820,68 +4779,55 @@ class data_set_template():
             # Check if the agent is to be kept at all
             if keep_center.sum() < 2:
                 continue
-            else:
-                # If the last center node is not kept, remove all successor connections
-                if not keep_center[-1]:
-                    # Get all successors
-                    suc_idcs = suc_pairs[:,0] == lane_id
-                    suc_pairs = suc_pairs[~suc_idcs]
-
-                # If the first center node is not kept, remove all predecessor connections
-                if not keep_center[0]:
-                    # Get all predecessors
-                    pre_idcs = pre_pairs[:,0] == lane_id
-                    pre_pairs = pre_pairs[~pre_idcs]
-                
-                # Remove the nodes that are not kept
-                left_pts = left_pts[keep_left]
-                right_pts = right_pts[keep_right]
-                centerline_pts = centerline_pts[keep_center]
-
-                # Filter out intemediat steps so general distance are kept within roughly 1 meters
-                dist_cons_left = np.linalg.norm(left_pts[1:] - left_pts[:-1], axis = 1)
-                dist_cons_right = np.linalg.norm(right_pts[1:] - right_pts[:-1], axis = 1)
-                dist_cons_center = np.linalg.norm(centerline_pts[1:] - centerline_pts[:-1], axis = 1)
-
-                # Cumulative distance
-                cum_dist_left = np.concatenate([[0], np.cumsum(dist_cons_left / wave_length)]).astype(int)
-                cum_dist_right = np.concatenate([[0], np.cumsum(dist_cons_right / wave_length)]).astype(int)  
-                cum_dist_center = np.concatenate([[0], np.cumsum(dist_cons_center / wave_length)]).astype(int)
-
-                # get points that are unnecessary
-                remove_left = np.zeros(len(left_pts), bool)
-                remove_left[1:] = cum_dist_left[1:] == cum_dist_left[:-1]
-
-                remove_right = np.zeros(len(right_pts), bool)
-                remove_right[1:] = cum_dist_right[1:] == cum_dist_right[:-1]
+            
+            # The kept nodes of a lane have to be consecutive, so all points between the first and last close one are kept
+            keep_center_idcs = np.where(keep_center)[0]
+            first_point = keep_center_idcs[0]
+            last_point = keep_center_idcs[-1]
+            
+            # If the last center node is not kept, remove all successor connections
+            if last_point < len(centerline_pts) - 1:
+                # Get all successors
+                suc_idcs = suc_pairs[:,0] == lane_id
+                suc_pairs = suc_pairs[~suc_idcs]
 
-                remove_center = np.zeros(len(centerline_pts), bool)
-                remove_center[1:-1] = cum_dist_center[1:-1] == cum_dist_center[:-2]
+            # If the first center node is not kept, remove all predecessor connections
+            if first_point > 0:
+                # Get all predecessors
+                pre_idcs = pre_pairs[:,0] == lane_id
+                pre_pairs = pre_pairs[~pre_idcs]
+            
+            # Remove the nodes that are not kept
+            left_pts = left_pts[keep_left]
+            right_pts = right_pts[keep_right]
 
-                # Update the points
-                left_pts = left_pts[~remove_left]
-                right_pts = right_pts[~remove_right]
-                centerline_pts = centerline_pts[~remove_center]
+            # Filter out intemediat steps so general distance are kept within roughly 1 meters
+            dist_cons_left = np.linalg.norm(left_pts[1:] - left_pts[:-1], axis = 1)
+            dist_cons_right = np.linalg.norm(right_pts[1:] - right_pts[:-1], axis = 1)
 
-                # Set lanes
-                Keep_segments[i_lane] = True
-                left_boundaries[i_lane] = left_pts
-                right_boundaries[i_lane] = right_pts
-                centerlines[i_lane] = centerline_pts
+            # Cumulative distance
+            cum_dist_left = np.concatenate([[0], np.cumsum(dist_cons_left / wave_length)]).astype(int)
+            cum_dist_right = np.concatenate([[0], np.cumsum(dist_cons_right / wave_length)]).astype(int)  
 
-                # Update keep center
-                keep_center[keep_center] = ~remove_center
+            # get points that are unnecessary
+            remove_left = np.zeros(len(left_pts), bool)
+            remove_left[1:] = cum_dist_left[1:] == cum_dist_left[:-1]
 
-                assert keep_center.sum() >= 2, "Not enough center points kept."
+            remove_right = np.zeros(len(right_pts), bool)
+            remove_right[1:] = cum_dist_right[1:] == cum_dist_right[:-1]
 
-            # Number nodes to keep
-            keep_num_nodes = keep_center.sum() - 1
+            # Update the points
+            left_pts = left_pts[~remove_left]
+            right_pts = right_pts[~remove_right]
 
-            # Get the current nodes for this lane
-            lane_nodes_id = np.where(lane_idcs == lane_id)[0]
+            # Set lanes
+            Keep_segments[i_lane] = True
+            left_boundaries[i_lane] = left_pts
+            right_boundaries[i_lane] = right_pts
+            centerlines[i_lane] = centerline_pts[first_point:last_point + 1]
 
-            # Get the nodes to keep 
-            Keep_nodes[lane_nodes_id[:keep_num_nodes]] = True
+            # Get the nodes to keep (node i lies between the centerline points i and i + 1)
+            Keep_nodes[full_lane_node_offsets[i_lane] + first_point:full_lane_node_offsets[i_lane] + last_point] = True
         
         # Keep lane segements
         left_boundaries = left_boundaries[Keep_segments]
@@ -3918,7 +4864,7 @@ class data_set_template():
             print(X_a[0])       
             print('')  
           
-        lane_idcs = lane_idcs[Keep_nodes]
+        lane_idcs = loc_Graph_index['lane_ids'][loc_Graph_connections['node_lanes'][Keep_nodes]]
         num_nodes = len(lane_idcs)
         
         if num_nodes > 0:
@@ -3945,9 +4891,31 @@ class data_set_template():
                                    index = ['num_nodes', 'lane_idcs', 'pre_pairs', 'suc_pairs', 'left_pairs', 'right_pairs',
                                              'left_boundaries', 'right_boundaries', 'centerlines', 'lane_type'])
         
-        # Get the missing segments
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        loc_Graph_cut = self.add_node_connections(loc_Graph_cut, device = device)
+        if num_nodes == 0:
+            # Get the (empty) node connections
+            loc_Graph_cut = self.add_node_connections(loc_Graph_cut)
+            return loc_Graph_cut
+        
+        # Get the node connections by slicing those of the whole location, with removed nodes mapped to -1
+        node_map = np.full(loc_Graph_full.num_nodes, -1, dtype = np.int64)
+        node_map[Keep_nodes] = np.arange(num_nodes)
+        
+        loc_Graph_cut['ctrs'] = loc_Graph_full.ctrs[Keep_nodes]
+        loc_Graph_cut['feats'] = loc_Graph_full.feats[Keep_nodes]
+        
+        for key in ['pre', 'suc', 'left', 'right']:
+            Nbrs = []
+            for nbr_full in loc_Graph_full[key]:
+                u = node_map[nbr_full['u']]
+                v = node_map[nbr_full['v']]
+                
+                # Only keep edges between kept nodes
+                useful = (u >= 0) & (v >= 0)
+                nbr = dict()
+                nbr['u'] = u[useful]
+                nbr['v'] = v[useful]
+                Nbrs.append(nbr)
+            loc_Graph_cut[key] = Nbrs
 
         return loc_Graph_cut
 
@@ -3976,6 +4944,7 @@ class data_set_template():
                     loc_indices = np.where(Locations_unique_path == location)[0]
                     
                     loc_Graph = self.SceneGraphs.loc[location]
+                    loc_Graph_index = self.SceneGraph_indices.loc[location]
 
                     if self.graph_count_always_one:
                         num = 1
@@ -3993,7 +4962,7 @@ class data_set_template():
                                 print('retrieving graphs ' + str(graph_num + 1) + 
                                     ' of ' + str(len(domain)) + ' total', flush = True)
                                 
-                            loc_Graph_cut = self.cut_sceneGraph(loc_Graph, X[index], radius, wave_length)
+                            loc_Graph_cut = self.cut_sceneGraph(loc_Graph, X[index], radius, wave_length, loc_Graph_index)
                             SceneGraphs[Graphs_Index[index]] = loc_Graph_cut
 
                             graph_num += 1
@@ -4124,26 +5093,110 @@ class data_set_template():
                 "This type of output required by the metric is not implemented")
         return output_trans
 
+    def get_class_change_times(self, Dist, T, num_timesteps):
+        r'''
+        This function finds for a batch of samples and predictions the first time at which the 
+        distance to each classification marker becomes non-positive, i.e., the time at which
+        a certain behavior is observed.
+
+        Parameters
+        ----------
+        Dist : np.ndarray
+            The distances to the classification markers, in the form of a 
+            :math:`\{N_{samples} \times N_{preds} \times N_{classes} \times N_{T}\}` dimensional numpy array.
+            Values at timesteps beyond **num_timesteps** are ignored.
+        T : np.ndarray
+            The timesteps of each sample, in the form of a :math:`\{N_{samples} \times N_{T}\}` 
+            dimensional numpy array.
+        num_timesteps : np.ndarray
+            The number of actual timesteps of each sample, in the form of a :math:`N_{samples}` 
+            dimensional numpy array.
+
+        Returns
+        -------
+        T_class : np.ndarray
+            The times at which each behavior is observed, in the form of a 
+            :math:`\{N_{samples} \times N_{preds} \times N_{classes}\}` dimensional numpy array. 
+            If a behavior is never observed, the time after the last timestep is used instead.
+        '''
+        num_samples, _, _, N_T = Dist.shape
+        num_timesteps = np.asarray(num_timesteps, int)
+        
+        # Ignore the padded timesteps
+        Valid = np.arange(N_T)[np.newaxis] < num_timesteps[:, np.newaxis] # Shape (N_samples, N_T)
+        Dist = np.where(Valid[:, np.newaxis, np.newaxis], Dist, np.nan)
+        t_end = T[np.arange(num_samples), num_timesteps - 1] # Shape (N_samples)
+
+        # Without a change, the behavior either already happened or never happens
+        T_no_change = np.where(Dist[..., 0] <= 0, 0.5 * self.dt, (t_end + self.dt)[:, np.newaxis, np.newaxis])
+        
+        # With a single timestep, no change can be observed
+        if N_T < 2:
+            T_class = T_no_change
+        else:
+            # Find the first change from positive to non-positive distances
+            Class_change = (Dist[..., 1:] <= 0) & (Dist[..., :-1] > 0) # Shape (N_samples, N_preds, N_classes, N_T - 1)
+            Changed = Class_change.any(-1)
+            ind = Class_change.argmax(-1)[..., np.newaxis] # Shape (N_samples, N_preds, N_classes, 1)
+
+            # Linearly interpolate the time of the change
+            D_0 = np.take_along_axis(Dist, ind, -1)[..., 0]
+            D_1 = np.take_along_axis(Dist, ind + 1, -1)[..., 0]
+            
+            i_sample = np.arange(num_samples)[:, np.newaxis, np.newaxis]
+            t_0 = T[i_sample, ind[..., 0]]
+            t_1 = T[i_sample, ind[..., 0] + 1]
+
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                T_change = (t_1 * D_0 - t_0 * D_1) / (D_0 - D_1)
+            
+            T_class = np.where(Changed, T_change, T_no_change) # Shape (N_samples, N_preds, N_classes)
+
+        # If no behavior is observed, the default behavior is assumed to happen at the end
+        Default = T_class.min(axis = -1) > t_end[:, np.newaxis] # Shape (N_samples, N_preds)
+        Default_beh = np.asarray(self.Behaviors) == self.behavior_default
+        T_class[..., Default_beh] = np.where(Default[..., np.newaxis], t_end[:, np.newaxis, np.newaxis], T_class[..., Default_beh])
+        return T_class
+    
+    
+    def _get_stacked_distances(self, Paths, T_list, Domains):
+        # Calculate the distances to the classification markers for each sample, 
+        # and stack them into arrays padded with np.nan
+        num_timesteps = np.array([len(t) for t in T_list], int)
+        N_T = num_timesteps.max()
+
+        Dist = np.full((len(T_list), self.num_samples_path_pred, len(self.Behaviors), N_T), np.nan, float)
+        T = np.full((len(T_list), N_T), np.nan, float)
+        for i, (paths, t, domain) in enumerate(zip(Paths, T_list, Domains)):
+            dist = self.calculate_distance(paths, t, domain)
+            Dist[i, :, :, :len(t)] = np.stack([dist[beh] for beh in self.Behaviors], axis = -2)
+            T[i, :len(t)] = t
+        return Dist, T, num_timesteps
+    
+    
+    def _get_class_batch_size(self, T_list):
+        # Limit the memory needed for the stacked distances (with some margin for intermediate arrays)
+        N_T = max([len(t) for t in T_list])
+        needed_memory = 16 * 8 * self.num_samples_path_pred * len(self.Behaviors) * N_T
+        available_memory = max(self.total_memory - get_used_memory(), 100 * 2**20)
+        return max(1, int(0.25 * available_memory / needed_memory))
+    
+    
+    def _get_time_quantiles(self, T_beh):
+        # Get the quantiles over predictions, ignoring np.nan values (where the quantiles are np.nan if all values are missing)
+        T_beh = np.moveaxis(T_beh, 1, -1) # Shape (N_samples, N_classes, N_preds)
+        Use = np.isfinite(T_beh).any(-1)
+        Quantiles = np.full((*T_beh.shape[:2], len(self.p_quantile)), np.nan, float)
+        if Use.any():
+            Quantiles[Use] = np.nanquantile(T_beh[Use], self.p_quantile, axis = -1).T
+        return Quantiles # Shape (N_samples, N_classes, N_quantiles)
+    
+    
     def path_to_class_and_time_sample(self, paths, t, domain):
         if self.classification_useful:
             # Compared to before, the paths here are of a self.num_path_pred \times len(t) shape
-            Dist = self.calculate_distance(paths, t, domain)
-    
-            T = np.zeros((self.num_samples_path_pred, len(self.Behaviors)), float)
-            for i_beh, beh in enumerate(self.Behaviors):
-                for j in range(self.num_samples_path_pred):
-                    class_change = np.where((Dist[beh][j, 1:] <= 0) & (Dist[beh][j, :-1] > 0))[0]
-                    if len(class_change) == 0:
-                        if Dist[beh][j, 0] <= 0:
-                            T[j, i_beh] = 0.5 * self.dt
-                        else:
-                            T[j, i_beh] = t[-1] + self.dt
-                    else:
-                        ind = class_change[0]
-                        T[j, i_beh] = ((t[ind + 1] * Dist[beh][j, ind] - t[ind] * Dist[beh][j, ind + 1]) /
-                                       (Dist[beh][j, ind] - Dist[beh][j, ind + 1]))
-            default = T.min(axis=-1) > t[-1]
-            T[default, self.Behaviors == self.behavior_default] = t[-1]
+            Dist, T, num_timesteps = self._get_stacked_distances([paths], [t], [domain])
+            T = self.get_class_change_times(Dist, T, num_timesteps)[0]
         else:
             T = np.ones((self.num_samples_path_pred, len(self.Behaviors)), float) * t[-1]
         return T
@@ -4216,44 +5269,60 @@ class data_set_template():
 
     
     def _path_to_class_and_time(self, Output_path_pred, Pred_index, Output_T_pred, Domain):
-        Output_A_pred = pd.DataFrame(np.zeros((len(Output_path_pred), len(self.Behaviors)), float),
-                                             columns = self.Behaviors)
-        Output_T_E_pred = pd.DataFrame(np.empty((len(Output_path_pred), len(self.Behaviors)), object),
-                                        columns = self.Behaviors)
+        Output_A_pred = np.zeros((len(Output_path_pred), len(self.Behaviors)), float)
+        Output_T_E_pred = np.full((len(Output_path_pred), len(self.Behaviors), len(self.p_quantile)), np.nan, float)
 
-        for i_sample, i_full in enumerate(Pred_index):
-            paths = Output_path_pred.iloc[i_sample]
-            
-            # Check if we need to increase the paths dim
-            need_dim_increase = False
-            for agent in paths.index:
-                if not isinstance(paths[agent], float):
-                    need_dim_increase = len(paths[agent].shape) == 2
-                    break
-            
-            # Increase dimensions if needed
-            if need_dim_increase:
-                if i_sample == 0:
-                    print('Adding num_predictions dimension to paths.', flush = True)
-                paths = self.increase_path_dim(paths)
-            
-            t = Output_T_pred[i_full]
-            domain = Domain.iloc[i_full]
-            T_class = self.path_to_class_and_time_sample(paths, t, domain)
-
-            output_A = np.arange(len(self.Behaviors))[np.newaxis] == T_class.argmin(axis=-1)[:,np.newaxis]
-
-            Output_A_pred.iloc[i_sample] = pd.Series(output_A.mean(axis=0), index=self.Behaviors)
+        # Get the timesteps of each sample
+        T_list = [Output_T_pred[i_full] for i_full in Pred_index]
+        batch_size = self._get_class_batch_size(T_list)
+        
+        for i_start in range(0, len(Pred_index), batch_size):
+            i_samples = np.arange(i_start, min(i_start + batch_size, len(Pred_index)))
 
-            for i_beh, beh in enumerate(self.Behaviors):
-                T_beh = T_class[output_A[:, i_beh], i_beh]
-                if len(T_beh) > 1:
-                    Output_T_E_pred.iloc[i_sample, i_beh] = np.quantile(T_beh, self.p_quantile)
-                if len(T_beh) == 1:
-                    Output_T_E_pred.iloc[i_sample, i_beh] = np.full(len(self.p_quantile), T_beh[0])
-                else:
-                    Output_T_E_pred.iloc[i_sample, i_beh] = np.full(len(self.p_quantile), np.nan)
+            Paths = []
+            for i_sample in i_samples:
+                paths = Output_path_pred.iloc[i_sample]
+                
+                # Check if we need to increase the paths dim
+                need_dim_increase = False
+                for agent in paths.index:
+                    if not isinstance(paths[agent], float):
+                        need_dim_increase = len(paths[agent].shape) == 2
+                        break
+                
+                # Increase dimensions if needed
+                if need_dim_increase:
+                    if i_sample == 0:
+                        print('Adding num_predictions dimension to paths.', flush = True)
+                    paths = self.increase_path_dim(paths)
+                Paths.append(paths)
+            
+            # Get the time at which each behavior is observed
+            Domains = [Domain.iloc[i_full] for i_full in Pred_index[i_samples]]
+            Dist, T, num_timesteps = self._get_stacked_distances(Paths, [T_list[i] for i in i_samples], Domains)
+            T_class = self.get_class_change_times(Dist, T, num_timesteps) # Shape (N_samples, N_preds, N_classes)
+
+            # The first observed behavior is the predicted class
+            output_A = np.arange(len(self.Behaviors)) == T_class.argmin(axis = -1)[..., np.newaxis] # Shape (N_samples, N_preds, N_classes)
+            Output_A_pred[i_samples] = output_A.mean(axis = 1)
+
+            # Get the time quantiles of the predictions with the respective behavior
+            T_beh = np.where(output_A, T_class, np.nan)
+            Output_T_E_pred[i_samples] = self._get_time_quantiles(T_beh)
+        
+        # Transform to dataframes
+        Output_A_pred = pd.DataFrame(Output_A_pred, columns = self.Behaviors)
+        Output_T_E_pred = self._get_time_quantile_dataframe(Output_T_E_pred)
         return Output_A_pred, Output_T_E_pred            
+    
+    
+    def _get_time_quantile_dataframe(self, Output_T_E):
+        # Save the quantiles of each sample and behavior as an array in an object dataframe
+        Output_T_E_pred = np.empty(Output_T_E.shape[:2], object)
+        for i_sample in range(Output_T_E.shape[0]):
+            for i_beh in range(Output_T_E.shape[1]):
+                Output_T_E_pred[i_sample, i_beh] = Output_T_E[i_sample, i_beh]
+        return pd.DataFrame(Output_T_E_pred, columns = self.Behaviors)
         
         
     
@@ -4273,9 +5342,6 @@ class data_set_template():
         # Remove other prediction type
         if self.classification_useful:
             self.train_path_models()
-
-            Output_T_E_pred = pd.DataFrame(np.empty((len(Output_A_pred), len(self.Behaviors)), object),
-                                            columns = self.Behaviors)
             
             # Predict paths for all samples
             Paths_beh = {}
@@ -4295,19 +5361,29 @@ class data_set_template():
                     
                     Paths_beh[beh].loc[Pred_index_used] = self.path_models[beh].predict_actual(Pred_index_used)[1]
 
-            for i_sample, i_full in enumerate(Pred_index):
-                t = self.Output_T_pred[i_full]
-                domain = Domain.iloc[i_full]
+            T_list = [self.Output_T_pred[i_full] for i_full in Pred_index]
+            batch_size = self._get_class_batch_size(T_list)
+
+            Output_T_E = np.full((len(Pred_index), len(self.Behaviors), len(self.p_quantile)), np.nan, float)
+            for i_start in range(0, len(Pred_index), batch_size):
+                i_samples = np.arange(i_start, min(i_start + batch_size, len(Pred_index)))
+                T_samples = [T_list[i] for i in i_samples]
+                Domain_samples = [Domain.iloc[i_full] for i_full in Pred_index[i_samples]]
+
                 for i_beh, beh in enumerate(self.Behaviors):
-                    paths_beh = Paths_beh[beh].loc[i_full]
-                    T_class_beh = self.path_to_class_and_time_sample(paths_beh, t, domain)
-                    T_beh = T_class_beh[((T_class_beh[:, i_beh] == T_class_beh.min(axis=-1)) &
-                                            (T_class_beh[:, i_beh] <= t[-1])), i_beh]
+                    Paths = [Paths_beh[beh].loc[i_full] for i_full in Pred_index[i_samples]]
+                    Dist, T, num_timesteps = self._get_stacked_distances(Paths, T_samples, Domain_samples)
+                    T_class_beh = self.get_class_change_times(Dist, T, num_timesteps) # Shape (N_samples, N_preds, N_classes)
 
-                    if len(T_beh) > 0:
-                        Output_T_E_pred.iloc[i_sample, i_beh] = np.quantile(T_beh, self.p_quantile)
-                    else:
-                        Output_T_E_pred.iloc[i_sample, i_beh] = np.full(len(self.p_quantile), np.nan)
+                    # Only use predictions where the behavior is observed first and within the prediction horizon
+                    t_end = T[np.arange(len(T)), num_timesteps - 1]
+                    T_beh = T_class_beh[..., i_beh]
+                    Use = (T_beh == T_class_beh.min(axis = -1)) & (T_beh <= t_end[:, np.newaxis]) # Shape (N_samples, N_preds)
+                    T_beh = np.where(Use, T_beh, np.nan)
+
+                    Output_T_E[i_samples, i_beh] = self._get_time_quantiles(T_beh[:, :, np.newaxis])[:, 0]
+            
+            Output_T_E_pred = self._get_time_quantile_dataframe(Output_T_E)
         else:
             Output_T_E_pred = pd.DataFrame(np.empty(Output_A_pred.shape, object), columns = self.Behaviors)
         return Output_T_E_pred
@@ -4774,6 +5850,91 @@ class data_set_template():
         '''
         raise AttributeError('Has to be overridden in actual data-set class.')
 
+    def _get_batch_sample_path(self, Path, T, i_sample, agents):
+        # Transform one sample of a batch into the format used by the per-sample functions
+        num_timesteps = np.isfinite(T[i_sample]).sum()
+        return self.dense_path_to_series(Path[i_sample, :, :num_timesteps], np.asarray(agents)), T[i_sample, :num_timesteps]
+    
+    
+    def calculate_distance_batch(self, Path, T, Domain, agents):
+        r'''
+        This is the batched version of *self.calculate_distance()*. By default, it calls this 
+        function for each sample, but it can be overridden with a vectorized implementation.
+
+        Parameters
+        ----------
+        Path : np.ndarray
+            The dense trajectories of the samples, in the form of a 
+            :math:`\{N_{samples} \times N_{agents} \times |t| \times N_{data}\}` dimensional numpy array.
+            Agents that are not observed in a sample are filled with np.nan values.
+        T : np.ndarray
+            The corresponding timesteps of each sample, in the form of a :math:`\{N_{samples} \times |t|\}`
+            dimensional numpy array.
+        Domain : pandas.DataFrame
+            The metadata of the samples, with :math:`N_{samples}` rows, each containing at least all the 
+            columns of **self.Domain_old**.
+        agents : np.ndarray
+            The names of the :math:`N_{agents}` agents in **Path**.
+
+        Returns
+        -------
+        Dist : np.ndarray
+            This is a :math:`\{N_{samples} \times N_{classes} \times |t|\}` dimensional numpy array with the distances 
+            to the classification markers, where the classes are ordered as in **self.Behaviors**.
+        '''
+        Dist = np.full((len(T), len(self.Behaviors), T.shape[1]), np.nan, float)
+        for i_sample in range(len(T)):
+            path, t = self._get_batch_sample_path(Path, T, i_sample, agents)
+            dist = self.calculate_distance(self.increase_path_dim(path), t, Domain.iloc[i_sample])
+            dist = self.decrease_dist_dim(dist)
+            Dist[i_sample, :, :len(t)] = np.stack([dist[beh] for beh in self.Behaviors], 0)
+        return Dist
+    
+    
+    def evaluate_scenario_batch(self, Path, D_class, T, Domain, agents):
+        r'''
+        This is the batched version of *self.evaluate_scenario()*. By default, it calls this 
+        function for each sample, but it can be overridden with a vectorized implementation.
+
+        Parameters
+        ----------
+        Path : np.ndarray
+            The dense trajectories of the samples, in the form of a 
+            :math:`\{N_{samples} \times N_{agents} \times |t| \times N_{data}\}` dimensional numpy array.
+            Agents that are not observed in a sample are filled with np.nan values.
+        D_class : np.ndarray
+            The distances to the classification markers, in the form of a :math:`\{N_{samples} \times N_{classes} \times |t|\}` 
+            dimensional numpy array, as returned by *self.calculate_distance_batch()*. Can be None.
+        T : np.ndarray
+            The corresponding timesteps of each sample, in the form of a :math:`\{N_{samples} \times |t|\}`
+            dimensional numpy array.
+        Domain : pandas.DataFrame
+            The metadata of the samples, with :math:`N_{samples}` rows, each containing at least all the 
+            columns of **self.Domain_old**.
+        agents : np.ndarray
+            The names of the :math:`N_{agents}` agents in **Path**.
+
+        Returns
+        -------
+        in_position : numpy.ndarray
+            This is a :math:`\{N_{samples} \times |t|\}` dimensional boolean array, which is true if all agents are
+            in a position where the scenario is valid.
+        '''
+        in_position = np.zeros(T.shape, bool)
+        for i_sample in range(len(T)):
+            path, t = self._get_batch_sample_path(Path, T, i_sample, agents)
+            if D_class is None:
+                d_class = None
+            else:
+                d_class = pd.Series(list(D_class[i_sample, :, :len(t)]), index = self.Behaviors)
+            
+            in_pos = self.evaluate_scenario(path, d_class, Domain.iloc[i_sample])
+            if in_pos is None:
+                in_pos = np.ones(len(t), bool)
+            in_position[i_sample, :len(t)] = in_pos
+        return in_position
+    
+    
     def calculate_additional_distances(self, path, t, domain):
         r'''
         Some models cannot deal with trajectory data and instead are constrained to quasi-one-dimensional
@@ -29,14 +29,11 @@ class ADE_indep(evaluation_template):
         self.set_default_kwargs()
      
     def evaluate_prediction_method(self):
-        Path_true, Path_pred, Pred_steps = self.get_true_and_predicted_paths(self.metric_kwargs['num_preds'])
+        Diff, Pred_steps = self.get_squared_displacement_errors(self.metric_kwargs['num_preds'])
         Pred_agents = Pred_steps.any(-1)
         Num_steps = Pred_steps.sum(-1).max(-1)
         Num_agents = Pred_agents.sum(-1)
         
-        # Get squared distance
-        Diff = ((Path_true - Path_pred) ** 2).sum(-1)
-        
         # Get absolute distance
         Diff = np.sqrt(Diff)
         
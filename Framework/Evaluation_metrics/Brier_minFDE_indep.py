@@ -43,7 +43,7 @@ class Brier_minFDE_indep(evaluation_template):
      
     def evaluate_prediction_method(self):
         # Get ground truth and predicted paths
-        Path_true, Path_pred, Pred_steps = self.get_true_and_predicted_paths(self.metric_kwargs['num_preds'])
+        Diff, Pred_steps = self.get_squared_displacement_errors(self.metric_kwargs['num_preds'])
 
         # Get the log likelihoods of the pred samples according to the pred samples
         _, KDE_log_prob_pred = self.get_KDE_probabilities(joint_agents = False)
@@ -58,9 +58,6 @@ class Brier_minFDE_indep(evaluation_template):
         Pred_agents = Pred_steps.any(-1)
         Num_steps = Pred_steps.sum(-1).max(-1)
         Num_agents = Pred_agents.sum(-1)
-
-        # Get squared distance
-        Diff = ((Path_true - Path_pred) ** 2).sum(-1)
         
         # Get absolute distance
         Diff = np.sqrt(Diff)
@@ -10,7 +10,8 @@ class Collision_rate_indep(evaluation_template):
     '''
     
     def setup_method(self):
-        pass
+        if 'memory_budget' not in self.metric_kwargs:
+            self.metric_kwargs['memory_budget'] = None
      
     def evaluate_prediction_method(self):
         Path_true, Path_pred, Pred_steps, _, Size_pred = self.get_true_and_predicted_paths(return_types = True)
@@ -40,63 +41,40 @@ class Collision_rate_indep(evaluation_template):
 
         Path_pred_agent = Path_pred[pred_sample, :, pred_agent] # Shape: (N, P, n_O, 2)
         Size_pred_agent = Size_pred[pred_sample, pred_agent] # Shape: (N, 2)
-        
-        # Get the ground truth of all other agents
-        Idx_sample = np.repeat(np.arange(N)[:, np.newaxis], num_pred_agents - 1, axis = 1)
-        Idx_agents = np.repeat(np.arange(1, num_pred_agents)[np.newaxis], N, axis = 0)
-        Idx_agents = np.mod(Idx_agents + pred_agent[:, np.newaxis], num_pred_agents)
-
-        # Apply the indexing to the ground truth of other agents
-        Path_pred_other = Path_true.squeeze(1)[pred_sample] # Shape: (N, num_pred_agents, n_O, 2)
-        Path_pred_other = Path_pred_other[Idx_sample, Idx_agents] # Shape: (N, num_pred_agents - 1, n_O, 2)
-        Size_pred_other = Size_pred[pred_sample][Idx_sample, Idx_agents] # Shape: (N, num_pred_agents - 1, 2)
-        Pred_agent_other = Pred_agent[pred_sample][Idx_sample, Idx_agents] # Shape: (N, num_pred_agents - 1)
 
-        Path_other = Path_other.squeeze(1)[pred_sample] # Shape: (N, num_other_agents, n_O, 2)
-        Size_other = Size_other[pred_agent] # Shape: (N, num_other_agents, 2)
-        Pred_other = np.ones((N, num_other_agents), dtype = bool) # Shape: (N, num_other_agents)
+        # Get the ground truth of all predicted agents
+        Path_B_pred = Path_true.reshape(num_samples * num_pred_agents, 1, n_O, 2) # Shape: (num_samples * num_pred_agents, 1, n_O, 2)
+        Size_B_pred = Size_pred.reshape(num_samples * num_pred_agents, 2) # Shape: (num_samples * num_pred_agents, 2)
 
-        num_agents = num_other_agents + num_pred_agents - 1
-        # Concatenate the ground truth of other agents
-        Path_other = np.concatenate([Path_pred_other, Path_other], axis = 1) # Shape: (N, num_agents, n_O, 2)
-        Size_other = np.concatenate([Size_pred_other, Size_other], axis = 1) # Shape: (N, num_agents, 2)
-        Pred_other = np.concatenate([Pred_agent_other, Pred_other], axis = 1) # Shape: (N, num_agents)
+        # Pair each predicted agent with all other predicted agents in the same sample
+        Pair_pred = Pred_agent[pred_sample] & (np.arange(num_pred_agents)[np.newaxis] != pred_agent[:, np.newaxis]) # Shape: (N, num_pred_agents)
+        Pair_A_pred, pair_agent = np.where(Pair_pred)
+        Pair_B_pred = pred_sample[Pair_A_pred] * num_pred_agents + pair_agent
 
-        # Fit range so that types are N, P, num agents, and paths are N, P, num agents, n_O, 2
-        Path_pred_agent = np.repeat(Path_pred_agent[:,:,np.newaxis], num_agents, axis = 2) # Shape: (N, P, num_agents, n_O, 2)
-        Size_pred_agent = np.repeat(np.repeat(Size_pred_agent[:,np.newaxis,np.newaxis], P, axis = 1), num_agents, axis = 2) # Shape: (N, P, num_agents, 2)
+        # Get the ground truth of all other agents
+        Path_B_other = Path_other.reshape(num_samples * num_other_agents, 1, n_O, 2) # Shape: (num_samples * num_other_agents, 1, n_O, 2)
+        Size_B_other = Size_other.reshape(num_samples * num_other_agents, 2) # Shape: (num_samples * num_other_agents, 2)
 
-        Path_other = np.repeat(Path_other[:,np.newaxis], P, axis = 1) # Shape: (N, P, num_agents, n_O, 2)
-        Size_other = np.repeat(Size_other[:,np.newaxis], P, axis = 1) # Shape: (N, P, num_agents, 2)
+        # Pair each predicted agent with all other agents in the same sample
+        Pair_A_other = np.repeat(np.arange(N), num_other_agents)
+        Pair_B_other = (pred_sample[:, np.newaxis] * num_other_agents + np.arange(num_other_agents)[np.newaxis]).reshape(-1)
 
         # Compute the collision rate
         print('Calculating collision rate (indep)', flush = True)
-        print('Path shape: ', Path_pred_agent.shape, flush = True)
-        total_memory, used_memory = get_total_memory(), get_used_memory()
-        available_memory = total_memory - used_memory
-        print('Available memory: {:.2f} GB'.format(available_memory / 2**30), flush = True)
-        # Get memry used for Path_pred_agent and Path_other
-        memory_Path_pred_agent = Path_pred_agent.nbytes
-        needed_memory = memory_Path_pred_agent * 250 # Rough estimate of memory needed for the calculation
-        
-        print('Needed memory: {:.2f} GB'.format(needed_memory / 2**30), flush = True)
-        split_size = max(1, int(P * available_memory / needed_memory))
-        num_splits = int(np.ceil(P / split_size))
-        print('Number of splits: {}'.format(num_splits), flush = True)
-        Collided = []
-        for i in range(num_splits):
-            i_min = i * split_size
-            i_max = min((i + 1) * split_size, P)
-            collided = self._check_collisions(Path_pred_agent[:,i_min:i_max], Path_other[:,i_min:i_max], Size_pred_agent[:,i_min:i_max], Size_other[:,i_min:i_max]) # Shape: (N, P, num_agents)       
-            Collided.append(collided)
-        Collided = np.concatenate(Collided, axis = 1)
-        assert Collided.shape == (N, P, num_agents)
+        if self.metric_kwargs['memory_budget'] is None:
+            memory_budget = 0.5 * max(get_total_memory(print_output = False) - get_used_memory(), 2 ** 28)
+        else:
+            memory_budget = self.metric_kwargs['memory_budget'] * 2 ** 30
+        print('Memory budget: {:.2f} GB'.format(memory_budget / 2**30), flush = True)
+        print('Number of agent pairs: {}'.format(len(Pair_A_pred) + len(Pair_A_other)), flush = True)
+
+        Collided_pred = self._check_collisions_streaming(Path_pred_agent, Path_B_pred, Size_pred_agent, Size_B_pred, 
+                                                         Pair_A_pred, Pair_B_pred, memory_budget) # Shape: (N, P)
+        Collided_other = self._check_collisions_streaming(Path_pred_agent, Path_B_other, Size_pred_agent, Size_B_other, 
+                                                          Pair_A_other, Pair_B_other, memory_budget) # Shape: (N, P)
         
-        # Set Collided to False if Pred_other is False
-        Collided = Collided & Pred_other[:,np.newaxis]
-
         # A single collision with other agent is enough to count as a collision
-        Collided = Collided.any(-1) # Shape: (N, P)
+        Collided = Collided_pred | Collided_other # Shape: (N, P)
 
         # Get probability of collision
         Prob_collision = Collided.mean(-1) # Shape: (N) 
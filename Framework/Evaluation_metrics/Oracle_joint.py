@@ -30,14 +30,11 @@ class Oracle_joint(evaluation_template):
         pass
      
     def evaluate_prediction_method(self):
-        Path_true, Path_pred, Pred_steps = self.get_true_and_predicted_paths(50)
+        Diff, Pred_steps = self.get_squared_displacement_errors(50)
         Pred_agents = Pred_steps.any(-1)
         Num_steps = Pred_steps.sum(-1).max(-1)
         Num_agents = Pred_agents.sum(-1)
         
-        # Get squared distance
-        Diff = ((Path_true - Path_pred) ** 2).sum(-1)
-        
         # Get mean over agents
         Diff = Diff.sum(2) / Num_agents[:,np.newaxis,np.newaxis]
         
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import os
+from utils.memory_utils import get_total_memory, get_used_memory
 
 
 class evaluation_template():
@@ -13,6 +14,9 @@ class evaluation_template():
             
             self.depict_results = False
             
+            # Results that can be shared with other metrics evaluated on the same samples
+            self.evaluation_context = None
+            
             self.Scenario_full   = self.data_set.Domain.Scenario_type
             
             self.t_e_quantile = self.data_set.p_quantile
@@ -35,7 +39,7 @@ class evaluation_template():
             self.depict_results = True
 
 
-    def _evaluate_on_subset(self, Output_pred, evaluation_index):
+    def _evaluate_on_subset(self, Output_pred, evaluation_index, evaluation_context = None):
         self.Index_curr = evaluation_index
 
         # Get the correspoding file index
@@ -49,6 +53,12 @@ class evaluation_template():
         if len(self.Index_curr) == 0:
             return None
         
+        # Only use the shared results if they belong to the current samples
+        if (evaluation_context is not None) and evaluation_context.matches(self.Index_curr):
+            self.evaluation_context = evaluation_context
+        else:
+            self.evaluation_context = None
+        
         available = self._set_current_data(Output_pred)
         if available:
             results = self.evaluate_prediction_method()
@@ -59,9 +69,15 @@ class evaluation_template():
     
 
     #%% Actual evaluation functions
-    def _set_current_data(self, Output_pred):
-        assert np.array_equal(self.Index_curr, Output_pred[0]) # Index of evaluation samples does not overlapwith predicted samples
-
+    def _get_shared_result(self, name, compute, *settings):
+        # Get results that might have been allready calculated by another metric
+        if self.evaluation_context is None:
+            return compute()
+        else:
+            return self.evaluation_context.get(name, compute, *settings)
+    
+    
+    def _get_true_outputs(self):
         if self.data_set.data_in_one_piece:
             Output_A_full   = self.data_set.Output_A.iloc[self.Index_curr]
             Output_T_E_full = self.data_set.Output_T_E[self.Index_curr]
@@ -80,6 +96,14 @@ class evaluation_template():
             Output_A_full   = Output_A_local.reindex(columns = self.data_set.Behaviors).loc[ind_used] # Shape len(Index_curr) x num_behaviors
             Output_T_E_full = Output_T_E_local[ind_used]    # Shape len(Index_curr)
         
+        return Output_A_full, Output_T_E_full
+    
+    
+    def _set_current_data(self, Output_pred):
+        assert np.array_equal(self.Index_curr, Output_pred[0]) # Index of evaluation samples does not overlapwith predicted samples
+
+        Output_A_full, Output_T_E_full = self._get_shared_result('true_outputs', self._get_true_outputs)
+        
         if self.get_output_type()[:5] == 'class':
             # Get label predictions
             Output_A_pred = Output_pred[1]
@@ -108,6 +132,33 @@ class evaluation_template():
     #                Helper functions for the evaluation of the metric                           #
     ##############################################################################################
 
+    def _get_path_angles(self, Path):
+        r'''
+        This function estimates the heading of an agent at each recorded timestep.
+
+        Parameters
+        ----------
+        Path : np.ndarray
+            The path of the agent, in the form of a :math:`\{... \times N_{O} \times 2\}` dimensional 
+            numpy array. Here, :math:`N_{O}` is the number of observed timesteps.
+        
+        Returns
+        -------
+        Theta : np.ndarray
+            This is a :math:`\{... \times N_{O}\}` dimensional numpy array with the headings of the agent.
+        '''
+        Theta = np.arctan2(Path[...,1:,1] - Path[...,:-1,1], Path[...,1:,0] - Path[...,:-1,0])
+        
+        # Elongate the theta values to original length, assuming that the
+        # Calculated angels correspond to the recorded angles at the middle of each timestep
+        Theta_start = Theta[...,0] - 0.5 * (Theta[...,1] - Theta[...,0])
+        Theta_end   = Theta[...,-1] + 0.5 * (Theta[...,-1] - Theta[...,-2])
+        
+        Theta = np.nanmean(np.stack((Theta[...,1:], Theta[...,:-1]), -1), -1)
+        Theta = np.concatenate((Theta_start[...,np.newaxis], Theta, Theta_end[...,np.newaxis]), axis=-1)
+        return Theta
+    
+    
     def _check_collisions(self, Path_A, Path_B, Size_A, Size_B):
         r'''
         This function checks if two agents collide with each other.
@@ -134,22 +185,8 @@ class evaluation_template():
             collision was detected for the corresponding pair of agents.
         '''
         # Get the corresponding angles
-        Theta_A = np.arctan2(Path_A[...,1:,1] - Path_A[...,:-1,1], Path_A[...,1:,0] - Path_A[...,:-1,0])
-        Theta_B = np.arctan2(Path_B[...,1:,1] - Path_B[...,:-1,1], Path_B[...,1:,0] - Path_B[...,:-1,0])
-        
-        # Elongate the theta values to original length, assuming that the
-        # Calculated angels correspond to the recorded angles at the middle of each timestep
-        Theta_A_start = Theta_A[...,0] - 0.5 * (Theta_A[...,1] - Theta_A[...,0])
-        Theta_B_start = Theta_B[...,0] - 0.5 * (Theta_B[...,1] - Theta_B[...,0])
-
-        Theta_A_end = Theta_A[...,-1] + 0.5 * (Theta_A[...,-1] - Theta_A[...,-2])
-        Theta_B_end = Theta_B[...,-1] + 0.5 * (Theta_B[...,-1] - Theta_B[...,-2])
-        
-        Theta_A = np.nanmean(np.stack((Theta_A[...,1:], Theta_A[...,:-1]), -1), -1)
-        Theta_B = np.nanmean(np.stack((Theta_B[...,1:], Theta_B[...,:-1]), -1), -1)
-
-        Theta_A = np.concatenate((Theta_A_start[...,np.newaxis], Theta_A, Theta_A_end[...,np.newaxis]), axis=-1)
-        Theta_B = np.concatenate((Theta_B_start[...,np.newaxis], Theta_B, Theta_B_end[...,np.newaxis]), axis=-1)
+        Theta_A = self._get_path_angles(Path_A)
+        Theta_B = self._get_path_angles(Path_B)
 
         # Get the relative positions
         Path_B_adj = Path_B - Path_A
@@ -452,6 +489,125 @@ class evaluation_template():
         Collided = ~No_collision
         return Collided
     
+    
+    def _check_collisions_streaming(self, Path_A, Path_B, Size_A, Size_B, Pair_A, Pair_B, memory_budget = None):
+        r'''
+        This function checks if agents collide with any of a number of other agents, without 
+        building the full set of paired paths. Instead, the pairs of agents are processed in chunks
+        of agent pairs and predictions, whose size is fixed up front by the memory budget. For each 
+        chunk, a cheap bounding circle test discards all pairs that are never close enough to touch, 
+        and only the remaining pairs are checked with the exact test of **self._check_collisions()**.
+
+        Parameters
+        ----------
+        Path_A : np.ndarray
+            The predicted paths of the first agents, in the form of a :math:`\{N_A \times P \times N_{O} \times 2\}` 
+            dimensional numpy array. Here, :math:`P` is the number of predictions and :math:`N_{O}` 
+            is the number of observed timesteps.
+        Path_B : np.ndarray
+            The paths of the second agents, in the form of a :math:`\{N_B \times P_B \times N_{O} \times 2\}` 
+            dimensional numpy array. Here, :math:`P_B` is either :math:`P` (if the second agents are predicted
+            as well) or 1 (if the same path is to be used for all predictions of the first agents).
+        Size_A : np.ndarray
+            The sizes of the first agents, in the form of a :math:`\{N_A \times 2\}` dimensional numpy array, 
+            with the length x width values of the agents.
+        Size_B : np.ndarray
+            The sizes of the second agents, in the form of a :math:`\{N_B \times 2\}` dimensional numpy array, 
+            with the length x width values of the agents.
+        Pair_A : np.ndarray
+            The indices of the first agents in each pair that is to be checked, in the form of a 
+            :math:`N_{pairs}` dimensional numpy array.
+        Pair_B : np.ndarray
+            The indices of the second agents in each pair that is to be checked, in the form of a 
+            :math:`N_{pairs}` dimensional numpy array.
+        memory_budget : float, optional
+            The maximum memory (in bytes) that is to be used for checking a chunk of pairs. If None, 
+            half of the currently available memory is used. The default is None.
+        
+        Returns
+        -------
+        Collided : np.ndarray
+            This is a :math:`\{N_A \times P\}` dimensional numpy array with boolean values. It indicates if 
+            a prediction of a first agent collides with any of the second agents it is paired with.
+        '''
+        num_A, P, n_O = Path_A.shape[:3]
+        assert Path_B.shape[1] in [1, P], 'The second agents need to have either one or P predictions.'
+        
+        Pair_A = np.asarray(Pair_A, int).reshape(-1)
+        Pair_B = np.asarray(Pair_B, int).reshape(-1)
+        assert len(Pair_A) == len(Pair_B), 'Each pair needs a first and a second agent.'
+
+        Collided = np.zeros((num_A, P), bool)
+        if len(Pair_A) == 0:
+            return Collided
+        
+        # Get the memory budget
+        if memory_budget is None:
+            memory_budget = 0.5 * max(get_total_memory(print_output = False) - get_used_memory(), 2 ** 28)
+
+        # Get the number of pair and prediction combinations that are checked at once
+        # (250 times the memory of the paths is a rough estimate of the memory needed by self._check_collisions)
+        element_memory = 250 * n_O * 2 * max(Path_A.itemsize, Path_B.itemsize)
+        max_elements = max(1, int(memory_budget / element_memory))
+        pred_chunk = min(P, max_elements)
+        pair_chunk = max(1, max_elements // pred_chunk)
+
+        # Get the headings of the first agents, needed to transform the second agents into their frame
+        Theta_A = self._get_path_angles(Path_A) # Shape (N_A, P, N_O)
+
+        # Get the radii of the circles around the second agents
+        Radius_B = 0.5 * np.sqrt(Size_B[:,0] ** 2 + Size_B[:,1] ** 2) # Shape (N_B)
+
+        for pair_start in range(0, len(Pair_A), pair_chunk):
+            pair_A = Pair_A[pair_start:pair_start + pair_chunk]
+            pair_B = Pair_B[pair_start:pair_start + pair_chunk]
+
+            # Get the distance from agent A, beyond which agent B cannot overlap with it on both axes of agent A
+            Max_dist = np.sqrt((0.5 * Size_A[pair_A,0] + Radius_B[pair_B]) ** 2 + 
+                               (0.5 * Size_A[pair_A,1] + Radius_B[pair_B]) ** 2) # Shape (num_pairs)
+            
+            for pred_start in range(0, P, pred_chunk):
+                pred_end = min(P, pred_start + pred_chunk)
+
+                path_A  = Path_A[pair_A, pred_start:pred_end]  # Shape (num_pairs, num_preds, N_O, 2)
+                theta_A = Theta_A[pair_A, pred_start:pred_end] # Shape (num_pairs, num_preds, N_O)
+                if Path_B.shape[1] > 1:
+                    path_B = Path_B[pair_B, pred_start:pred_end] # Shape (num_pairs, num_preds, N_O, 2)
+                else:
+                    path_B = Path_B[pair_B] # Shape (num_pairs, 1, N_O, 2)
+
+                # Get the relative positions in the frame of agent A
+                Rel = path_B - path_A # Shape (num_pairs, num_preds, N_O, 2)
+                Rel = np.stack((Rel[...,0] * np.cos(-theta_A) - Rel[...,1] * np.sin(-theta_A),
+                                Rel[...,0] * np.sin(-theta_A) + Rel[...,1] * np.cos(-theta_A)), axis=-1)
+                
+                # Get the minimum distance of the linearly interpolated positions between timesteps
+                Rel_0 = Rel[...,:-1,:] # Shape (num_pairs, num_preds, N_O - 1, 2)
+                Rel_d = Rel[...,1:,:] - Rel_0 # Shape (num_pairs, num_preds, N_O - 1, 2)
+                Factor = - (Rel_0 * Rel_d).sum(-1) / np.maximum((Rel_d ** 2).sum(-1), 1e-12)
+                Factor = np.clip(Factor, 0.0, 1.0)
+                Dist = np.sqrt(((Rel_0 + Factor[...,np.newaxis] * Rel_d) ** 2).sum(-1)) # Shape (num_pairs, num_preds, N_O - 1)
+                del Rel, Rel_0, Rel_d, Factor
+                
+                # Only close pairs can collide (missing positions, where Dist is np.nan, cannot collide either)
+                Candidate = (Dist <= Max_dist[:,np.newaxis,np.newaxis] + 1e-3).any(-1) # Shape (num_pairs, num_preds)
+                
+                # Ignore predictions where a collision was already found
+                Candidate &= ~Collided[pair_A, pred_start:pred_end]
+
+                cand_pair, cand_pred = np.where(Candidate)
+                if len(cand_pair) == 0:
+                    continue
+                
+                # Use the exact test on the remaining candidates
+                cand_pred_B = cand_pred if path_B.shape[1] > 1 else np.zeros_like(cand_pred)
+                collided = self._check_collisions(path_A[cand_pair, cand_pred], path_B[cand_pair, cand_pred_B],
+                                                  Size_A[pair_A[cand_pair]], Size_B[pair_B[cand_pair]]) # Shape (num_candidates)
+                
+                Collided[pair_A[cand_pair[collided]], pred_start + cand_pred[collided]] = True
+
+        return Collided
+    
 
 
     def get_true_and_predicted_class_probabilities(self):
@@ -602,6 +758,22 @@ class evaluation_template():
 
         '''
         assert self.get_output_type()[:4] == 'path', 'This is not a path prediction metric.'
+        self._set_pred_idx(num_preds)
+        
+        Path_true, Path_pred, Pred_step, Types, Sizes = self._get_shared_true_and_predicted_paths(exclude_late_timesteps)
+        
+        # Copy the shared results, so that they cannot be changed by the metric
+        Path_true = Path_true.copy()
+        Path_pred = Path_pred[:, self.pred_idx]
+        Pred_step = Pred_step.copy()
+
+        if return_types:
+            return Path_true, Path_pred, Pred_step, Types.copy(), Sizes.copy()
+        else:
+            return Path_true, Path_pred, Pred_step
+    
+    
+    def _set_pred_idx(self, num_preds):
         if not hasattr(self, 'pred_idx'):
             # Get the stochastic prediction indices
             if num_preds is None:
@@ -617,13 +789,21 @@ class evaluation_template():
             else:
                 N = num_preds
             assert N == len(self.pred_idx), 'The number of predictions does not match the number of predictions in the model.'
-        
+    
+    
+    def _get_shared_true_and_predicted_paths(self, exclude_late_timesteps):
+        return self._get_shared_result('true_and_predicted_paths', 
+                                       lambda: self._get_true_and_all_predicted_paths(exclude_late_timesteps),
+                                       self.get_output_type(), exclude_late_timesteps)
+    
+    
+    def _get_true_and_all_predicted_paths(self, exclude_late_timesteps):
         self.model._transform_predictions_to_numpy(self.Index_curr, self.Output_path_pred, 
                                                    self.get_output_type() == 'path_all_wo_pov',
                                                    exclude_late_timesteps)
         
         Path_true = self.model.Path_true
-        Path_pred = self.model.Path_pred[:, self.pred_idx]
+        Path_pred = self.model.Path_pred
         Pred_step = self.model.Pred_step
 
         # Get samples where a prediction is actually useful
@@ -633,15 +813,44 @@ class evaluation_template():
         Path_pred = Path_pred[Use_samples]
         Pred_step = Pred_step[Use_samples]
 
-        if return_types:
-            Types = self.model.T_pred
-            Types = Types[Use_samples]
+        Types = self.model.T_pred[Use_samples]
+        Sizes = self.model.S_pred[Use_samples]
+        return Path_true, Path_pred, Pred_step, Types, Sizes
+    
+    
+    def get_squared_displacement_errors(self, num_preds = None, exclude_late_timesteps = True):
+        r'''
+        This returns the squared distances between the true and predicted positions.
 
-            Sizes = self.model.S_pred
-            Sizes = Sizes[Use_samples]
-            return Path_true, Path_pred, Pred_step, Types, Sizes   
-        else:
-            return Path_true, Path_pred, Pred_step
+        Parameters
+        ----------
+        num_preds : int, optional
+            The number :math:`N_{preds}` of different predictions used. The default is None,
+            in which case all available predictions are used.
+        exclude_late_timesteps : bool, optional
+            Decides if predicted timesteps after the set prediction horizon should be excluded. 
+            The default is True.
+
+        Returns
+        -------
+        Diff : np.ndarray
+            This is the squared displacement error of the predicted trajectories, in the form of a
+            :math:`\{N_{samples} \times N_{preds} \times N_{agents} \times N_{O}\}` dimensional 
+            numpy array with float values. For timesteps that are not predicted, this is set to zero.
+        Pred_steps : np.ndarray
+            This is a :math:`\{N_{samples} \times N_{agents} \times N_{O}\}` dimensional numpy array with 
+            boolean values. It indicates for each agent and timestep if the prediction should influence
+            the final metric result.
+
+        '''
+        assert self.get_output_type()[:4] == 'path', 'This is not a path prediction metric.'
+        self._set_pred_idx(num_preds)
+        
+        Path_true, Path_pred, Pred_step, _, _ = self._get_shared_true_and_predicted_paths(exclude_late_timesteps)
+        Diff = self._get_shared_result('squared_displacement_errors', lambda: ((Path_true - Path_pred) ** 2).sum(-1),
+                                       self.get_output_type(), exclude_late_timesteps)
+        
+        return Diff[:, self.pred_idx], Pred_step.copy()
         
     
     def get_other_agents_paths(self, return_types = False):
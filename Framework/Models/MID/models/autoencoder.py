@@ -29,7 +29,8 @@ class AutoEncoder(Module):
         z = self.encoder.get_latent(batch, node_type)
         return z
     
-    def generate(self, batch, node_type, num_points, sample, bestof, flexibility=0.0, ret_traj=False, sampling="ddpm", step=100):
+    def generate(self, batch, node_type, num_points, sample, bestof, flexibility=0.0, ret_traj=False, sampling="ddpm", step=100,
+                 num_sampling_steps=None, max_batch_size=None, generator=None):
         #print(f"Using {sampling}")
         dynamics = self.encoder.node_models_dict[node_type].dynamic
         
@@ -37,7 +38,8 @@ class AutoEncoder(Module):
         
         predicted_y_vel =  self.diffusion.sample(num_points, encoded_x,sample,bestof, 
                                                  flexibility=flexibility, ret_traj=ret_traj, 
-                                                 sampling=sampling, step=step)
+                                                 sampling=sampling, step=step, num_sampling_steps=num_sampling_steps,
+                                                 max_batch_size=max_batch_size, generator=generator)
         predicted_y_pos = dynamics.integrate_samples(predicted_y_vel)
         return predicted_y_pos.cpu().detach().numpy()
 
@@ -52,6 +52,15 @@ class VarianceSchedule(Module):
         ts = np.random.choice(np.arange(1, self.num_steps+1), batch_size)
         return ts.tolist()
 
+    def get_sampling_timesteps(self, stride=1, num_sampling_steps=None):
+        # Get the decreasing timesteps visited by the reverse chain, always ending at 0
+        if num_sampling_steps is None:
+            timesteps = list(range(self.num_steps, 0, -stride))
+        else:
+            num_sampling_steps = max(1, min(int(num_sampling_steps), self.num_steps))
+            timesteps = np.round(np.linspace(self.num_steps, 0, num_sampling_steps + 1)).astype(int)[:-1].tolist()
+        return timesteps + [0]
+
     def get_sigmas(self, t, flexibility):
         assert 0 <= flexibility and flexibility <= 1
         sigmas = self.sigmas_flex[t] * flexibility + self.sigmas_inflex[t] * (1 - flexibility)
@@ -83,48 +92,86 @@ class DiffusionTraj(Module):
         loss = F.mse_loss(e_theta.view(-1, point_dim), e_rand.view(-1, point_dim), reduction='mean')
         return loss
 
-    def sample(self, num_points, context, sample, bestof, point_dim=2, flexibility=0.0, ret_traj=False, sampling="ddpm", step=100):
+    def sample(self, num_points, context, sample, bestof, point_dim=2, flexibility=0.0, ret_traj=False, sampling="ddpm", step=100,
+               num_sampling_steps=None, max_batch_size=None, generator=None):
+        """
+        Args:
+            num_points:  Number of predicted timesteps N.
+            context:  Encoded history. (B, F).
+            sample:  Number of drawn trajectories S per agent.
+            sampling:  Either 'ddpm' or 'ddim' (deterministic given the initial noise).
+            step:  Stride of the reverse chain, ignored if num_sampling_steps is given.
+            num_sampling_steps:  Number of evaluations of the denoiser in the reverse chain.
+            max_batch_size:  Maximum number of trajectories (samples times agents) denoised at once.
+            generator:  Optional torch.Generator (on the cpu) used for drawing all noise.
+        Returns:
+            Trajectories. (S, B, N, d).
+        """
+        assert sampling in ('ddpm', 'ddim'), "Unknown sampling method " + str(sampling) + "."
+        batch_size = context.size(0)
+        timesteps = self.var_sched.get_sampling_timesteps(step, num_sampling_steps)
+
+        # Fold multiple samples into the batch dimension
+        if max_batch_size is None:
+            samples_per_chunk = sample
+        else:
+            samples_per_chunk = max(1, min(sample, max_batch_size // batch_size))
+
         traj_list = []
-        for i in range(sample):
-            batch_size = context.size(0)
-            if bestof:
-                x_T = torch.randn([batch_size, num_points, point_dim]).to(context.device)
+        for i_start in range(0, sample, samples_per_chunk):
+            num_chunk = min(samples_per_chunk, sample - i_start)
+
+            # Samples are stacked sample-major, i.e., (S_chunk * B, F)
+            context_chunk = context.repeat(num_chunk, *[1] * (context.dim() - 1))
+            traj = self._sample_chain(num_points, context_chunk, bestof, point_dim, flexibility,
+                                      ret_traj, sampling, timesteps, generator)
+
+            if ret_traj:
+                for i in range(num_chunk):
+                    traj_list.append({t: x_t[i * batch_size:(i + 1) * batch_size] for t, x_t in traj.items()})
             else:
-                x_T = torch.zeros([batch_size, num_points, point_dim]).to(context.device)
-            traj = {self.var_sched.num_steps: x_T}
-            stride = step
-            #stride = int(100/stride)
-            for t in range(self.var_sched.num_steps, 0, -stride):
-                z = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
-                alpha = self.var_sched.alphas[t]
-                alpha_bar = self.var_sched.alpha_bars[t]
-                alpha_bar_next = self.var_sched.alpha_bars[t-stride]
-                #pdb.set_trace()
+                traj_list += list(traj[0].view(num_chunk, batch_size, num_points, point_dim).unbind(0))
+
+        if ret_traj:
+            return traj_list
+        return torch.stack(traj_list)
+
+    def _get_noise(self, shape, device, generator):
+        if generator is None:
+            return torch.randn(shape, device=device)
+        else:
+            return torch.randn(shape, generator=generator).to(device)
+
+    def _sample_chain(self, num_points, context, bestof, point_dim, flexibility, ret_traj, sampling, timesteps, generator):
+        batch_size = context.size(0)
+        if bestof:
+            x_T = self._get_noise([batch_size, num_points, point_dim], context.device, generator)
+        else:
+            x_T = torch.zeros([batch_size, num_points, point_dim]).to(context.device)
+        traj = {timesteps[0]: x_T}
+        for t, t_next in zip(timesteps[:-1], timesteps[1:]):
+            alpha = self.var_sched.alphas[t]
+            alpha_bar = self.var_sched.alpha_bars[t]
+            alpha_bar_next = self.var_sched.alpha_bars[t_next]
+
+            x_t = traj[t]
+            beta = self.var_sched.betas[[t]*batch_size]
+            e_theta = self.net(x_t, beta=beta, context=context)
+            if sampling == "ddpm":
+                z = self._get_noise(x_t.shape, x_t.device, generator) if t > 1 else torch.zeros_like(x_t)
                 sigma = self.var_sched.get_sigmas(t, flexibility)
 
                 c0 = 1.0 / torch.sqrt(alpha)
                 c1 = (1 - alpha) / torch.sqrt(1 - alpha_bar)
-
-                x_t = traj[t]
-                beta = self.var_sched.betas[[t]*batch_size]
-                e_theta = self.net(x_t, beta=beta, context=context)
-                if sampling == "ddpm":
-                    x_next = c0 * (x_t - c1 * e_theta) + sigma * z
-                elif sampling == "ddim":
-                    x0_t = (x_t - e_theta * (1 - alpha_bar).sqrt()) / alpha_bar.sqrt()
-                    x_next = alpha_bar_next.sqrt() * x0_t + (1 - alpha_bar_next).sqrt() * e_theta
-                else:
-                    pdb.set_trace()
-                traj[t-stride] = x_next.detach()     # Stop gradient and save trajectory.
-                traj[t] = traj[t].cpu()         # Move previous output to CPU memory.
-                if not ret_traj:
-                   del traj[t]
-
-            if ret_traj:
-                traj_list.append(traj)
+                x_next = c0 * (x_t - c1 * e_theta) + sigma * z
             else:
-                traj_list.append(traj[0])
-        return torch.stack(traj_list)
+                x0_t = (x_t - e_theta * (1 - alpha_bar).sqrt()) / alpha_bar.sqrt()
+                x_next = alpha_bar_next.sqrt() * x0_t + (1 - alpha_bar_next).sqrt() * e_theta
+            traj[t_next] = x_next.detach()     # Stop gradient and save trajectory.
+            traj[t] = traj[t].cpu()         # Move previous output to CPU memory.
+            if not ret_traj:
+               del traj[t]
+        return traj
 
 class TrajNet(Module):
 
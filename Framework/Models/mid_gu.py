@@ -5,6 +5,7 @@ import random
 import torch
 
 from model_template import model_template
+from utils.memory_utils import get_used_memory
 from MID.evaluation import *
 from MID import mid_model
 from MID.environment import *
@@ -33,15 +34,41 @@ class mid_gu(model_template):
     def define_default_kwargs(self):
         if not('seed' in self.model_kwargs.keys()):
             self.model_kwargs['seed'] = 0
+            
+        # Reverse diffusion used for prediction ('ddpm', 'ddim', or 'ddim_deterministic')
+        if not('sampling' in self.model_kwargs.keys()):
+            self.model_kwargs['sampling'] = 'ddim'
+        assert self.model_kwargs['sampling'] in ['ddpm', 'ddim', 'ddim_deterministic'], "Unknown sampling method for MID."
+        
+        if not('sampling_steps' in self.model_kwargs.keys()):
+            if self.model_kwargs['sampling'] == 'ddpm':
+                self.model_kwargs['sampling_steps'] = 100
+            else:
+                self.model_kwargs['sampling_steps'] = 5
+        
+        # Maximum number of trajectories denoised at once (None: Determined by the available memory)
+        if not('sampling_batch_size' in self.model_kwargs.keys()):
+            self.model_kwargs['sampling_batch_size'] = None
 
     def get_name(self = None):
         self.define_default_kwargs()
+        file_name = 'MDI_' + str(self.model_kwargs['seed'])
+        
         names = {'print': 'MDI',
-                    'file': 'MDI_' + str(self.model_kwargs['seed']),
+                    'file': file_name,
                     'latex': r'\emph{MDI}'}
 
         return names
 
+    def get_prediction_file_addon(self):
+        # The sampling settings only change the predictions, so the trained model is shared between them
+        # (only non default settings are added, so that existing predictions are still found)
+        self.define_default_kwargs()
+        file_addon = super().get_prediction_file_addon()
+        if (self.model_kwargs['sampling'] != 'ddim') or (self.model_kwargs['sampling_steps'] != 5):
+            file_addon += '--sampling_' + self.model_kwargs['sampling'] + str(self.model_kwargs['sampling_steps'])
+        return file_addon
+
     def requires_torch_gpu(self = None):
         return True
 
@@ -549,7 +576,7 @@ class mid_gu(model_template):
                     node_type = NodeType(name=node_type, value=value)
                     
                     traj_pred = self.MID.model.generate(test_batch, node_type, num_points=self.num_timesteps_out, sample=20,
-                                                        bestof=True) # B * 20 * self.num_timesteps_out * 2
+                                                        bestof=True, max_batch_size=self.get_sampling_batch_size(self.num_timesteps_out)) # B * 20 * self.num_timesteps_out * 2
                     timesteps_o = traj_pred.shape[1]
 
                     predictions = traj_pred
@@ -610,10 +637,37 @@ class mid_gu(model_template):
                 Weights[i][:] = torch.from_numpy(weights)[:]
 
 
+    def get_sampling_batch_size(self, num_points):
+        if self.model_kwargs['sampling_batch_size'] is not None:
+            return max(1, int(self.model_kwargs['sampling_batch_size']))
+        
+        # Get the available memory on the device used for denoising
+        if self.device.type == 'cuda':
+            available_memory = torch.cuda.mem_get_info(self.device)[0]
+        else:
+            available_memory = self.data_set.total_memory - get_used_memory()
+        available_memory = max(available_memory, 100 * 2**20)
+        
+        # Assume that the activations of the transformer (with width 2 * encoder_dim) are stored multiple times
+        bytes_per_trajectory = 16 * 4 * num_points * 2 * self.config_dict['encoder_dim']
+        return max(1, int(0.5 * available_memory / bytes_per_trajectory))
+    
+    
     def predict_method(self):
         batch_size = max(1, int(self.hyperparams['batch_size'] / 10))
         self.MID.model.eval()
         
+        # Get the sampling settings
+        if self.model_kwargs['sampling'] == 'ddpm':
+            sampling = 'ddpm'
+        else:
+            sampling = 'ddim'
+        
+        # The deterministic mode draws all noise from a seperate, seeded generator
+        generator = None
+        if self.model_kwargs['sampling'] == 'ddim_deterministic':
+            generator = torch.Generator().manual_seed(self.model_kwargs['seed'])
+        
         prediction_done = False
         
         batch_number = 0
@@ -643,8 +697,11 @@ class mid_gu(model_template):
             
             num_steps_pred = min(num_steps, 100)
 
-            traj_pred = self.MID.model.generate(test_batch, node_type, num_points=num_steps_pred, sample=self.num_samples_path_pred,
-                                                bestof=True, sampling='ddim', step=100//5) # B * 20 * 12 * 2
+            with torch.no_grad():
+                traj_pred = self.MID.model.generate(test_batch, node_type, num_points=num_steps_pred, sample=self.num_samples_path_pred,
+                                                    bestof=True, sampling=sampling, num_sampling_steps=self.model_kwargs['sampling_steps'],
+                                                    max_batch_size=self.get_sampling_batch_size(num_steps_pred), 
+                                                    generator=generator) # S * B * N * 2
                 
             # set batchsize first
             Pred_r = traj_pred.transpose(1,0,2,3)
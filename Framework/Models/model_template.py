@@ -7,8 +7,15 @@ import scipy as sp
 import importlib
 import psutil
 import shutil
+import hashlib
 from pathlib import Path
 from utils.memory_utils import get_total_memory, get_used_memory
+from utils.batch_prefetch_utils import batch_prefetcher, array_to_torch
+from utils.inference_utils import inference_optimizer, get_torch_networks
+from utils.prediction_store_utils import dense_path_predictions_from_dataframes, merge_dense_path_predictions
+from utils.prediction_store_utils import save_dense_path_predictions, load_dense_path_predictions
+from utils.evaluation_context_utils import evaluation_cache
+from utils.results_index_utils import results_index, get_results_index_file
 
 from rome.ROME import ROME
 
@@ -37,8 +44,10 @@ class model_template():
                         look_for_gpu = False
                 
                 if torch.cuda.is_available() and look_for_gpu:
+                    # The device is only set in self.set_torch_device(), as initializing cuda here
+                    # would prevent models that are only used to get their trainability and file names
+                    # from being run in forked processes afterwards
                     self.device = torch.device('cuda', index=0) 
-                    torch.cuda.set_device(0)
                 else:
                     if look_for_gpu:
                         warnings.warn('''No GPU could be found. Program is proccessed on the CPU.
@@ -48,6 +57,39 @@ class model_template():
                         
                     self.device = torch.device('cpu')
             
+            # Check if batches should be prepared in the background
+            self.num_prefetch_batches = 0
+            if 'prefetch_batches' in model_kwargs.keys():
+                self.num_prefetch_batches = max(0, int(model_kwargs['prefetch_batches']))
+            
+            self.prefetch_torch_output = False
+            self.prefetch_pin_memory = False
+            if 'prefetch_pin_memory' in model_kwargs.keys():
+                # Pinned memory is only useful for transfer to the gpu
+                self.prefetch_torch_output = bool(model_kwargs['prefetch_pin_memory'])
+                self.prefetch_pin_memory = self.prefetch_torch_output and torch.cuda.is_available()
+            
+            self.batch_prefetchers = {}
+            
+            # Check if the predictions of torch models should be optimized
+            self.inference_optimizer = None
+            if self.requires_torch_gpu():
+                inference_settings = {'inference_mode': False, 'compile': False, 'cpu_threads': None, 'inference_precision': 'float32'}
+                for key in inference_settings.keys():
+                    if key in model_kwargs.keys():
+                        inference_settings[key] = model_kwargs[key]
+                
+                self.inference_optimizer = inference_optimizer(self.device, 
+                                                               inference_mode = bool(inference_settings['inference_mode']), 
+                                                               compile = bool(inference_settings['compile']), 
+                                                               cpu_threads = inference_settings['cpu_threads'], 
+                                                               precision = inference_settings['inference_precision'])
+            
+            # Get the precision in which predicted trajectories are saved
+            self.prediction_dtype = np.float32
+            if 'prediction_dtype' in model_kwargs.keys():
+                assert model_kwargs['prediction_dtype'] in ['float32', 'float16'], "Predictions can only be saved as float32 or float16."
+                self.prediction_dtype = np.dtype(model_kwargs['prediction_dtype']).type
             
             self.data_set = data_set
             self.splitter = splitter
@@ -106,7 +148,8 @@ class model_template():
 
                             self.model_file = self.model_file[:-4] + self.pretrained_string + '.npy'
                     
-                    self.model_file_metric = self.model_file + ''
+                    # Predictions (and their evaluations) with reduced precision are saved seperately
+                    self.model_file_metric = self.model_file[:-4] + self.get_prediction_file_addon() + '.npy'
                     if '_pert=' in self.model_file:
                         pert_split = self.model_file.split('_pert=')
                         self.model_file = pert_split[0] + '_pert=' + pert_split[1][0] + pert_split[1][2:]
@@ -227,8 +270,29 @@ class model_template():
             assert len(self.train_loss.shape) == 2, "The train loss should be a 2D numpy array."
             np.save(self.loss_file, self.train_loss.astype(np.float32))
     
+    def get_prediction_file_addon(self):
+        # The weights of the model are not changed by the inference precision or the precision
+        # in which predictions are saved, only its predictions (and their evaluations)
+        file_addon = ''
+        if self.requires_torch_gpu():
+            precision = self.model_kwargs.get('inference_precision', 'float32')
+            if precision != 'float32':
+                file_addon += '--inference_' + precision
+        
+        prediction_dtype = self.model_kwargs.get('prediction_dtype', 'float32')
+        if prediction_dtype != 'float32':
+            file_addon += '--pred_' + prediction_dtype
+        return file_addon
+    
+    def set_torch_device(self):
+        # Initialize cuda only once the model is actually trained or evaluated
+        if self.requires_torch_gpu() and self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
+    
     def train(self):
         assert not self.simply_load_results, 'This model instance is nonly for loading results.'
+        self.set_torch_device()
+        self.stop_batch_prefetching()
         self.model_mode = 'train'
         if os.path.isfile(self.model_file) and not self.model_overwrite:
             self.weights_saved = list(np.load(self.model_file, allow_pickle = True)[:-1])
@@ -294,6 +358,8 @@ class model_template():
         return self.model_file
         
     def predict_actual(self, Index = None):
+        self.set_torch_device()
+        
         # Reset prediction analysis
         self.reset_prediction_analysis()
 
@@ -306,26 +372,43 @@ class model_template():
         if self.get_output_type()[:4] == 'path':
             self.create_empty_output_path()
             if len(self.Index_test) > 0:
-                self.predict_method()
+                self.run_predict_method()
             output = [self.Index_test, self.Output_path_pred, self.Output_path_pred_probs]
         elif self.get_output_type() == 'class':
             self.create_empty_output_A()
             if len(self.Index_test) > 0:
-                self.predict_method()
+                self.run_predict_method()
             output = [self.Index_test, self.Output_A_pred]
         elif self.get_output_type() == 'class_and_time':
             self.create_empty_output_A()
             self.create_empty_output_T()
             if len(self.Index_test) > 0:
-                self.predict_method()
+                self.run_predict_method()
             output = [self.Index_test, self.Output_A_pred, self.Output_T_E_pred]
         else:
             raise TypeError("This output type for models is not implemented.")
         return output
         
+    def run_predict_method(self):
+        if self.inference_optimizer is None:
+            self.predict_method()
+            return
+        
+        # Apply the selected optimizations to all torch networks used by the model
+        if self.inference_optimizer.active:
+            Locations = get_torch_networks(self)
+        else:
+            Locations = []
+        with self.inference_optimizer.apply(Locations, len(self.Index_test)):
+            self.predict_method()
+        
+        self.inference_optimizer.print_throughput()
+        
+        
     def reset_prediction_analysis(self):
         assert not self.simply_load_results, 'This model instance is nonly for loading results.'
         # Reset potential batch extraction
+        self.stop_batch_prefetching()
         if hasattr(self, 'Ind_pred'):
             del self.Ind_pred
 
@@ -384,7 +467,8 @@ class model_template():
                 continue
 
             # Get metric save file
-            metric_file = metric.data_set.change_result_directory(self.model_file_metric, 'Metrics', metric.get_name()['file'])
+            metric_file = metric.data_set.change_result_directory(self.model_file_metric, 'Metrics', 
+                                                                  metric.get_name()['file'] + metric.data_set.get_KDE_file_addon())
 
             if os.path.isfile(metric_file) and not metric.metric_override:
                 # Load results to check if the train set is allready evaluated
@@ -552,9 +636,13 @@ class model_template():
         return Result_dict
     
     def save_metric_results(self, Result_dict, identical_test_set = False):
+        # Get the experiment level index, from which the results can be read without loading the data
+        Results_index = results_index(get_results_index_file(self.data_set.path))
+        
         for mode, Result_mode_dict in Result_dict.items():
             for metric, Result in Result_mode_dict.items():
-                metric_file = metric.data_set.change_result_directory(self.model_file_metric, 'Metrics', metric.get_name()['file'])
+                metric_file = metric.data_set.change_result_directory(self.model_file_metric, 'Metrics', 
+                                                                      metric.get_name()['file'] + metric.data_set.get_KDE_file_addon())
                 
                 if os.path.isfile(metric_file):
                     Results = list(np.load(metric_file, allow_pickle = True)[:-1])
@@ -593,6 +681,7 @@ class model_template():
                 save_data = np.array(Results + [0], object) # 0 is there to avoid some numpy load and save errros
                 os.makedirs(os.path.dirname(metric_file), exist_ok=True)
                 np.save(metric_file, save_data)
+                Results_index.set_results(metric_file, Results)
 
     
     def predict_Index(self, Index, model_type, file_index = 0):
@@ -621,12 +710,20 @@ class model_template():
     def predict_and_evaluate(self, Metric_dict_list, print_status_function):
         assert not self.depict_results, 'This model instance is only for loading results.'
         assert self.data_set is not None, 'This model instance is only for loading results.'
+        self.set_torch_device()
 
         # Preselct the metrics based on their existence and other requirements
         Metric_dict, Result_dict, identical_test_set = self.Sort_Metrics(Metric_dict_list, print_status_function)
 
         # Get the type of prediction in this output
         model_type = self.get_output_type()
+        
+        # Prepare the storage of intermediate results shared between metrics
+        if 'evaluation_memory_budget' in self.model_kwargs.keys():
+            evaluation_memory = self.model_kwargs['evaluation_memory_budget'] * 2 ** 30
+        else:
+            evaluation_memory = 0.25 * max(self.data_set.total_memory - get_used_memory(), 2 ** 28)
+        Evaluation_cache = evaluation_cache(evaluation_memory)
 
         # Go through needed metrics and sort by metric type
         for mode, Metric_type_dict in Metric_dict.items():
@@ -646,16 +743,21 @@ class model_template():
                 
                 # Get output
                 output = self.predict_Index(Index, model_type, file_index)
+                
+                # Get the results shared between metrics evaluated on these samples
+                evaluation_context = Evaluation_cache.get_context(Index, file_index)
 
                 for metric_type, Metric_list in Metric_type_dict.items():
                     output_trans = self.transform_output(output, Index, model_type, metric_type)
 
                     for metric in Metric_list:
                         # Evaluate metric
-                        result = metric._evaluate_on_subset(output_trans, Index)
+                        result = metric._evaluate_on_subset(output_trans, Index, evaluation_context)
 
                         # Append results to result dict
                         Result_dict = self.append_result_dict(mode, metric, Result_dict, result, Index, Index_df)
+            
+            Evaluation_cache.clear()
 
         self.save_metric_results(Result_dict, identical_test_set)
 
@@ -824,8 +926,12 @@ class model_template():
                 # Get current file
                 pred_file = self.pred_loc_file[:-4] + '--' + pred_name + '_' + str(pred_file_number) + '.npy'
                 
-                # Load the results
-                pred_results = np.load(pred_file, allow_pickle = True)
+                # Load the results (predicted paths are only read for the required samples)
+                pred_dir = self._get_dense_prediction_directory(pred_file, pred_name)
+                if pred_dir is not None:
+                    pred_results = load_dense_path_predictions(pred_dir).to_dataframes(Index_loaded_file)
+                else:
+                    pred_results = np.load(pred_file, allow_pickle = True)
                 
                 for i in range(num_outputs):
                     if len(pred_results) > i:
@@ -892,7 +998,7 @@ class model_template():
             # get approximate number of agents
             num_agents_per_sample = self.data_set.Pred_agents_pred_all.sum(-1)
             num_agents = 0.8 * num_agents_per_sample.mean() + 0.2 * num_agents_per_sample.max()
-            n_bytes_per_sample = num_agents * (self.num_timesteps_out * 1.25) * 8
+            n_bytes_per_sample = num_agents * self.num_samples_path_pred * (self.num_timesteps_out * 1.25) * 2 * np.dtype(self.prediction_dtype).itemsize
             
         elif pred_type[:5] == 'class':
             pred_name = 'class'
@@ -924,6 +1030,10 @@ class model_template():
             # Get current file
             pred_file = self.pred_loc_file[:-4] + '--' + pred_name + '_' + str(pred_file_number) + '.npy'
             
+            if pred_name == 'paths':
+                self._save_path_predictions_to_file(pred_file, output, Index_overwrite_file)
+                continue
+            
             # Load the results
             pred_results = np.load(pred_file, allow_pickle = True)
             
@@ -966,25 +1076,28 @@ class model_template():
             # Get the output saved in this iteration  
             Index_new_saved = Index_new[:num_saved]   
             
-            # Load the results
-            if os.path.isfile(pred_file):
-                pred_results = np.load(pred_file, allow_pickle = True)
+            if pred_name == 'paths':
+                self._save_path_predictions_to_file(pred_file, output, Index_new_saved)
             else:
-                pred_results = [pd.DataFrame(np.zeros((0, len(columns)), object), columns = columns) for _ in range(num_outputs_req)]
-                pred_results = pred_results + [0]
-                
+                # Load the results
+                if os.path.isfile(pred_file):
+                    pred_results = np.load(pred_file, allow_pickle = True)
+                else:
+                    pred_results = [pd.DataFrame(np.zeros((0, len(columns)), object), columns = columns) for _ in range(num_outputs_req)]
+                    pred_results = pred_results + [0]
+                    
+                    
+                # Go through the outputs
+                for i in range(num_outputs):
+                    pred_results[i] = pd.concat([pred_results[i], output[i + 1].loc[Index_new_saved]], axis = 0)
+                for i in range(num_outputs, num_outputs_req):
+                    out_empty = pd.DataFrame(np.empty((len(Index_new_saved), len(columns)), object), columns = columns, index = Index_new_saved)
+                    pred_results[i] = pd.concat([pred_results[i], out_empty], axis = 0)
+    
                 
-            # Go through the outputs
-            for i in range(num_outputs):
-                pred_results[i] = pd.concat([pred_results[i], output[i + 1].loc[Index_new_saved]], axis = 0)
-            for i in range(num_outputs, num_outputs_req):
-                out_empty = pd.DataFrame(np.empty((len(Index_new_saved), len(columns)), object), columns = columns, index = Index_new_saved)
-                pred_results[i] = pd.concat([pred_results[i], out_empty], axis = 0)
-
-            
-            # Save the results
-            os.makedirs(os.path.dirname(pred_file), exist_ok=True)
-            np.save(pred_file, np.array(pred_results, object))    
+                # Save the results
+                os.makedirs(os.path.dirname(pred_file), exist_ok=True)
+                np.save(pred_file, np.array(pred_results, object))    
             
             # Overwrite Pred_locator
             self.Pred_locator.loc[Index_new_saved, pred_name] = pred_file_number
@@ -1003,6 +1116,41 @@ class model_template():
 
     
 
+    def _get_dense_prediction_directory(self, pred_file, pred_name):
+        # Predicted paths are saved as dense arrays in a directory, while older versions used a pickled file
+        if pred_name != 'paths':
+            return None
+        
+        pred_dir = pred_file[:-4]
+        if os.path.isdir(pred_dir):
+            return pred_dir
+        else:
+            return None
+    
+    
+    def _save_path_predictions_to_file(self, pred_file, output, Index_saved):
+        # Get the new predictions in the dense format
+        Pred_new = dense_path_predictions_from_dataframes(output[1].loc[Index_saved], output[2].loc[Index_saved], 
+                                                          list(self.data_set.Agents), self.prediction_dtype)
+        
+        # Combine with the predictions allready saved in this file
+        pred_dir = self._get_dense_prediction_directory(pred_file, 'paths')
+        if pred_dir is not None:
+            Pred_old = load_dense_path_predictions(pred_dir)
+            Pred_new = merge_dense_path_predictions(Pred_old, Pred_new)
+        elif os.path.isfile(pred_file):
+            pred_results = np.load(pred_file, allow_pickle = True)
+            Pred_old = dense_path_predictions_from_dataframes(pred_results[0], pred_results[1], 
+                                                              list(self.data_set.Agents), self.prediction_dtype)
+            Pred_new = merge_dense_path_predictions(Pred_old, Pred_new)
+        
+        save_dense_path_predictions(Pred_new, pred_file[:-4])
+        
+        # Remove the pickled file of older versions
+        if os.path.isfile(pred_file):
+            os.remove(pred_file)
+        
+    
     #################################################################################################
     #################################################################################################
     ###                                                                                           ###
@@ -1041,6 +1189,11 @@ class model_template():
                 print_progress = False
             else:
                 print_progress = True
+            
+            if hasattr(self, 'target_m_per_px'):
+                target_m_per_px = self.target_m_per_px
+            else:
+                target_m_per_px = None
                 
 
             img_needed, img_m_per_px_needed = self.data_set.return_batch_images(domain_needed, centre, rot,
@@ -1048,7 +1201,8 @@ class model_template():
                                                                                 target_width = self.target_width,
                                                                                 grayscale = self.grayscale,
                                                                                 return_resolution = True,
-                                                                                print_progress = print_progress)
+                                                                                print_progress = print_progress,
+                                                                                target_m_per_px = target_m_per_px)
             use_batch_extraction = False
         else:
             img_needed = None
@@ -2027,6 +2181,88 @@ class model_template():
             This indicates wether one has just sampled all batches from an epoch and has to go to the next one.
 
         '''
+        # Prepare data (this has to happen before the background thread is started)
+        self.prepare_batch_generation()
+
+        if mode == 'pred':
+            return_classifications = False
+
+        batch_key = (mode, batch_size, val_split_size, ignore_map, ignore_graph, return_categories, return_classifications)
+        
+        if self.num_prefetch_batches == 0:
+            output, input_data_type, batch_data = self._provide_batch_data_actual(*batch_key)
+        
+        else:
+            # Stop the prefetching of batches with other settings, but keep the already prepared ones
+            for key in self.batch_prefetchers.keys():
+                if key != batch_key:
+                    self.batch_prefetchers[key].stop()
+            
+            if batch_key not in self.batch_prefetchers.keys():
+                self.batch_prefetchers[batch_key] = self._get_batch_prefetcher(batch_key)
+
+            prefetcher = self.batch_prefetchers[batch_key]
+            output, input_data_type, batch_data = prefetcher.get()
+
+            # After the end of an epoch, the next one is prepared by a new prefetcher
+            if prefetcher.finished:
+                del self.batch_prefetchers[batch_key]
+        
+        self.input_data_type = input_data_type
+        if mode == 'pred':
+            self.batch_data = batch_data
+        
+        return output
+    
+    
+    def _get_batch_prefetcher(self, batch_key):
+        # Select the samples of all batches until the end of the epoch here, so that the index state
+        # (including the shuffle for the next epoch) is only ever changed by the calling thread
+        (mode, batch_size, val_split_size, ignore_map, ignore_graph, return_categories, return_classifications) = batch_key
+        
+        Batch_indices = []
+        epoch_done = False
+        while not epoch_done:
+            ind_advance, num_steps, epoch_done = self._select_batch_indices(mode, batch_size, val_split_size, ignore_map)
+            
+            # The background thread only gets read-only copies of the selected samples
+            ind_advance = ind_advance.copy()
+            ind_advance.setflags(write = False)
+            Batch_indices.append((ind_advance, num_steps, epoch_done))
+        Batch_indices = tuple(Batch_indices)
+        
+        # The position is only advanced by the background thread
+        position = [0]
+        def produce_batch():
+            ind_advance, num_steps, epoch_done = Batch_indices[position[0]]
+            batch = self._load_batch_data(mode, ind_advance, num_steps, epoch_done, ignore_map, ignore_graph, 
+                                          return_categories, return_classifications)
+            position[0] += 1
+            return batch, epoch_done
+        
+        return batch_prefetcher(produce_batch, self.num_prefetch_batches)
+    
+    
+    def stop_batch_prefetching(self):
+        # Stop all background threads and discard all prepared batches
+        if not hasattr(self, 'batch_prefetchers'):
+            return
+        
+        for key in self.batch_prefetchers.keys():
+            self.batch_prefetchers[key].stop()
+        
+        self.batch_prefetchers = {}
+    
+    
+    def _provide_batch_data_actual(self, mode, batch_size, val_split_size = 0.0, ignore_map = False, ignore_graph = False, 
+                                   return_categories = False, return_classifications = False):
+        ind_advance, num_steps, epoch_done = self._select_batch_indices(mode, batch_size, val_split_size, ignore_map)
+        return self._load_batch_data(mode, ind_advance, num_steps, epoch_done, ignore_map, ignore_graph, 
+                                     return_categories, return_classifications)
+    
+    
+    def _select_batch_indices(self, mode, batch_size, val_split_size = 0.0, ignore_map = False):
+        ## NOTE: Method has been adjusted for large datasets
         reset_train_indices = False
         if hasattr(self, 'val_split_size') and mode == 'train':
             if hasattr(self, 'Ind_train') and val_split_size != self.val_split_size:
@@ -2037,9 +2273,6 @@ class model_template():
         self.val_split_size = val_split_size
         
         self.prepare_batch_generation()
-
-        if mode == 'pred':
-            return_classifications = False
         
         if mode == 'pred':
             assert self.model_mode == 'pred', 'During prediction, testing set should be called.'
@@ -2142,12 +2375,18 @@ class model_template():
         # check if epoch is completed, if so, shuffle and reset index
         epoch_done, Ind_advance = self._update_available_samples(Ind_advance, ind_advance) 
 
-        ## Prepare the data to be returned
         # get num_steps
         num_steps = N_O[ind_advance].min()
         if mode != 'pred':
             assert num_steps <= self.max_t_O_train, 'Number of timesteps is too large for training, got {}, while max is {}'.format(num_steps, self.max_t_O_train)
         
+        return ind_advance, num_steps, epoch_done
+    
+    
+    def _load_batch_data(self, mode, ind_advance, num_steps, epoch_done, ignore_map = False, ignore_graph = False, 
+                         return_categories = False, return_classifications = False):
+        # This does not change the index state of the model, so it can be run in a background thread
+        ## Prepare the data to be returned
         # Get data as available for whole dataset
         T = self.T[ind_advance]
         S = self.S[ind_advance]
@@ -2160,9 +2399,9 @@ class model_template():
         # Get the corresponding input_data_type
         input_data_type_indices = self.data_set.Domain.iloc[Sample_id[:,0]].data_type_index
         assert len(np.unique(input_data_type_indices)) == 1, 'Only one data type should be used in each batch'
-        self.input_data_type = self.data_set.Input_data_type[input_data_type_indices.iloc[0]]
+        input_data_type = self.data_set.Input_data_type[input_data_type_indices.iloc[0]]
 
-        num_dim = len(self.input_data_type)
+        num_dim = len(input_data_type)
 
         # Prepare the output arrays
         X = np.full((len(ind_advance), self.ID.shape[1], self.num_timesteps_in, num_dim), np.nan, np.float32)
@@ -2309,23 +2548,43 @@ class model_template():
 
             else:
                 C = None
+        
+        # Save the numpy data needed for evaluating predictions
+        if mode == 'pred':
+            if return_categories:
+                batch_data = [X, Y, T, S, C, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id]
+            else:
+                batch_data = [X, Y, T, S, None, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id]
+        else:
+            batch_data = None
+        
+        # Transform numerical data to (pinned) torch tensors if desired
+        if self.prefetch_torch_output:
+            X            = array_to_torch(X, self.prefetch_pin_memory)
+            Y            = array_to_torch(Y, self.prefetch_pin_memory)
+            S            = array_to_torch(S, self.prefetch_pin_memory)
+            img          = array_to_torch(img, self.prefetch_pin_memory)
+            img_m_per_px = array_to_torch(img_m_per_px, self.prefetch_pin_memory)
+        
+        if return_categories:
             if mode == 'pred':
-                self.batch_data = [X, Y, T, S, C, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id]
-                return     X,    T, S, C,                 img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done    
+                output = (X,    T, S, C,                 img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done)
             else:
                 if return_classifications:
-                    return X, Y, T, S, C, P, class_names, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done
+                    output = (X, Y, T, S, C, P, class_names, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done)
                 else:
-                    return X, Y, T, S, C,                 img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done
+                    output = (X, Y, T, S, C,                 img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done)
         else:
             if mode == 'pred':
-                self.batch_data = [X, Y, T, S, None, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id]
-                return     X,    T, S,                    img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done    
+                output = (X,    T, S,                    img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done)
             else:
                 if return_classifications:
-                    return X, Y, T, S,    P, class_names, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done
+                    output = (X, Y, T, S,    P, class_names, img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done)
                 else:
-                    return X, Y, T, S,                    img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done
+                    output = (X, Y, T, S,                    img, img_m_per_px, graph, Pred_agents, num_steps, Sample_id, Agent_id, epoch_done)
+        
+        return output, input_data_type, batch_data
+    
     
     def classify_data(self, Pred, Sample_id, Agent_id):
         r'''
@@ -3359,21 +3618,24 @@ class model_template():
         self.Path_pred = np.zeros((self.num_samples_path_pred, num_samples,
                                    max_num_pred_agents, nto_max, 2), dtype = np.float32)
         
+        # Get the predictions of all agents with useful timesteps at once
         Agents = np.array(self.data_set.Agents)
-        for i in range(num_samples):
-            pred_agents = np.where(self.Pred_step[i].any(-1))[0]
-            
-            # Avoid useless samples 
-            if len(pred_agents) == 0:
-                continue
-
-            pred_agents_id = Agents[i_agent_sort[i, pred_agents]]
-            path_pred_orig = Output_path_pred.loc[Pred_index[i], pred_agents_id]
-            path_pred = np.stack(path_pred_orig.to_numpy(), axis = 1)
-        
-            nto_i = min(Nto_i[i], path_pred.shape[2])
-            # Assign to full length label
-            self.Path_pred[:,i, pred_agents, :nto_i] = path_pred[:,:,:nto_i]
+        pred_samples, pred_agents = np.where(self.Pred_step.any(-1))
+        
+        row_index = Output_path_pred.index.get_indexer(Pred_index[pred_samples])
+        column_index = Output_path_pred.columns.get_indexer(Agents[i_agent_sort[pred_samples, pred_agents]])
+        path_pred_orig = Output_path_pred.to_numpy()[row_index, column_index]
+        
+        if len(path_pred_orig) > 0:
+            # Stack predictions with the same number of timesteps together
+            Nto_pred = np.array([path_pred.shape[1] for path_pred in path_pred_orig])
+            Nto_pred = np.minimum(Nto_i[pred_samples], Nto_pred)
+            for nto_i in np.unique(Nto_pred):
+                use = Nto_pred == nto_i
+                path_pred = np.stack([path_pred[:,:nto_i] for path_pred in path_pred_orig[use]], axis = 1)
+                
+                # Assign to full length label
+                self.Path_pred[:, pred_samples[use], pred_agents[use], :nto_i] = path_pred[...,:2]
         
         # Set missing values to zero
         self.Path_pred[:,~self.Pred_step,:] = 0.0 
@@ -3477,7 +3739,7 @@ class model_template():
                 paths_pred_comp = paths_pred_comp.reshape(-1, num_features)
                 
                 # Evaluate trejatories
-                log_prob_pred = self.data_set.KDE_joint[subgroup][nto].score_samples(paths_pred_comp)
+                log_prob_pred = self.data_set.KDE_scoring.score_samples(self.data_set.KDE_joint[subgroup][nto], paths_pred_comp)
                 self.Log_prob_true_joint_pred[nto_index] = log_prob_pred.reshape(*paths_pred.shape[:2])
             
             
@@ -3554,7 +3816,7 @@ class model_template():
                     # Collapse agents further
                     paths_pred_agent_comp = paths_pred_agent_comp.reshape(-1, num_features)
                     
-                    log_prob_pred_agent = self.data_set.KDE_indep[subgroup][nto][agent].score_samples(paths_pred_agent_comp)
+                    log_prob_pred_agent = self.data_set.KDE_scoring.score_samples(self.data_set.KDE_indep[subgroup][nto][agent], paths_pred_agent_comp)
 
                     self.Log_prob_true_indep_pred[nto_index,:,i_agent_orig] = log_prob_pred_agent.reshape(*paths_pred.shape[:2])
 
@@ -3564,6 +3826,51 @@ class model_template():
     #                           Get KDE_pred(x) and KDE_pred(x_pred)                                    #
     #####################################################################################################
 
+    def _get_KDE_file_index(self, Pred_index):
+        # Get the current file_index
+        if self.data_set.data_in_one_piece:
+            return 0
+        
+        file_indices = self.data_set.Domain.file_index.iloc[Pred_index].to_numpy()
+        assert len(np.unique(file_indices)) == 1, 'All predictions should come from the same file.'
+        return file_indices[0]
+    
+    
+    def _get_KDE_prediction_hash(self, Pred_index):
+        # Get a hash of the evaluated trajectories, which changes if the predictions are changed
+        hasher = hashlib.sha1()
+        
+        # Include the version of the saved format and the scoring settings (e.g., the approximation), 
+        # as they change the saved log likelihoods
+        hasher.update(('KDE_pred_v2--' + self.data_set.KDE_scoring.get_settings_key()).encode())
+        for array in [Pred_index, self.Path_true, self.Path_pred, self.Pred_step]:
+            array = np.ascontiguousarray(array)
+            hasher.update((str(array.shape) + str(array.dtype)).encode())
+            hasher.update(array.view(np.uint8).reshape(-1))
+        
+        return hasher.hexdigest()
+    
+    
+    def _load_KDE_pred_data(self, kde_file, prediction_hash):
+        if (not os.path.isfile(kde_file)) or self.prediction_overwrite:
+            return {}, None
+        
+        kde_saved = np.load(kde_file, allow_pickle = True)
+        [KDE_data, saved_hash, Log_prob_true, Log_prob_pred, _] = kde_saved
+        
+        # If the predictions or the scoring settings changed, the KDE has to be fitted again
+        if saved_hash != prediction_hash:
+            return {}, None
+        
+        return KDE_data, [Log_prob_true, Log_prob_pred]
+    
+    
+    def _save_KDE_pred_data(self, kde_file, prediction_hash, KDE_data, Log_probs):
+        os.makedirs(os.path.dirname(kde_file), exist_ok = True)
+        kde_saved = np.array([KDE_data, prediction_hash, Log_probs[0], Log_probs[1], 0], dtype = object)
+        np.save(kde_file, kde_saved)
+    
+    
     def _get_joint_KDE_pred_probabilities(self, Pred_index, Output_path_pred, exclude_ego = False, get_for_pred_agents = False):
         if hasattr(self, 'Log_prob_joint_pred') and hasattr(self, 'Log_prob_joint_true'):
             if self.excluded_ego_joint == exclude_ego:
@@ -3576,17 +3883,8 @@ class model_template():
             file_addon += 'wo_pov'
         else:
             file_addon += 'wi_pov'
+        file_addon += '_FI_' + str(self._get_KDE_file_index(Pred_index)) + self.data_set.get_KDE_file_addon()
         kde_file = self.data_set.change_result_directory(self.model_file_metric, 'Predictions', file_addon)
-
-        if not hasattr(self, 'exclude_ego_joint'):
-            self.excluded_ego_joint = None
-            
-        if not ((self.excluded_ego_joint == exclude_ego) and hasattr(self, 'KDE_joint_data')):
-            # Load kde data if it exists
-            if os.path.exists(kde_file):
-                self.KDE_joint_data = np.load(kde_file, allow_pickle = True)[0]
-            else:
-                self.KDE_joint_data = {}
             
         # Save last setting 
         self.excluded_ego_joint = exclude_ego
@@ -3595,6 +3893,13 @@ class model_template():
         # Check if dataset has all valuable stuff
         self._transform_predictions_to_numpy(Pred_index, Output_path_pred, exclude_ego, get_for_pred_agents = get_for_pred_agents)
         
+        # Load kde data if it exists and fits the current predictions
+        prediction_hash = self._get_KDE_prediction_hash(Pred_index)
+        self.KDE_joint_data, Log_probs = self._load_KDE_pred_data(kde_file, prediction_hash)
+        if Log_probs is not None:
+            [self.Log_prob_joint_true, self.Log_prob_joint_pred] = Log_probs
+            return
+        
         # get predicted agents
         Pred_agents = self.Pred_step.any(-1)
         
@@ -3611,6 +3916,7 @@ class model_template():
         print('Calculate joint PDF on predicted probabilities.', flush = True)
         for i, subgroup in enumerate(np.unique(Subgroups)):
             print('    Subgroup {:5.0f}/{:5.0f}'.format(i + 1, len(np.unique(Subgroups))), flush = True)
+            timer = self.data_set.KDE_scoring.start_timing('joint_pred', subgroup)
             s_ind = np.where(Subgroups == subgroup)[0]
             
             assert len(np.unique(Pred_agents[s_ind], axis = 0)) == 1
@@ -3689,8 +3995,8 @@ class model_template():
                             kde_all = ROME().fit(paths_pred_comp[test_ind_all], clusters = labels_all)
 
                         # Score samples
-                        log_prob_true = kde_all.score_samples(paths_true_comp)
-                        log_prob_pred = kde_all.score_samples(paths_pred_comp)
+                        log_prob_true = self.data_set.KDE_scoring.score_samples(kde_all, paths_true_comp, len(test_ind_all))
+                        log_prob_pred = self.data_set.KDE_scoring.score_samples(kde_all, paths_pred_comp, len(test_ind_all))
                         
                         # Check if we sufficiently represent predicted distribution
                         print('            ' + str(i))
@@ -3739,18 +4045,20 @@ class model_template():
                     kde_all = ROME().fit(path_pred_comp_train, clusters = cluster_labels)
 
                     # Score samples
-                    log_prob_true = kde_all.score_samples(paths_true_comp)
-                    log_prob_pred = kde_all.score_samples(paths_pred_comp)
+                    log_prob_true = self.data_set.KDE_scoring.score_samples(kde_all, paths_true_comp, len(path_pred_comp_train))
+                    log_prob_pred = self.data_set.KDE_scoring.score_samples(kde_all, paths_pred_comp, len(path_pred_comp_train))
 
 
 
                 self.Log_prob_joint_true[nto_index] = log_prob_true.reshape(*paths_true.shape[:2])
                 self.Log_prob_joint_pred[nto_index] = log_prob_pred.reshape(*paths_pred.shape[:2])
+            
+            self.data_set.KDE_scoring.stop_timing(timer)
         
         # Save the KDE data
         if self.data_set.save_predictions:
-            os.makedirs(os.path.dirname(kde_file), exist_ok = True)
-            np.save(kde_file, np.array([self.KDE_joint_data, 0], dtype = object))
+            self._save_KDE_pred_data(kde_file, prediction_hash, self.KDE_joint_data, 
+                                     [self.Log_prob_joint_true, self.Log_prob_joint_pred])
             
             
     def _get_indep_KDE_pred_probabilities(self, Pred_index, Output_path_pred, exclude_ego = False, get_for_pred_agents = False):
@@ -3761,13 +4069,12 @@ class model_template():
                 
         # Get save file for KDE saving
         file_addon = 'indep_KDE'
+        if exclude_ego:
+            file_addon += 'wo_pov'
+        else:
+            file_addon += 'wi_pov'
+        file_addon += '_FI_' + str(self._get_KDE_file_index(Pred_index)) + self.data_set.get_KDE_file_addon()
         kde_file = self.data_set.change_result_directory(self.model_file_metric, 'Predictions', file_addon)
-        if not hasattr(self, 'KDE_indep_data'):
-            # Load kde data if it exists
-            if os.path.exists(kde_file):
-                self.KDE_indep_data = np.load(kde_file, allow_pickle = True)[0]
-            else:
-                self.KDE_indep_data = {}
         
         # Save last setting 
         self.excluded_ego_indep = exclude_ego
@@ -3776,6 +4083,13 @@ class model_template():
         # Check if dataset has all valuable stuff
         self._transform_predictions_to_numpy(Pred_index, Output_path_pred, exclude_ego, get_for_pred_agents = get_for_pred_agents)
         
+        # Load kde data if it exists and fits the current predictions
+        prediction_hash = self._get_KDE_prediction_hash(Pred_index)
+        self.KDE_indep_data, Log_probs = self._load_KDE_pred_data(kde_file, prediction_hash)
+        if Log_probs is not None:
+            [self.Log_prob_indep_true, self.Log_prob_indep_pred] = Log_probs
+            return
+        
         # get predicted agents
         Pred_agents = self.Pred_step.any(-1)
         
@@ -3793,6 +4107,7 @@ class model_template():
         print('Calculate indep PDF on predicted probabilities.', flush = True)
         for i, subgroup in enumerate(np.unique(Subgroups)):
             print('    Subgroup {:5.0f}/{:5.0f}'.format(i + 1, len(np.unique(Subgroups))), flush = True)
+            timer = self.data_set.KDE_scoring.start_timing('indep_pred', subgroup)
             s_ind = np.where(Subgroups == subgroup)[0]
             
             assert len(np.unique(Pred_agents[s_ind], axis = 0)) == 1
@@ -3887,8 +4202,8 @@ class model_template():
                                 kde_all = ROME().fit(paths_pred_agent_comp[test_ind_all], clusters = labels_all)
 
                             # Score samples
-                            log_prob_true_agent = kde_all.score_samples(paths_true_agent_comp)
-                            log_prob_pred_agent = kde_all.score_samples(paths_pred_agent_comp)
+                            log_prob_true_agent = self.data_set.KDE_scoring.score_samples(kde_all, paths_true_agent_comp, len(test_ind_all))
+                            log_prob_pred_agent = self.data_set.KDE_scoring.score_samples(kde_all, paths_pred_agent_comp, len(test_ind_all))
                             
                             # Check if we sufficiently represent predicted distribution
                             print('            ' + str(i))
@@ -3939,17 +4254,19 @@ class model_template():
                         kde_all = ROME().fit(path_pred_agent_comp_train, clusters = cluster_labels)
 
                         # Score samples
-                        log_prob_true_agent = kde_all.score_samples(paths_true_agent_comp)
-                        log_prob_pred_agent = kde_all.score_samples(paths_pred_agent_comp)
+                        log_prob_true_agent = self.data_set.KDE_scoring.score_samples(kde_all, paths_true_agent_comp, len(path_pred_agent_comp_train))
+                        log_prob_pred_agent = self.data_set.KDE_scoring.score_samples(kde_all, paths_pred_agent_comp, len(path_pred_agent_comp_train))
                             
 
                     self.Log_prob_indep_true[nto_index,:,i_agent_orig] = log_prob_true_agent.reshape(*paths_true.shape[:2])
                     self.Log_prob_indep_pred[nto_index,:,i_agent_orig] = log_prob_pred_agent.reshape(*paths_pred.shape[:2])
+            
+            self.data_set.KDE_scoring.stop_timing(timer)
         
         # Save the KDE data
         if self.data_set.save_predictions:
-            os.makedirs(os.path.dirname(kde_file), exist_ok = True)
-            np.save(kde_file, np.array([self.KDE_indep_data, 0], dtype = object))
+            self._save_KDE_pred_data(kde_file, prediction_hash, self.KDE_indep_data, 
+                                     [self.Log_prob_indep_true, self.Log_prob_indep_pred])
                 
     #%% 
     #########################################################################################
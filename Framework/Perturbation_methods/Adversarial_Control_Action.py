@@ -11,6 +11,7 @@ from Adversarial_classes.helper import Helper
 from Adversarial_classes.loss import Loss
 from Adversarial_classes.plot import Plot
 from Adversarial_classes.smoothing import Smoothing
+from Adversarial_classes.convergence import Convergence
 
 from PIL import Image
 
@@ -155,6 +156,8 @@ class Adversarial_Control_Action(perturbation_template):
             self.name += '---' + str(self.kwargs['barrier_function_future'])
             self.name += '---' + str(self.kwargs['distance_threshold_future'])
             self.name += '---' + str(self.kwargs['log_value_future'])
+        if self.convergence_tolerance is not None:
+            self.name += '---conv' + str(self.convergence_tolerance) + '_' + str(self.convergence_patience)
 
     def initialize_settings(self):
         # Initialize parameters
@@ -183,6 +186,25 @@ class Adversarial_Control_Action(perturbation_template):
             self.alpha = 0.01
             self.kwargs['alpha'] = self.alpha
 
+        # Number of samples optimized together
+        if 'batch_size' in self.kwargs.keys():
+            self.optimization_batch_size = int(self.kwargs['batch_size'])
+        else:
+            self.optimization_batch_size = 5
+
+        # Samples are not optimized further once their loss changes less than the relative tolerance in multiple iterations
+        if 'convergence_tolerance' in self.kwargs.keys():
+            self.convergence_tolerance = self.kwargs['convergence_tolerance']
+        else:
+            self.convergence_tolerance = None
+
+        if 'convergence_patience' in self.kwargs.keys():
+            self.convergence_patience = self.kwargs['convergence_patience']
+        else:
+            self.convergence_patience = 3
+
+        # Iteration times and gradient norms of each optimized batch
+        self.optimization_statistics = []
 
 
         # Car size
@@ -366,10 +388,28 @@ class Adversarial_Control_Action(perturbation_template):
         alpha_acc = self.alpha_acc * torch.ones_like(control_action[:, :, :, 0])
         alpha_curv = self.alpha_curv * torch.ones_like(control_action[:, :, :, 1])
 
+        # Keep track of converged samples, which are not optimized further
+        convergence = Convergence(X.shape[0], self.pert_model.device, self.convergence_tolerance, self.convergence_patience)
+
+        # The perturbation used for the final prediction of each sample
+        perturbation_final = perturbation_storage.clone()
+
         # Start the optimization of the adversarial attack
         for i in range(self.max_number_iterations):
+            if convergence.done:
+                break
+            convergence.start_iteration()
+
+            # Only use the samples that are still optimized
+            index = convergence.get_active_index()
+            index_used = None if convergence.all_active else index
+            (X_i, Y_i, T_i, S_i, C_i, img_i, img_m_per_px_i, graph_i, Pred_agents_i, positions_perturb_i, data_barrier_i, 
+             Y_Pred_iter_1_i, control_action_i, heading_i, velocity_i, alpha_acc_i, alpha_curv_i, 
+             perturbation_storage_i) = Convergence.select(index_used, X, Y, T, S, C, img, img_m_per_px, graph, Pred_agents, positions_perturb, data_barrier,
+                                                          Y_Pred_iter_1, control_action, heading, velocity, alpha_acc, alpha_curv, perturbation_storage)
+
             # Create a tensor for the perturbation
-            perturbation = perturbation_storage.detach().clone()
+            perturbation = perturbation_storage_i.detach().clone()
             perturbation.requires_grad = True
 
             # Reset gradients
@@ -377,31 +417,31 @@ class Adversarial_Control_Action(perturbation_template):
 
             # Calculate updated adversarial position
             adv_position = Control_action.Dynamical_Model(
-                control_action + perturbation, positions_perturb, heading, velocity, self.dt, device=self.pert_model.device)
+                control_action_i + perturbation, positions_perturb_i, heading_i, velocity_i, self.dt, device=self.pert_model.device)
 
             # Split the adversarial position back to X and Y
-            X_new, Y_new = Helper.return_data(adv_position, X, Y, self.future_action_included)
+            X_new, Y_new = Helper.return_data(adv_position, X_i, Y_i, self.future_action_included)
 
             # Forward pass through the model
-            Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T, S=S, C=C, 
-                                                          img=img, img_m_per_px=img_m_per_px, graph = graph,
-                                                          Pred_agents = Pred_agents, num_steps = self.num_steps_predict)
+            Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T_i, S=S_i, C=C_i, 
+                                                          img=img_i, img_m_per_px=img_m_per_px_i, graph = graph_i,
+                                                          Pred_agents = Pred_agents_i, num_steps = self.num_steps_predict)
             # Only use actually predicted target agent
             Y_Pred = Y_Pred[:,0]
 
             assert Y_Pred.shape[-2] == self.num_steps_predict, "The number of predicted steps does not correspond to the number of steps in the model."
 
             if i == 0:
-                # Store the first prediction
+                # Store the first prediction (all samples are optimized in the first iteration)
                 Y_Pred_iter_1 = Y_Pred.detach()
-                Helper
+                Y_Pred_iter_1_i = Y_Pred_iter_1
             
             X_new.retain_grad()
-            losses = self._loss_module(X, X_new, Y, Y_new, Y_Pred, Y_Pred_iter_1, data_barrier, i)
+            losses = self._loss_module(X_i, X_new, Y_i, Y_new, Y_Pred, Y_Pred_iter_1_i, data_barrier_i, i)
 
             print('')
-            max_perturb = np.nanmax(torch.norm(X_new - X, dim = -1).max(-1).values.detach().cpu().numpy(), 1)
-            print('Iteration {}: alpha_m:                          {}'. format(i, alpha_curv[:,0,0].detach().cpu().numpy()), flush = True)
+            max_perturb = np.nanmax(torch.norm(X_new - X_i, dim = -1).max(-1).values.detach().cpu().numpy(), 1)
+            print('Iteration {}: alpha_m:                          {}'. format(i, alpha_curv_i[:,0,0].detach().cpu().numpy()), flush = True)
             print('Iteration {}: Initial max_perturbations [in m]: {}'. format(i, max_perturb), flush = True)
             print('Iteration {}: Initial losses:                   {}'.format(i, losses.detach().cpu().numpy()), flush = True)
 
@@ -415,8 +455,8 @@ class Adversarial_Control_Action(perturbation_template):
             grad[:, :, :, 1].clamp_(-self.epsilon_curv_relative * 20, self.epsilon_curv_relative * 20)
 
             # copy learning rates
-            alpha_acc_iter = alpha_acc.clone()
-            alpha_curv_iter = alpha_curv.clone()
+            alpha_acc_iter = alpha_acc_i.clone()
+            alpha_curv_iter = alpha_curv_i.clone()
 
             inner_loop_count = 0
 
@@ -436,35 +476,35 @@ class Adversarial_Control_Action(perturbation_template):
                     perturbation_new[:, :, :X.shape[2], 1].clamp_(-self.epsilon_curv_relative, self.epsilon_curv_relative)
 
                     # Apply absolute control action limits
-                    control_action_perturbed = control_action + perturbation_new
+                    control_action_perturbed = control_action_i + perturbation_new
                     control_action_perturbed[:, :, :, 0].clamp_(-self.epsilon_acc_absolute, self.epsilon_acc_absolute)
                     control_action_perturbed[:, :, :, 1].clamp_(-self.epsilon_curv_absolute, self.epsilon_curv_absolute)
 
-                    perturbation_new = control_action_perturbed - control_action
+                    perturbation_new = control_action_perturbed - control_action_i
 
                     # only consider target agent
                     perturbation_new[:, 1:] = 0.0
 
                 # Calculate updated adversarial position
                 adv_position = Control_action.Dynamical_Model(
-                    control_action + perturbation_new, positions_perturb, heading, velocity, self.dt, device=self.pert_model.device)
+                    control_action_i + perturbation_new, positions_perturb_i, heading_i, velocity_i, self.dt, device=self.pert_model.device)
 
                 # Split the adversarial position back to X and Y
                 X_new, Y_new = Helper.return_data(
-                    adv_position, X, Y, self.future_action_included)
+                    adv_position, X_i, Y_i, self.future_action_included)
 
-                assert (X.isnan().any(-1).any(-1) == X_new.isnan().any(-1).any(-1)).all(), "Perturbation removed existing trajectories."
+                assert (X_i.isnan().any(-1).any(-1) == X_new.isnan().any(-1).any(-1)).all(), "Perturbation removed existing trajectories."
 
                 # Forward pass through the model
-                Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T, S=S, C=C, 
-                                                              img=img, img_m_per_px=img_m_per_px, graph = graph,
-                                                              Pred_agents = Pred_agents, num_steps = self.num_steps_predict)
+                Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T_i, S=S_i, C=C_i, 
+                                                              img=img_i, img_m_per_px=img_m_per_px_i, graph = graph_i,
+                                                              Pred_agents = Pred_agents_i, num_steps = self.num_steps_predict)
                 # Only use actually predicted target agent
                 Y_Pred = Y_Pred[:,0]
                 
-                losses = self._loss_module(X, X_new, Y, Y_new, Y_Pred, Y_Pred_iter_1, data_barrier, i)
+                losses = self._loss_module(X_i, X_new, Y_i, Y_new, Y_Pred, Y_Pred_iter_1_i, data_barrier_i, i)
                 
-                max_perturb = np.nanmax(torch.norm(X_new - X, dim = -1).max(-1).values.detach().cpu().numpy(), 1)
+                max_perturb = np.nanmax(torch.norm(X_new - X_i, dim = -1).max(-1).values.detach().cpu().numpy(), 1)
                 print('Iteration {}: Perturbation attempt {} - alpha_m:                  {}'. format(i, inner_loop_count, alpha_curv_iter[:,0,0].detach().cpu().numpy()), flush = True) 
                 print('Iteration {}: Perturbation attempt {} - max_perturbations [in m]: {}'. format(i, inner_loop_count, max_perturb), flush = True)
                 print('Iteration {}: Perturbation attempt {} - losses:                   {}'.format(i, inner_loop_count, losses.detach().cpu().numpy()), flush = True)
@@ -484,18 +524,27 @@ class Adversarial_Control_Action(perturbation_template):
                     break
 
             # Get used perturbation
-            perturbation_storage = perturbation_new.detach().clone()
+            perturbation_storage[index] = perturbation_new.detach().clone()
+            perturbation_final[index] = perturbation.detach()
 
-            # Store the loss for plot
-            loss_store.append(losses.detach().cpu().numpy())
+            # Store the loss for plot (np.nan for samples that are not optimized anymore)
+            loss_full = np.full(X.shape[0], np.nan, dtype = np.float32)
+            loss_full[index.cpu().numpy()] = losses.detach().cpu().numpy()
+            loss_store.append(loss_full)
 
             # Update the step size
             alpha_acc  *= self.gamma
             alpha_curv *= self.gamma
 
+            # Record the instrumentation and remove converged samples
+            convergence.end_iteration(index, losses, grad)
+
+        self.optimization_statistics.append(convergence.get_statistics())
+        convergence.print_summary()
+
         # Calculate the final adversarial position
         adv_position = Control_action.Dynamical_Model(
-            control_action + perturbation, positions_perturb, heading, velocity, self.dt, device=self.pert_model.device)
+            control_action + perturbation_final, positions_perturb, heading, velocity, self.dt, device=self.pert_model.device)
 
         # Split the adversarial position back to X and Y
         X_new, Y_new = Helper.return_data(
@@ -758,7 +807,7 @@ class Adversarial_Control_Action(perturbation_template):
 
         '''
 
-        self.batch_size = 5
+        self.batch_size = self.optimization_batch_size
 
     def get_constraints(self):
         '''
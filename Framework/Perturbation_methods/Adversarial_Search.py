@@ -10,6 +10,7 @@ from Adversarial_classes.helper import Helper
 from Adversarial_classes.loss import Loss
 from Adversarial_classes.plot import Plot
 from Adversarial_classes.search import Search
+from Adversarial_classes.convergence import Convergence
 
 from PIL import Image
 
@@ -156,6 +157,8 @@ class Adversarial_Search(perturbation_template):
             self.name += '---' + str(kwargs['barrier_function_future'])
             self.name += '---' + str(kwargs['distance_threshold_future'])
             self.name += '---' + str(kwargs['log_value_future'])
+        if self.convergence_tolerance is not None:
+            self.name += '---conv' + str(self.convergence_tolerance) + '_' + str(self.convergence_patience)
 
     def initialize_settings(self):        # Initialize parameters
         if 'num_samples_perturb' in self.kwargs.keys():
@@ -183,6 +186,25 @@ class Adversarial_Search(perturbation_template):
             self.alpha = 0.01
             self.kwargs['alpha'] = self.alpha
 
+        # Number of samples optimized together
+        if 'batch_size' in self.kwargs.keys():
+            self.optimization_batch_size = int(self.kwargs['batch_size'])
+        else:
+            self.optimization_batch_size = 5
+
+        # Samples are not optimized further once their loss changes less than the relative tolerance in multiple iterations
+        if 'convergence_tolerance' in self.kwargs.keys():
+            self.convergence_tolerance = self.kwargs['convergence_tolerance']
+        else:
+            self.convergence_tolerance = None
+
+        if 'convergence_patience' in self.kwargs.keys():
+            self.convergence_patience = self.kwargs['convergence_patience']
+        else:
+            self.convergence_patience = 3
+
+        # Iteration times and gradient norms of each optimized batch
+        self.optimization_statistics = []
 
 
         # Car size
@@ -349,27 +371,44 @@ class Adversarial_Search(perturbation_template):
         # learning rate
         alpha = self.alpha * torch.ones_like(positions_perturb)
 
+        # Keep track of converged samples, which are not optimized further
+        convergence = Convergence(X.shape[0], self.pert_model.device, self.convergence_tolerance, self.convergence_patience)
+
+        # The perturbation used for the final prediction of each sample
+        perturbation_final = perturbation_storage.clone()
+
         # Start the optimization of the adversarial attack
         for i in range(self.max_number_iterations):
+            if convergence.done:
+                break
+            convergence.start_iteration()
+
+            # Only use the samples that are still optimized
+            index = convergence.get_active_index()
+            index_used = None if convergence.all_active else index
+            (X_i, Y_i, T_i, S_i, C_i, img_i, img_m_per_px_i, graph_i, Pred_agents_i, positions_perturb_i,
+             data_barrier_i, Y_Pred_iter_1_i, alpha_i, perturbation_storage_i) = Convergence.select(index_used, X, Y, T, S, C, img, img_m_per_px, graph, Pred_agents,
+                                                                                                   positions_perturb, data_barrier, Y_Pred_iter_1, alpha, perturbation_storage)
+
             # Create a tensor for the perturbation
-            perturbation = perturbation_storage.detach().clone()
+            perturbation = perturbation_storage_i.detach().clone()
             perturbation.requires_grad = True
 
             # Reset gradients
             perturbation.grad = None
 
             # Process the perturbations
-            perturbation_new = Search.hard_constraint(positions_perturb=positions_perturb, perturbation_tensor=perturbation, ego_agent_index=self.ego_agent_index,
+            perturbation_new = Search.hard_constraint(positions_perturb=positions_perturb_i, perturbation_tensor=perturbation, ego_agent_index=self.ego_agent_index,
                                                       tar_agent_index=self.tar_agent_index, hard_bound=self.distance_threshold_past, physical_bounds=self.physical_bounds, dt=self.dt, device=self.pert_model.device)
 
             # Split the adversarial position back to X and Y
             X_new, Y_new = Helper.return_data(
-                positions_perturb + perturbation_new, X, Y, self.future_action_included)
+                positions_perturb_i + perturbation_new, X_i, Y_i, self.future_action_included)
 
             # Forward pass through the model
-            Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T, S=S, C=C, 
-                                                          img=img, img_m_per_px=img_m_per_px, graph = graph,
-                                                          Pred_agents = Pred_agents, num_steps = self.num_steps_predict)
+            Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T_i, S=S_i, C=C_i, 
+                                                          img=img_i, img_m_per_px=img_m_per_px_i, graph = graph_i,
+                                                          Pred_agents = Pred_agents_i, num_steps = self.num_steps_predict)
             # Only use actually predicted target agent
             Y_Pred = Y_Pred[:,0]
 
@@ -377,11 +416,12 @@ class Adversarial_Search(perturbation_template):
                 # check conversion
                 # Helper.check_conversion(adv_position, positions_perturb)
 
-                # Store the first prediction
+                # Store the first prediction (all samples are optimized in the first iteration)
                 Y_Pred_iter_1 = Y_Pred.detach()
+                Y_Pred_iter_1_i = Y_Pred_iter_1
 
             losses = self._loss_module(
-                X, X_new, Y, Y_new, Y_Pred, Y_Pred_iter_1, data_barrier, i)
+                X_i, X_new, Y_i, Y_new, Y_Pred, Y_Pred_iter_1_i, data_barrier_i, i)
 
             print(losses)
 
@@ -395,27 +435,28 @@ class Adversarial_Search(perturbation_template):
             inner_loop_count = 0
 
             while True:
+                inner_loop_count += 1
             # Update Control inputs
                 with torch.no_grad():
                     perturbation_new = perturbation.clone()
-                    perturbation_new.subtract_(grad * alpha)
+                    perturbation_new.subtract_(grad * alpha_i)
 
                     # set perturbations of ego agent to zero
                     perturbation_new[:, 1:] = 0.0
 
                 # Split the adversarial position back to X and Y
                 X_new, Y_new = Helper.return_data(
-                    positions_perturb + perturbation_new, X, Y, self.future_action_included)
+                    positions_perturb_i + perturbation_new, X_i, Y_i, self.future_action_included)
                 
                 # Forward pass through the model
-                Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T, S=S, C=C, 
-                                                              img=img, img_m_per_px=img_m_per_px, graph = graph,
-                                                              Pred_agents = Pred_agents, num_steps = self.num_steps_predict)
+                Y_Pred = self.pert_model.predict_batch_tensor(X=X_new, T=T_i, S=S_i, C=C_i, 
+                                                              img=img_i, img_m_per_px=img_m_per_px_i, graph = graph_i,
+                                                              Pred_agents = Pred_agents_i, num_steps = self.num_steps_predict)
                 # Only use actually predicted target agent
                 Y_Pred = Y_Pred[:,0]
 
                 losses = self._loss_module(
-                    X, X_new, Y, Y_new, Y_Pred, Y_Pred_iter_1, data_barrier, i)
+                    X_i, X_new, Y_i, Y_new, Y_Pred, Y_Pred_iter_1_i, data_barrier_i, i)
                 
                 print(losses)
 
@@ -425,24 +466,35 @@ class Adversarial_Search(perturbation_template):
                     # check if agent crashes replace tensor with zero tensor
                     if inner_loop_count >= 20:
                         # perturbation_new[invalid_mask] = torch.zeros_like(perturbation_new[invalid_mask])
-                        perturbation_new[invalid_mask] = perturbation_storage[invalid_mask].clone()
-                        perturbation_storage = perturbation_new.detach().clone()
+                        perturbation_new[invalid_mask] = perturbation_storage_i[invalid_mask].clone()
                         break
                     # Half the learning rate only for samples with NaN losses
-                    alpha[invalid_mask] *= 0.5
+                    alpha_i[invalid_mask] *= 0.5
                     continue  # Skip this iteration and try again with reduced learning rate for NaN samples
                 else:
-                    perturbation_storage = perturbation_new.detach().clone()
                     break
 
-            # Store the loss for plot
-            loss_store.append(losses.detach().cpu().numpy())
+            # Write the results of the optimized samples back
+            perturbation_storage[index] = perturbation_new.detach().clone()
+            perturbation_final[index] = perturbation.detach()
+            alpha[index] = alpha_i
+
+            # Store the loss for plot (np.nan for samples that are not optimized anymore)
+            loss_full = np.full(X.shape[0], np.nan, dtype = np.float32)
+            loss_full[index.cpu().numpy()] = losses.detach().cpu().numpy()
+            loss_store.append(loss_full)
 
             # Update the step size
             alpha *= self.gamma
 
+            # Record the instrumentation and remove converged samples
+            convergence.end_iteration(index, losses, grad)
+
+        self.optimization_statistics.append(convergence.get_statistics())
+        convergence.print_summary()
+
         # Create a tensor for the perturbation
-        perturbation_storage = Search.hard_constraint(positions_perturb=positions_perturb, perturbation_tensor=perturbation, ego_agent_index=self.ego_agent_index,
+        perturbation_storage = Search.hard_constraint(positions_perturb=positions_perturb, perturbation_tensor=perturbation_final, ego_agent_index=self.ego_agent_index,
                                                       tar_agent_index=self.tar_agent_index, hard_bound=self.distance_threshold_past, physical_bounds=self.physical_bounds, dt=self.dt, device=self.pert_model.device)
 
         # Split the adversarial position back to X and Y
@@ -661,7 +713,7 @@ class Adversarial_Search(perturbation_template):
 
         '''
 
-        self.batch_size = 5
+        self.batch_size = self.optimization_batch_size
     
     def get_constraints(self):
         '''
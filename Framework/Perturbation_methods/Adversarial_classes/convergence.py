@@ -0,0 +1,137 @@
+import time
+import numpy as np
+import torch
+
+
+class Convergence:
+    def __init__(self, num_samples, device, tolerance=None, patience=3):
+        """
+        Keeps track of which samples in a batch are still optimized during the adversarial attack,
+        and records the duration, gradient norms and number of optimized samples of each iteration.
+
+        Args:
+            num_samples (int): The number of samples in the batch.
+            device (torch.device): The device on which the optimization is performed.
+            tolerance (float): The relative change of a sample's loss below which an iteration counts as converged.
+                               If None, all samples are optimized for the full number of iterations.
+            patience (int): The number of consecutive converged iterations after which a sample is removed.
+        """
+        self.num_samples = num_samples
+        self.device = device
+        self.tolerance = tolerance
+        self.patience = max(1, int(patience))
+
+        self.active = torch.ones(num_samples, dtype=torch.bool, device=device)
+        self.loss_old = torch.full((num_samples,), np.nan, device=device)
+        self.num_converged = torch.zeros(num_samples, dtype=torch.int64, device=device)
+        self.num_iterations = np.zeros(num_samples, int)
+
+        # Instrumentation
+        self.iteration_time = []
+        self.grad_norm = []
+        self.num_active = []
+
+        self.t_start = None
+
+    @property
+    def done(self):
+        return not bool(self.active.any())
+
+    @property
+    def all_active(self):
+        return bool(self.active.all())
+
+    def get_active_index(self):
+        """
+        Returns the indices of the samples that are still optimized.
+
+        Returns:
+            torch.Tensor: The indices of the active samples on the optimization device.
+        """
+        return torch.where(self.active)[0]
+
+    @staticmethod
+    def select(index, *Data):
+        """
+        Selects the given samples from tensors and numpy arrays (other values, such as None, are returned unchanged).
+
+        Args:
+            index (torch.Tensor): The indices of the selected samples. If None, all samples are used.
+            Data: Tensors and arrays with the samples in the first dimension.
+
+        Returns:
+            list: The selected parts of the given data.
+        """
+        if index is None:
+            return list(Data)
+
+        index_np = index.cpu().numpy()
+        Selected = []
+        for data in Data:
+            if isinstance(data, torch.Tensor):
+                Selected.append(data[index.to(data.device)])
+            elif isinstance(data, np.ndarray):
+                Selected.append(data[index_np])
+            else:
+                Selected.append(data)
+        return Selected
+
+    def start_iteration(self):
+        self.t_start = time.time()
+
+    def end_iteration(self, index, losses, grad):
+        """
+        Records the instrumentation of the current iteration, and removes converged samples.
+
+        Args:
+            index (torch.Tensor): The indices of the samples optimized in this iteration.
+            losses (torch.Tensor): The losses of those samples after the update, with shape (number optimized samples).
+            grad (torch.Tensor): The gradients of those samples, with the optimized samples in the first dimension.
+        """
+        losses = losses.detach()
+        grad_norm = torch.nan_to_num(grad.detach()).flatten(1).norm(dim=1)
+
+        grad_norm_full = np.full(self.num_samples, np.nan)
+        grad_norm_full[index.cpu().numpy()] = grad_norm.cpu().numpy()
+        self.grad_norm.append(grad_norm_full)
+        self.num_active.append(len(index))
+        self.num_iterations[index.cpu().numpy()] += 1
+
+        if self.tolerance is not None:
+            # An iteration counts as converged if the loss changes by less than the relative tolerance
+            loss_old = self.loss_old[index]
+            change = (losses - loss_old).abs()
+            converged = change <= self.tolerance * loss_old.abs().clamp(min=1e-6)
+
+            self.num_converged[index] = torch.where(converged, self.num_converged[index] + 1, torch.zeros_like(self.num_converged[index]))
+            self.loss_old[index] = losses
+            self.active[index] = self.num_converged[index] < self.patience
+
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.iteration_time.append(time.time() - self.t_start)
+
+    def get_statistics(self):
+        """
+        Returns the recorded instrumentation.
+
+        Returns:
+            dict: A dictionary containing:
+                - iteration_time: The duration of each iteration (in seconds).
+                - grad_norm: The gradient norm of each sample in each iteration (np.nan if not optimized),
+                             with shape (number iterations, number samples).
+                - num_active: The number of optimized samples in each iteration.
+                - num_iterations: The number of iterations each sample was optimized for.
+        """
+        return {'iteration_time': np.array(self.iteration_time),
+                'grad_norm': np.array(self.grad_norm).reshape(-1, self.num_samples),
+                'num_active': np.array(self.num_active, int),
+                'num_iterations': self.num_iterations.copy()}
+
+    def print_summary(self):
+        statistics = self.get_statistics()
+        total_time = statistics['iteration_time'].sum()
+        num_iterations = len(statistics['iteration_time'])
+        print('Optimized {} samples in {} iterations ({:0.2f}s, {:0.3f}s per iteration); '.format(self.num_samples, num_iterations, total_time,
+                                                                                               total_time / max(num_iterations, 1)) +
+              'average number of iterations per sample: {:0.1f}'.format(statistics['num_iterations'].mean()), flush=True)
@@ -78,36 +78,15 @@ class perturbation_template():
         S = np.stack(S.tolist())
 
         # Get length of future data
-        N_O = np.zeros(len(Output_T), int)
-        for i_sample in range(Output_T.shape[0]):
-            if 'dt' in requirements.keys():
-                assert np.all(np.abs(np.diff(Input_T[i_sample]) - requirements['dt']) < 1e-3), "The input time steps are not constant."
-                assert np.all(np.abs(np.diff(Output_T[i_sample]) - requirements['dt']) < 1e-3), "The output time steps are not constant."
-
-            N_O[i_sample] = len(Output_T[i_sample])
-
-
-        X = np.ones(list(Input_path.shape) + [data.num_timesteps_in_real, 2], dtype = np.float32) * np.nan
-        Y = np.ones(list(Output_path.shape) + [N_O.max(), 2], dtype = np.float32) * np.nan
+        N_O = np.fromiter((len(output_t) for output_t in Output_T), int, len(Output_T))
         
-        # Extract data from original number a samples
-        for i_sample, i_index in enumerate(Input_path.index):
-            for i_agent, agent in enumerate(Agents):
-                # Check if the named agent actually exists
-                if not isinstance(Input_path.loc[i_index, agent], float):    
-                    n_time = N_O[i_sample]
-
-                    if 'n_I_max' in requirements.keys():
-                        assert len(Input_path.loc[i_index, agent]) <= requirements['n_I_max'], "The number of input timesteps is too large."
-                    if 'n_I_min' in requirements.keys():
-                        assert len(Input_path.loc[i_index, agent]) >= requirements['n_I_min'], "The number of input timesteps is too small."
-                    if 'n_O_max' in requirements.keys():
-                        assert n_time <= requirements['n_O_max'], "The number of output timesteps is too large."
-                    if 'n_O_min' in requirements.keys():
-                        assert n_time >= requirements['n_O_min'], "The number of output timesteps is too small."
-
-                    X[i_sample, i_agent]          = Input_path.loc[i_index, agent].astype(np.float32)[...,:2]
-                    Y[i_sample, i_agent, :n_time] = Output_path.loc[i_index, agent][:n_time].astype(np.float32)[...,:2]
+        # Transform the paths into dense arrays
+        X, Input_length = self._path_frame_to_array(Input_path, data.num_timesteps_in_real)
+        Y, _ = self._path_frame_to_array(Output_path, N_O.max(), N_O)
+        
+        # Check the requirements for all samples at once
+        self._check_requirements(requirements, Input_T, Output_T, Input_length, N_O)
+        assert (Input_length[Input_length > 0] == data.num_timesteps_in_real).all(), "The number of input timesteps is inconsistent."
 
         # Get the batch size
         self.set_batch_size()
@@ -157,12 +136,142 @@ class perturbation_template():
 
         # Go through the data 
         num_batches = int(np.ceil(X.shape[0] / self.batch_size))
-        for i_batch in range(num_batches):
+        Batches = self._iterate_batches(X_sort, Y_sort, T_sort, S_sort, Domain_sort, Agents, pred_agents)
+        for i_batch, (samples, X_batch, Y_batch, T_batch, S_batch, C, img, img_m_per_px, graph) in enumerate(Batches):
             print(f'Perturbing batch {i_batch + 1}/{num_batches}', flush = True)
+
+            # self.perturb_batch has to provide: X, Y, T, S, C, img, img_m_per_px, graph, Pred_agents, num_steps
+            X_pert_sort[samples], Y_pert_sort[samples] = self.perturb_batch(X_batch, Y_batch, T_batch, S_batch, C,
+                                                                            img, img_m_per_px, graph, Agents)
+
+
+        sort_indices_inverse = np.argsort(sorted_indices)
+        X_pert = X_pert_sort[sort_indices_inverse]
+        Y_pert = Y_pert_sort[sort_indices_inverse]
+
+        # Get the additional required information.
+        data_type = data.path_data_info()
+        X_pert, Y_pert = self.extend_postion_data(X_pert, Y_pert, dt, data_type)
+        
+        # Add unperturberd input and output columns to Domain
+        Domain['Unperturbed_input']  = [input_i.copy() for _, input_i in Input_path.iterrows()]
+        Domain['Unperturbed_output'] = [output_i.copy() for _, output_i in Output_path.iterrows()]
+
+        # Overwrite Input_path and Output_path with the perturbed data
+        Input_path  = self._array_to_path_frame(Input_path, X_pert)
+        Output_path = self._array_to_path_frame(Output_path, Y_pert)
+        
+        # Save changes to data object
+        data.Input_path = Input_path
+        data.Output_path = Output_path
+        data.Domain = Domain
+        return data
+    
+    
+    def _path_frame_to_array(self, Path, num_timesteps, N_steps = None):
+        r'''
+        Transforms a pandas.DataFrame of trajectories into a dense array, by stacking all 
+        trajectories of the same length at once.
+
+        Parameters
+        ----------
+        Path : pandas.DataFrame
+            The trajectories, with one numpy array of shape :math:`\{N_{steps} \times N_{data}\}` per existing agent.
+        num_timesteps : int
+            The number of timesteps in the returned array.
+        N_steps : np.ndarray, optional
+            The number of timesteps that are used in each sample. If None, all timesteps are used.
+
+        Returns
+        -------
+        P : np.ndarray
+            The positions, as a float32 array of shape :math:`\{N_{samples} \times N_{agents} \times num_{timesteps} \times 2\}`.
+        Length : np.ndarray
+            The original number of timesteps of each trajectory, as an int array of shape
+            :math:`\{N_{samples} \times N_{agents}\}`, which is 0 for missing agents.
+        '''
+        Values = Path.to_numpy()
+        P = np.full(list(Values.shape) + [num_timesteps, 2], np.nan, dtype = np.float32)
+        Length = np.zeros(Values.shape, int)
+
+        # Find the existing agents
+        exists = np.array([not isinstance(value, float) for value in Values.flat], bool).reshape(Values.shape)
+        samples, agents = np.where(exists)
+        if len(samples) == 0:
+            return P, Length
+
+        Length[samples, agents] = np.fromiter((len(value) for value in Values[samples, agents]), int, len(samples))
+
+        for length in np.unique(Length[samples, agents]):
+            use = Length[samples, agents] == length
+            samples_use, agents_use = samples[use], agents[use]
+
+            paths = np.stack(Values[samples_use, agents_use].tolist(), 0)[..., :2].astype(np.float32)
+            n_steps = min(length, num_timesteps)
+            paths = paths[:, :n_steps]
+
+            if N_steps is not None:
+                # Remove the timesteps after the end of the respective sample
+                late = np.arange(n_steps)[np.newaxis] >= N_steps[samples_use, np.newaxis]
+                paths[late] = np.nan
+
+            P[samples_use, agents_use, :n_steps] = paths
+        return P, Length
+    
+    
+    def _check_requirements(self, requirements, Input_T, Output_T, Input_length, N_O):
+        # Check the requirements of the perturbation method for all samples at once
+        if 'dt' in requirements.keys():
+            for Time, name in [(Input_T, 'input'), (Output_T, 'output')]:
+                Lengths = np.fromiter((len(t) for t in Time), int, len(Time))
+                if Lengths.sum() == 0:
+                    continue
+                dt_all = np.diff(np.concatenate(list(Time)))
+
+                # Ignore the differences between consecutive samples
+                within_sample = np.ones(len(dt_all), bool)
+                within_sample[np.cumsum(Lengths)[:-1] - 1] = False
+
+                assert np.all(np.abs(dt_all[within_sample] - requirements['dt']) < 1e-3), "The " + name + " time steps are not constant."
+
+        # Only samples with existing agents are checked
+        exists = Input_length > 0
+        if 'n_I_max' in requirements.keys():
+            assert (Input_length[exists] <= requirements['n_I_max']).all(), "The number of input timesteps is too large."
+        if 'n_I_min' in requirements.keys():
+            assert (Input_length[exists] >= requirements['n_I_min']).all(), "The number of input timesteps is too small."
+
+        N_O_used = N_O[exists.any(1)]
+        if 'n_O_max' in requirements.keys():
+            assert (N_O_used <= requirements['n_O_max']).all(), "The number of output timesteps is too large."
+        if 'n_O_min' in requirements.keys():
+            assert (N_O_used >= requirements['n_O_min']).all(), "The number of output timesteps is too small."
+    
+    
+    def _array_to_path_frame(self, Path, P):
+        # Write the trajectories of existing agents in the dense array P into a copy of the DataFrame Path
+        Values = Path.to_numpy().copy()
+        exists = np.array([not isinstance(value, float) for value in Values.flat], bool).reshape(Values.shape)
+        samples, agents = np.where(exists)
+
+        # Add a helper entry, so that numpy does not try to stack the arrays
+        Values[samples, agents] = np.array(list(P[samples, agents]) + ['helper'], dtype = object)[:-1]
+        return pd.DataFrame(Values, index = Path.index, columns = Path.columns)
+    
+    
+    def _iterate_batches(self, X_sort, Y_sort, T_sort, S_sort, Domain_sort, Agents, pred_agents):
+        r'''
+        Yields the batches given to *self.perturb_batch()*, where the images, scene graphs, and categories
+        are only extracted for the current batch.
+        '''
+        data = self.data
+        num_batches = int(np.ceil(X_sort.shape[0] / self.batch_size))
+        for i_batch in range(num_batches):
             i_start = i_batch * self.batch_size
-            i_end = min((i_batch + 1) * self.batch_size, X.shape[0])
+            i_end = min((i_batch + 1) * self.batch_size, X_sort.shape[0])
 
             samples = np.arange(i_start, i_end)
+            X_batch = X_sort[samples]
 
             # Predagents are the predefined agents
             Pred_agents = np.tile(pred_agents[np.newaxis], (len(samples), 1))
@@ -173,15 +282,10 @@ class perturbation_template():
                 domain_needed = Domain_sort.iloc[samples[np.where(Img_needed)[0]]]
 
                 # Only use the input positions
-                X_needed = X_sort[samples][Img_needed]
+                X_needed = X_batch[Img_needed]
                 centre = X_needed[:, -1,:].copy()
                 x_rel = centre - X_needed[:, -2,:]
                 rot = np.angle(x_rel[:,0] + 1j * x_rel[:,1]) 
-
-                if hasattr(self, 'use_batch_extraction') and self.use_batch_extraction:
-                    print_progress = False
-                else:
-                    print_progress = True
                 
                 if self.pert_model.grayscale:
                     img_needed = np.zeros((X_needed.shape[0], self.pert_model.target_height, self.pert_model.target_width, 1), dtype = np.uint8)
@@ -194,7 +298,7 @@ class perturbation_template():
                                                       Imgs_rot = img_needed,
                                                       Imgs_index = np.arange(X_needed.shape[0]),
                                                       print_progress = False)
-                img_m_per_px_needed = data.Images.Target_MeterPerPx.loc[domain_needed.image_id.iloc[Use]]
+                img_m_per_px_needed = data.Images.Target_MeterPerPx.loc[domain_needed.image_id].to_numpy()
 
                 img = np.zeros((len(samples), X_sort.shape[1], *img_needed.shape[1:]), dtype = np.uint8)
                 img_m_per_px = np.zeros((len(samples), X_sort.shape[1]), dtype = np.float32)
@@ -205,7 +309,7 @@ class perturbation_template():
                 img_m_per_px = None
             
             if data.includes_sceneGraphs() and hasattr(self, 'pert_model') and self.pert_model.can_use_graph:
-                X_last_all = X_sort[samples][...,-1,:2].copy() # num_samples x num_agents x 2
+                X_last_all = X_batch[...,-1,:2].copy() # num_samples x num_agents x 2
                 X_last_all[~Pred_agents] = np.nan
                 if hasattr(self.pert_model, 'sceneGraph_radius'):
                     radius = self.pert_model.sceneGraph_radius
@@ -219,12 +323,11 @@ class perturbation_template():
                     
                 graph = np.full(len(samples), np.nan, dtype = object)
                 graph = data.return_batch_sceneGraphs(Domain_sort.iloc[samples], X_last_all, radius, wave_length, graph, np.arange(len(samples)), print_progress = False)
-                pass # TODO
             else:
                 graph = None
 
             # get categories
-            if 'category' in Domain.columns:
+            if 'category' in Domain_sort.columns:
                 C = Domain_sort.iloc[samples].category
                 C = pd.DataFrame(C.to_list())
 
@@ -239,45 +342,9 @@ class perturbation_template():
             else:
                 C = None
 
-            # self.perturb_batch has to provide: X, Y, T, S, C, img, img_m_per_px, graph, Pred_agents, num_steps
-            X_pert_sort[samples], Y_pert_sort[samples] = self.perturb_batch(X_sort[samples], Y_sort[samples], T_sort[samples], S_sort[samples], C,
-                                                                            img, img_m_per_px, graph, Agents)
+            yield samples, X_batch, Y_sort[samples], T_sort[samples], S_sort[samples], C, img, img_m_per_px, graph
 
 
-        sort_indices_inverse = np.argsort(sorted_indices)
-        X_pert = X_pert_sort[sort_indices_inverse]
-        Y_pert = Y_pert_sort[sort_indices_inverse]
-
-        # Get the additional required information.
-        data_type = data.path_data_info()
-        X_pert, Y_pert = self.extend_postion_data(X_pert, Y_pert, dt, data_type)
-        
-        # Add unperturberd input and output columns to Domain
-        Domain['Unperturbed_input'] = None
-        Domain['Unperturbed_output'] = None
-
-        # Write the unperturbed data into new columns in domain and overwrite Input_path and Output_path with the perturbed data
-        for i_sample, i_index in enumerate(Input_path.index):
-            # Save the unperturbed data
-            input_i = Input_path.loc[i_index].copy()
-            output_i = Output_path.loc[i_index].copy()
-
-            Domain.Unperturbed_input.loc[i_index] = [input_i]
-            Domain.Unperturbed_output.loc[i_index] = [output_i]
-
-            # Overwrite data with
-            for i_agent, agent in enumerate(Agents):
-                if not isinstance(Input_path.loc[i_index, agent], float):
-                    Input_path.loc[i_index, agent]  = X_pert[i_sample, i_agent]
-                    Output_path.loc[i_index, agent] = Y_pert[i_sample, i_agent]
-        
-        # Save changes to data object
-        data.Input_path = Input_path
-        data.Output_path = Output_path
-        data.Domain = Domain
-        return data
-    
-    
     def get_nan_gradient(self, F, axis = -1):
         '''
         This function calculates the gradient of a numpy array, while ignoring NaN values.
@@ -336,7 +336,8 @@ class splitting_template():
 
         data_set.set_extraction_parameters(perturbed_dataset.t0_type, 
                                            perturbed_dataset.T0_type_compare, 
-                                           perturbed_dataset.max_num_agents)
+                                           perturbed_dataset.max_num_agents,
+                                           perturbed_dataset.num_extraction_workers)
 
         # Get data for unperturbed dataset
         data_set.get_data(perturbed_dataset.dt,
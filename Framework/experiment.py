@@ -11,9 +11,14 @@ from matplotlib.collections import LineCollection
 import matplotlib
 from matplotlib.colors import LinearSegmentedColormap
 import time
+import hashlib
+import functools
+import multiprocessing
 import seaborn as sns
 from pathlib import Path
 from utils.memory_utils import get_total_memory, get_used_memory
+from utils.job_scheduler_utils import job_ledger, model_job, job_scheduler
+from utils.results_index_utils import results_index, get_results_index_file, get_configuration_key
 
 # allow for latex code
 # from matplotlib import rc
@@ -300,6 +305,9 @@ class Experiment():
         print('with dt = ' + '{:0.2f}'.format(max(0, min(9.99, data_param['dt']))).zfill(4) + 
               ' and n_I = {}->{}'.format(*n_I) + ' ({}/{})'.format(j + 1, self.num_data_params), flush = True)
         
+        if data_set.kde_tolerance is not None:
+            print('with KDEs approximated with a tolerance of {:g}'.format(data_set.kde_tolerance), flush = True)
+        
         if data_set.classification_useful:
             sample_string = ''
             for beh in data_set.Behaviors:
@@ -359,10 +367,74 @@ class Experiment():
                   'This might require the training of a transformation model.', flush = True)
             
 
-    def run(self):
+    def _get_model_job(self, model_class, model_kwargs, data_set, splitter, model, memory_per_job):
+        # The key includes the used metrics, so that adding metrics leads to a rerun
+        metric_hash = hashlib.md5(str(self.Metrics).encode()).hexdigest()[:8]
+        key = model.model_file + '--' + metric_hash
+
+        # Get the reserved memory
+        if 'memory_reservation' in model_kwargs:
+            memory = model_kwargs['memory_reservation'] * 2 ** 30
+        else:
+            memory = memory_per_job
+
+        uses_gpu = model.requires_torch_gpu() and model.device.type == 'cuda'
+
+        # Create the model used for training only within the worker (the model in the parent process
+        # does not initialize cuda, see model_template.set_torch_device())
+        create_model = functools.partial(model_class, model_kwargs, data_set, splitter, self.evaluate_on_train_set)
+
+        description = model.get_name()['print'] + ' (' + data_set.get_name()['print'] + ', ' + splitter.get_name()['print'] + ')'
+        return model_job(key, create_model, memory, uses_gpu, description)
+
+
+    def run(self, num_workers = 1, memory_per_job = None, jobs_per_gpu = 1):
+        r'''
+        Train and evaluate all models on all datasets and splits.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            The number of models that are trained and evaluated at the same time. If larger than one,
+            each dataset and split is prepared once, and the models are then run in forked worker processes.
+            The status of each model is kept in a ledger in the *Results* folder, so that a rerun of an
+            interrupted experiment skips allready finished models (unless overwrite_results is set in
+            *set_parameters()*). The default is 1.
+        memory_per_job : float, optional
+            The memory (in GB) reserved for each model, which can be overwritten for single models
+            with the model kwarg 'memory_reservation'. Jobs are only started if their reservations fit into
+            the available memory. The default is None, in which case the memory is split evenly between workers.
+        jobs_per_gpu : int, optional
+            The number of models that can share one gpu. The default is 1.
+
+        '''
         assert self.provided_modules, "No modules have been provided. Run self.set_modules() first."
         assert self.provided_setting, "No parameters have been provided. Run self.set_parameters() first."
 
+        parallel = num_workers > 1
+        if parallel and 'fork' not in multiprocessing.get_all_start_methods():
+            warnings.warn("Forked processes are not available on this system, so the models are run sequentially.")
+            parallel = False
+
+        if parallel:
+            available_memory = max(self.total_memory - get_used_memory(), 100 * 2 ** 20)
+            if memory_per_job is None:
+                memory_per_job = available_memory / num_workers
+            else:
+                memory_per_job = memory_per_job * 2 ** 30
+
+            ledger_file = self.path + os.sep + 'Results' + os.sep + 'Job_ledger--' + self.Experiment_name + '.json'
+            num_gpus = torch.cuda.device_count() if torch.cuda.is_available() else 0
+
+            # Cuda cannot be used in forked processes if it was initialized in this process
+            # (which is checked again by the scheduler before starting each job)
+            scheduler = job_scheduler(job_ledger(ledger_file), num_workers, available_memory, num_gpus, jobs_per_gpu,
+                                      fork_gpu_jobs = not torch.cuda.is_initialized())
+            Failed_jobs = []
+
+        # Get the experiment level index, in which the result files of each setting are saved
+        Results_index = results_index(get_results_index_file(self.path))
+
         print('Starting the running of the benchmark', flush = True)
         for i, data_set_dict in enumerate(self.Data_sets):
             # Get data set class
@@ -409,6 +481,7 @@ class Experiment():
                     
                     # Use splitting method to get train and test samples
                     splitter.split_data()
+                    Jobs = []
                                                                
                     # Go through each model to be trained
                     for l, model_dict in enumerate(self.Models):
@@ -431,10 +504,18 @@ class Experiment():
                         self.print_split_status(k, splitter, split_failure)
                         self.print_model_status(l, model, model_failure) 
                         
+                        # Allow loading the results later without loading the data
+                        self._index_result_files(Results_index, i, j, k, l, data_set, splitter, model)
+                        
                         # Do not train model if not possible
                         if model_failure is not None:
                             continue
                         
+                        # Collect the models to run them in parallel
+                        if parallel:
+                            Jobs.append(self._get_model_job(model_class, model_kwargs, data_set, splitter, model, memory_per_job))
+                            continue
+                        
                         # Train the model on the given training set
                         model.train()
                         
@@ -442,8 +523,108 @@ class Experiment():
                         # possible due to memory constraints. Therefore, the predictions and evaluations are calculated
                         # at the same time. For this, we have to create a new function called predict_and_evaluate()
                         model.predict_and_evaluate(self.Metrics, self.print_metric_status)
+                
+                    # Run the collected models, which share the loaded dataset and split. This has to happen
+                    # before the next split is made, as this changes the data set used by the models
+                    if parallel and len(Jobs) > 0:
+                        Failed_jobs += scheduler.run(Jobs, self.Metrics, self.print_metric_status, 
+                                                     skip_done = data_set.overwrite_results == 'no')
+        
+        if parallel and len(Failed_jobs) > 0:
+            print('The following jobs failed and will be rerun in the next run:', flush = True)
+            for key in Failed_jobs:
+                print('    ' + key, flush = True)
     
     #%% Loading results
+    def _get_configuration_key(self, i, j, k, l, m):
+        # Get the key of the settings in the results index (without the parameters 
+        # overwrite_results, save_predictions and total_memory, which do not change the results)
+        Parameters = self.parameters[:7] + self.parameters[8:9]
+        return get_configuration_key(self.Data_sets[i], self.Data_params[j], self.Splitters[k], 
+                                     self.Models[l], self.Metrics[m], Parameters)
+    
+    
+    def _get_result_files(self, data_set, splitter, model, metric):
+        # Get the name of the split method used.
+        splitter_str = splitter.get_name()['file'] + splitter.get_rep_str()
+        
+        model_str = model.get_name()['file']
+        if 'pretrained' in model.model_kwargs.keys():
+            pretrained_path = model.model_kwargs['pretrained']                            
+            pretrained_folder = Path(pretrained_path).parent.parent.name
+            model_str += '--pretrain_' + pretrained_folder
+        model_str += model.get_prediction_file_addon()
+        
+        # Approximated KDEs lead to different results
+        metric_str = metric.get_name()['file'] + data_set.get_KDE_file_addon()
+        
+        results_file_name = (data_set.data_file[:-4] + '--' + 
+                             # Add splitting method
+                             splitter_str + '--' + 
+                             # Add model name
+                             model_str + '--' + 
+                             # Add metric name
+                             metric_str  + '.npy')
+        
+        results_file_name = results_file_name.replace(os.sep + 'Data' + os.sep,
+                                                      os.sep + 'Metrics' + os.sep)
+        
+        # Get the figure file (without the model name)
+        figure_file = data_set.change_result_directory(results_file_name, 'Metric_figures', '')
+        num = 6 + len(model.get_name()['file']) + len(model.get_prediction_file_addon()) + len(metric_str)
+        figure_file = figure_file[:-num] + metric_str + '.pdf'
+        
+        if model.provides_epoch_loss():
+            # Adjust splitter_str
+            splitter_str_new = splitter_str + ''
+            if '_pert=' in splitter_str_new:
+                pert_split = splitter_str_new.split('_pert=')
+                splitter_str_new = pert_split[0] + '_pert=' + pert_split[1][0] + pert_split[1][2:]
+
+            train_loss_file_name = (data_set.data_file[:-4] + '--' + 
+                                    # Add splitting method
+                                    splitter_str_new + '--' +  
+                                    # Add model name
+                                    model.get_name()['file']  + '--train_loss.npy')
+            
+            train_loss_file_name = train_loss_file_name.replace(os.sep + 'Data' + os.sep,
+                                                                os.sep + 'Models' + os.sep)
+        else:
+            train_loss_file_name = None
+        
+        return results_file_name, train_loss_file_name, figure_file
+    
+    
+    def _index_result_files(self, Results_index, i, j, k, l, data_set, splitter, model):
+        # Save the result files of all metrics for this model in the results index
+        Configurations = []
+        for m, metric_dict in enumerate(self.Metrics):
+            metric_module = importlib.import_module(metric_dict['metric'])
+            metric_class = getattr(metric_module, metric_dict['metric'])
+            metric = metric_class(metric_dict['kwargs'], None, None, None)
+            
+            result_files = self._get_result_files(data_set, splitter, model, metric)
+            Configurations.append((self._get_configuration_key(i, j, k, l, m),) + result_files)
+            
+        Results_index.set_configurations(Configurations)
+    
+    
+    def _get_indexed_configurations(self, Results_index, i, j):
+        # Get the result files of all splitters, models and metrics for a dataset and data params
+        Keys = {}
+        for k in range(len(self.Splitters)):
+            for l in range(len(self.Models)):
+                for m in range(len(self.Metrics)):
+                    Keys[(k, l, m)] = self._get_configuration_key(i, j, k, l, m)
+        
+        Configurations = Results_index.get_configurations(Keys.values())
+        
+        # Only use the index if all settings are known
+        if len(Configurations) < len(set(Keys.values())):
+            return None
+        return {position: Configurations[key] for position, key in Keys.items()}
+    
+
     def load_results(self, plot_if_possible = True, return_train_results = False, return_train_loss = False):
         assert self.provided_modules, "No modules have been provided. Run self.set_modules() first."
         assert self.provided_setting, "No parameters have been provided. Run self.set_parameters() first."
@@ -494,35 +675,46 @@ class Experiment():
                                        self.num_models),
                                       np.ndarray) * np.nan
 
+        # Get the experiment level index, so that data is only loaded for unknown settings
+        Results_index = results_index(get_results_index_file(self.path))
+        
         for i, data_set_dict in enumerate(self.Data_sets):
-                # Get data set class
-            data_set = data_interface(data_set_dict, self.parameters)
+            data_set = None
 
             for j, data_param in enumerate(self.Data_params):
-                data_set.reset()
-                data_set.get_data(**data_param)
+                # Check if the result files of all settings are allready known
+                Configurations = self._get_indexed_configurations(Results_index, i, j)
+                New_configurations = []
+                
+                if Configurations is None:
+                    # Get data set class
+                    if data_set is None:
+                        data_set = data_interface(data_set_dict, self.parameters)
+                    data_set.reset()
+                    data_set.get_data(**data_param)
+                
                 for k, splitter_param in enumerate(self.Splitters):
-                    splitter_name       = splitter_param['Type']
-                    splitter_rep        = splitter_param['repetition']
-                    splitter_tp         = splitter_param['test_part']
-                    splitter_train_pert = splitter_param['train_pert']
-                    splitter_test_pert  = splitter_param['test_pert']
-                    splitter_tot        = splitter_param['train_on_test']
+                    if Configurations is None:
+                        splitter_name       = splitter_param['Type']
+                        splitter_rep        = splitter_param['repetition']
+                        splitter_tp         = splitter_param['test_part']
+                        splitter_train_pert = splitter_param['train_pert']
+                        splitter_test_pert  = splitter_param['test_pert']
+                        splitter_tot        = splitter_param['train_on_test']
 
-                    splitter_module = importlib.import_module(splitter_name)
-                    splitter_class = getattr(splitter_module, splitter_name)
-
-                    splitter = splitter_class(data_set, splitter_tp, splitter_rep, splitter_train_pert, splitter_test_pert, splitter_tot)
+                        splitter_module = importlib.import_module(splitter_name)
+                        splitter_class = getattr(splitter_module, splitter_name)
 
-                    # Get the name of the splitmethod used.
-                    splitter_str = splitter.get_name()['file'] + splitter.get_rep_str()
+                        splitter = splitter_class(data_set, splitter_tp, splitter_rep, splitter_train_pert, splitter_test_pert, splitter_tot)
 
                     for m, metric_dict in enumerate(self.Metrics):
                         metric_name = metric_dict['metric']
                         metric_kwargs = metric_dict['kwargs']
                         metric_module = importlib.import_module(metric_name)
                         metric_class = getattr(metric_module, metric_name)
-                        metric = metric_class(metric_kwargs, data_set, splitter, None)
+                        
+                        # The metric is only needed for its name and plots
+                        metric = metric_class(metric_kwargs, None, None, None)
                             
                         create_plot = plot_if_possible and metric.allows_plot()
                         if create_plot:
@@ -537,32 +729,26 @@ class Experiment():
                             model_module = importlib.import_module(model_name)
                             model_class = getattr(model_module, model_name)
                             
-                            # Initialize the model
-                            model = model_class(model_kwargs, data_set, splitter, self.evaluate_on_train_set)
-                            model_str = model.get_name()['file']
-                            if 'pretrained' in model.model_kwargs.keys():
-                                pretrained_path = model.model_kwargs['pretrained']                            
-                                pretrained_folder = Path(pretrained_path).parent.parent.name
-                                model_str += '--pretrain_' + pretrained_folder
-                            
-                            results_file_name = (data_set.data_file[:-4] + '--' + 
-                                                 # Add splitting method
-                                                 splitter_str + '--' + 
-                                                 # Add model name
-                                                 model_str + '--' + 
-                                                 # Add metric name
-                                                 metric.get_name()['file']  + '.npy')
-                            
-                            results_file_name = results_file_name.replace(os.sep + 'Data' + os.sep,
-                                                                          os.sep + 'Metrics' + os.sep)
-                            
+                            if Configurations is None:
+                                # Initialize the model
+                                model = model_class(model_kwargs, data_set, splitter, self.evaluate_on_train_set)
+                                result_files = self._get_result_files(data_set, splitter, model, metric)
+                                New_configurations.append((self._get_configuration_key(i, j, k, l, m),) + result_files)
+                            else:
+                                model = model_class(model_kwargs, None, None, self.evaluate_on_train_set)
+                                result_files = Configurations[(k, l, m)]
                             
+                            results_file_name, train_loss_file_name, figure_file = result_files
                             
                             # print('--'.join(os.path.basename(results_file_name).split('--')[-2:]))
-                            if os.path.isfile(results_file_name):
-                                try:
-                                    metric_result = np.load(results_file_name, allow_pickle = True)[:-1]
-                                    
+                            try:
+                                metric_result = Results_index.get_results(results_file_name)
+                                if metric_result is None and os.path.isfile(results_file_name):
+                                    # Add results saved before the index existed
+                                    metric_result = list(np.load(results_file_name, allow_pickle = True)[:-1])
+                                    Results_index.set_results(results_file_name, metric_result)
+                                
+                                if metric_result is not None:
                                     if return_train_results:
                                         train_results = metric_result[0]
                                         if train_results is not None:
@@ -573,37 +759,16 @@ class Experiment():
 
                                     
                                     if create_plot:
-                                        figure_file = data_set.change_result_directory(results_file_name, 'Metric_figures', '')
-                                        
-                                        # remove model name from figure file
-                                        num = 6 + len(model.get_name()['file']) + len(metric.get_name()['file'])
-                                        figure_file = figure_file[:-num] + metric.get_name()['file'] + '.pdf'
-                                        
                                         os.makedirs(os.path.dirname(figure_file), exist_ok = True)
                                         saving_figure = l == (self.num_models - 1)
                                         metric.create_plot(test_results, figure_file, fig, ax, saving_figure, model)
-                                except:
-                                    print('Desired result cannot be opened: ' + '--'.join(results_file_name.split('--')[-2:]))
-                            else:
-                                print('Desired result not findable.')
+                                else:
+                                    print('Desired result not findable.')
+                            except:
+                                print('Desired result cannot be opened: ' + '--'.join(results_file_name.split('--')[-2:]))
                                 
                             if m == 0 and return_train_loss:
-                                if model.provides_epoch_loss():
-                                    # Adjust splitter_str
-                                    splitter_str_new = splitter_str + ''
-                                    if '_pert=' in splitter_str_new:
-                                        pert_split = splitter_str_new.split('_pert=')
-                                        splitter_str_new = pert_split[0] + '_pert=' + pert_split[1][0] + pert_split[1][2:]
-
-                                    train_loss_file_name = (data_set.data_file[:-4] + '--' + 
-                                                            # Add splitting method
-                                                            splitter_str_new + '--' +  
-                                                            # Add model name
-                                                            model.get_name()['file']  + '--train_loss.npy')
-                                    
-                                    train_loss_file_name = train_loss_file_name.replace(os.sep + 'Data' + os.sep,
-                                                                                        os.sep + 'Models' + os.sep)
-                                    
+                                if train_loss_file_name is not None:
                                     if os.path.isfile(train_loss_file_name):
                                         train_loss = np.load(train_loss_file_name, allow_pickle = True)
                                         
@@ -613,6 +778,10 @@ class Experiment():
                                         print('Desired train loss is not available not findable')
                                 else:
                                     print('The model ' + model.get_name()['print'] + ' does not provide training losses.')
+                
+                # Remember the result files, so that the data is not loaded again
+                if len(New_configurations) > 0:
+                    Results_index.set_configurations(New_configurations)
                                   
         self.results_loaded = True
         
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The framework imports its modules relative to the Framework folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
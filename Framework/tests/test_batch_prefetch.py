@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from utils.batch_prefetch_utils import batch_prefetcher
+
+
+def get_producer(num_batches):
+    state = {'i': 0}
+    def produce_batch():
+        state['i'] += 1
+        return state['i'], state['i'] == num_batches
+    return produce_batch
+
+
+def test_batches_match_synchronous_order():
+    produce_batch = get_producer(10)
+    prefetcher = batch_prefetcher(produce_batch, 3)
+
+    batches = []
+    while not prefetcher.finished:
+        batches.append(prefetcher.get())
+    prefetcher.stop()
+    assert batches == list(range(1, 11))
+
+
+def test_stop_keeps_prepared_batches():
+    produce_batch = get_producer(10)
+    prefetcher = batch_prefetcher(produce_batch, 2)
+    assert prefetcher.get() == 1
+    prefetcher.stop()
+
+    # Restarting continues with the next batch
+    assert prefetcher.get() == 2
+    prefetcher.stop()
+
+
+def test_errors_are_raised_in_caller():
+    def produce_batch():
+        raise ValueError('broken batch')
+
+    prefetcher = batch_prefetcher(produce_batch, 2)
+    with pytest.raises(ValueError, match = 'broken batch'):
+        prefetcher.get()
+    prefetcher.stop()
@@ -0,0 +1,41 @@
+import numpy as np
+
+from utils.evaluation_context_utils import evaluation_cache
+
+
+def test_results_are_computed_once():
+    cache = evaluation_cache(2 ** 20)
+    context = cache.get_context(np.arange(5), 0)
+
+    num_calls = [0]
+    def compute():
+        num_calls[0] += 1
+        return np.ones(10)
+
+    context.get('ones', compute, 'a')
+    context.get('ones', compute, 'a')
+    assert num_calls[0] == 1
+    assert (cache.num_hits, cache.num_misses) == (1, 1)
+
+    # Different settings or samples are stored seperately
+    context.get('ones', compute, 'b')
+    cache.get_context(np.arange(6), 0).get('ones', compute, 'a')
+    assert num_calls[0] == 3
+
+
+def test_least_recently_used_results_are_removed():
+    # Each result uses 800 bytes, so only two fit into the cache
+    cache = evaluation_cache(2000)
+    for key in ['a', 'b']:
+        cache.get(key, lambda: np.zeros(100))
+    
+    # Use 'a', so that 'b' is the least recently used result
+    cache.get('a', lambda: np.zeros(100))
+    cache.get('c', lambda: np.zeros(100))
+
+    assert list(cache.entries.keys()) == ['a', 'c']
+    assert cache.memory == 1600
+    
+    # The newest result is kept even if it exceeds the memory cap
+    cache.get('d', lambda: np.zeros(1000))
+    assert list(cache.entries.keys()) == ['d']
@@ -0,0 +1,16 @@
+import os
+import numpy as np
+
+from utils.file_utils import save_atomic
+
+
+def test_save_atomic_replaces_file(tmp_path):
+    file = str(tmp_path / 'data.npy')
+    save_atomic(file, np.array([np.arange(3), 0], object))
+    save_atomic(file, np.array([np.arange(5), 0], object))
+
+    [data, _] = np.load(file, allow_pickle = True)
+    assert np.array_equal(data, np.arange(5))
+
+    # No temporary files are left behind
+    assert os.listdir(tmp_path) == ['data.npy']
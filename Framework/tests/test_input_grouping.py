@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from utils.input_grouping_utils import group_identical_samples
+
+
+def get_connected_components(X, tolerance):
+    # Compare all pairs of samples
+    D = np.abs(X[:, np.newaxis] - X[np.newaxis])
+    useful = np.isfinite(D)
+    D[~useful] = 0.0
+    Finite = np.isfinite(X)
+    Identical = useful.any(-1) & (D.max(-1) < tolerance) & (Finite[:, np.newaxis] == Finite[np.newaxis]).all(-1)
+
+    labels = np.full(len(X), -1, int)
+    num_groups = 0
+    for seed in range(len(X)):
+        if labels[seed] >= 0:
+            continue
+        labels[seed] = num_groups
+        added = [seed]
+        while len(added) > 0:
+            i = added.pop()
+            new = np.where(Identical[i] & (labels < 0))[0]
+            labels[new] = num_groups
+            added += list(new)
+        num_groups += 1
+    return labels
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_groups_are_connected_components(seed):
+    rng = np.random.default_rng(seed)
+    num_values = rng.integers(1, 12)
+    X = np.round(rng.random((300, num_values)) * 3) + rng.random((300, num_values)) * 2e-3
+    if seed % 2 == 0:
+        X[rng.random(X.shape) < 0.2] = np.nan
+
+    labels = group_identical_samples(X, tolerance = 1e-3)
+    assert np.array_equal(labels, get_connected_components(X, 1e-3))
+
+
+def test_chained_samples_form_one_group():
+    X = np.array([[0.0], [0.0008], [0.0016], [5.0]])
+    assert np.array_equal(group_identical_samples(X, tolerance = 1e-3), [0, 0, 0, 1])
+
+
+def test_multidimensional_samples_are_flattened():
+    rng = np.random.default_rng(0)
+    X = rng.normal(0, 0.1, (200, 3, 4, 2))
+    X[100:] = X[:100] + 1e-5
+    labels = group_identical_samples(X, tolerance = 1e-3)
+    assert np.array_equal(labels[100:], labels[:100])
+    assert labels.max() == 99
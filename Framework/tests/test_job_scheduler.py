@@ -0,0 +1,113 @@
+import os
+import functools
+import multiprocessing
+import pytest
+
+pytest.importorskip('torch')
+from utils.job_scheduler_utils import job_ledger, model_job, job_scheduler
+
+pytestmark = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(),
+                                reason = 'The scheduler needs forked processes.')
+
+
+class shared_data_set():
+    # Stands in for the data set, which is changed by each split
+    def __init__(self):
+        self.split = None
+
+
+class dummy_model():
+    def __init__(self, data_set, name, result_dir, fail = False):
+        self.data_set = data_set
+        self.name = name
+        self.result_file = os.path.join(result_dir, name + '.txt')
+        self.fail = fail
+
+    def train(self):
+        if self.fail:
+            raise ValueError('Training failed.')
+
+    def predict_and_evaluate(self, Metrics, print_metric_status):
+        with open(self.result_file, 'w') as f:
+            f.write(self.data_set.split + ':' + self.name + ':' + ','.join(Metrics))
+
+
+def get_jobs(data_set, split, result_dir, fail = ()):
+    Jobs = []
+    for name in ['model_a', 'model_b', 'model_c']:
+        name = split + '_' + name
+        create_model = functools.partial(dummy_model, data_set, name, result_dir, name in fail)
+        Jobs.append(model_job(name, create_model, 1.0, False, name))
+    return Jobs
+
+
+def run_splits(result_dir, ledger_file, num_workers, skip_done = True, fail = ()):
+    data_set = shared_data_set()
+    scheduler = job_scheduler(job_ledger(ledger_file), num_workers, 10.0)
+
+    failed_jobs = []
+    for split in ['split_0', 'split_1']:
+        # Each split changes the shared data set before its models are run
+        data_set.split = split
+        Jobs = get_jobs(data_set, split, result_dir, fail)
+        failed_jobs += scheduler.run(Jobs, ['metric'], print, skip_done = skip_done)
+    return failed_jobs
+
+
+def read_results(result_dir):
+    Results = {}
+    for file in sorted(os.listdir(result_dir)):
+        with open(os.path.join(result_dir, file), 'r') as f:
+            Results[file] = f.read()
+    return Results
+
+
+def test_parallel_matches_serial(tmp_path):
+    serial_dir = tmp_path / 'serial'
+    parallel_dir = tmp_path / 'parallel'
+    serial_dir.mkdir()
+    parallel_dir.mkdir()
+
+    assert run_splits(str(serial_dir), str(tmp_path / 'serial.json'), 1) == []
+    assert run_splits(str(parallel_dir), str(tmp_path / 'parallel.json'), 3) == []
+
+    Results_serial = read_results(str(serial_dir))
+    assert len(Results_serial) == 6
+    assert Results_serial == read_results(str(parallel_dir))
+
+    # Each model has to see the data set of its own split
+    for file, result in Results_serial.items():
+        assert result == file[:7] + ':' + file[:-4] + ':metric'
+
+
+def test_ledger_skips_done_jobs_unless_overwritten(tmp_path):
+    result_dir = tmp_path / 'results'
+    result_dir.mkdir()
+    ledger_file = str(tmp_path / 'ledger.json')
+
+    run_splits(str(result_dir), ledger_file, 2)
+    for file in os.listdir(str(result_dir)):
+        os.remove(os.path.join(str(result_dir), file))
+
+    # Finished jobs are not rerun
+    run_splits(str(result_dir), ledger_file, 2)
+    assert len(os.listdir(str(result_dir))) == 0
+
+    # Unless the results are supposed to be overwritten
+    run_splits(str(result_dir), ledger_file, 2, skip_done = False)
+    assert len(os.listdir(str(result_dir))) == 6
+
+
+def test_failed_jobs_are_rerun(tmp_path):
+    result_dir = tmp_path / 'results'
+    result_dir.mkdir()
+    ledger_file = str(tmp_path / 'ledger.json')
+
+    failed_jobs = run_splits(str(result_dir), ledger_file, 2, fail = ('split_1_model_b',))
+    assert failed_jobs == ['split_1_model_b']
+    assert job_ledger(ledger_file).entries['split_1_model_b']['status'] == 'failed'
+    assert len(os.listdir(str(result_dir))) == 5
+
+    assert run_splits(str(result_dir), ledger_file, 2) == []
+    assert job_ledger(ledger_file).entries['split_1_model_b']['attempts'] == 2
+    assert len(os.listdir(str(result_dir))) == 6
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('psutil')
+
+from utils.kde_scoring_utils import kde_scoring_engine
+
+
+class gaussian_kde():
+    # Simple density estimator, counting how many samples it scored
+    def __init__(self, X_train, bandwidth):
+        self.X_train   = X_train
+        self.bandwidth = bandwidth
+        self.num_scored = 0
+
+    def score_samples(self, X):
+        self.num_scored += len(X)
+        D2 = ((X[:, np.newaxis] - self.X_train[np.newaxis]) ** 2).sum(-1) / self.bandwidth ** 2
+        log_kernel = -0.5 * D2 - 0.5 * X.shape[1] * np.log(2 * np.pi * self.bandwidth ** 2)
+        return np.log(np.exp(log_kernel).mean(1))
+
+
+def get_samples(num_samples, num_features, seed = 0):
+    rng = np.random.default_rng(seed)
+    X_train = rng.normal(size = (200, num_features))
+    # Repeat samples, with small noise on some of them
+    X = rng.normal(size = (num_samples // 4, num_features))
+    X = np.repeat(X, 4, axis = 0)
+    X[::2] += rng.normal(size = X[::2].shape) * 1e-4
+    return X_train, X
+
+
+def test_exact_mode_matches_direct_scoring():
+    X_train, X = get_samples(400, 6)
+    kde = gaussian_kde(X_train, 1.0)
+    engine = kde_scoring_engine(2 ** 30)
+
+    log_probs = engine.score_samples(kde, X)
+    assert np.allclose(log_probs, gaussian_kde(X_train, 1.0).score_samples(X))
+
+    # Identical samples are only scored once
+    assert kde.num_scored == len(np.unique(X, axis = 0))
+
+
+@pytest.mark.parametrize('num_features', [2, 24])
+def test_approximate_mode_respects_tolerance(num_features):
+    X_train, X = get_samples(2000, num_features)
+    kde = gaussian_kde(X_train, 1.0)
+    engine = kde_scoring_engine(2 ** 30, tolerance = 1e-2)
+
+    log_probs = engine.score_samples(kde, X)
+    log_probs_exact = gaussian_kde(X_train, 1.0).score_samples(X)
+
+    # The tolerance is not guaranteed outside the validation samples, but should hold for smooth densities
+    assert np.abs(log_probs - log_probs_exact).max() < 5e-2
+    assert engine.get_settings_key().startswith('approx_tol0.01')
+
+
+def test_approximate_mode_merges_high_dimensional_samples():
+    X_train, X = get_samples(2000, 24)
+    kde = gaussian_kde(X_train, 1.0)
+    engine = kde_scoring_engine(2 ** 30, tolerance = 1e-2)
+    engine.score_samples(kde, X)
+
+    # Including the validation samples, fewer samples are scored than in the exact mode
+    assert kde.num_scored < len(np.unique(X, axis = 0))
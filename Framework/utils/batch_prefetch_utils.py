@@ -0,0 +1,118 @@
+import threading
+import numpy as np
+import torch
+from collections import deque
+
+
+class batch_prefetcher():
+    r'''
+    This class prepares batches in a background thread, while the model works on
+    the previously provided batches. The batches are produced strictly sequentially
+    by calling **produce_batch**, so their content and ordering are identical to
+    calling **produce_batch** synchronously.
+
+    Parameters
+    ----------
+    produce_batch : callable
+        A function without arguments that returns the tuple (batch, epoch_done). After a
+        batch with epoch_done = True has been produced, no further batches are prepared.
+    num_batches : int
+        The maximum number of batches that are prepared ahead of time.
+    '''
+    def __init__(self, produce_batch, num_batches):
+        self.produce_batch = produce_batch
+        self.num_batches = max(1, int(num_batches))
+
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+
+        self.stop_requested = False
+        self.exhausted = False
+        self.error = None
+
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # Wait until there is space in the buffer
+                while len(self.buffer) >= self.num_batches and not self.stop_requested:
+                    self.condition.wait()
+
+                if self.stop_requested:
+                    return
+
+            try:
+                batch, epoch_done = self.produce_batch()
+            except BaseException as error:
+                with self.condition:
+                    self.error = error
+                    self.exhausted = True
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.buffer.append(batch)
+                self.exhausted = epoch_done
+                self.condition.notify_all()
+
+            if epoch_done:
+                return
+
+
+    def is_producer_thread(self):
+        return self.thread is not None and threading.current_thread() is self.thread
+
+
+    def start(self):
+        if self.exhausted or (self.thread is not None and self.thread.is_alive()):
+            return
+
+        self.stop_requested = False
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+
+    def get(self):
+        self.start()
+        with self.condition:
+            while len(self.buffer) == 0:
+                if self.error is not None:
+                    error = self.error
+                    self.error = None
+                    raise error
+
+                if self.exhausted or self.thread is None or not self.thread.is_alive():
+                    raise RuntimeError("No further batches can be prefetched.")
+
+                self.condition.wait()
+
+            batch = self.buffer.popleft()
+            self.condition.notify_all()
+        return batch
+
+
+    @property
+    def finished(self):
+        return self.exhausted and len(self.buffer) == 0
+
+
+    def stop(self):
+        # Already prepared batches are kept, so that they can be returned later
+        with self.condition:
+            self.stop_requested = True
+            self.condition.notify_all()
+
+        if self.thread is not None and not self.is_producer_thread():
+            self.thread.join()
+        self.thread = None
+
+
+
+def array_to_torch(value, pin_memory = False):
+    ''' Transform a numerical numpy array into a (pinned) torch tensor, other values are returned unchanged. '''
+    if isinstance(value, np.ndarray) and (value.dtype.kind in 'fiub'):
+        value = torch.from_numpy(np.ascontiguousarray(value))
+        if pin_memory:
+            value = value.pin_memory()
+    return value
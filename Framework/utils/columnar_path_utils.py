@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Marker that is saved in the pickled --all_orig_paths files instead of the path data,
+# signaling that the actual path data is stored in the corresponding columnar directory.
+COLUMNAR_MARKER = 'columnar_path_data'
+
+# Names of the files in a columnar directory
+COLUMNAR_FILES = ['data', 'sample_index', 'agent_index', 'time_index', 'sample_offsets']
+
+
+class columnar_path_data():
+    r'''
+    This class holds the sparse recordings of the original paths in a columnar format.
+    All recordings are sorted by sample, agent and time, so that the recordings of a single
+    sample can be found as a contiguous slice using the CSR-style offset table.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The recorded path data as a float32 array of shape :math:`\{N_{data} \times N_{rec}\}`,
+        so that each channel (x, y, ...) is contiguous in memory.
+    sample_index : np.ndarray
+        The sample index of each recording, as an int32 array of length :math:`N_{rec}`.
+    agent_index : np.ndarray
+        The agent index of each recording, as an int32 array of length :math:`N_{rec}`.
+    time_index : np.ndarray
+        The time index of each recording, as an int32 array of length :math:`N_{rec}`.
+    sample_offsets : np.ndarray
+        The offsets of each sample, as an int64 array of length :math:`N_{samples} + 1`. The
+        recordings of sample i are found in the slice [sample_offsets[i], sample_offsets[i + 1]).
+    columns : list
+        The names of the channels in data (i.e., self.path_data_info() of the dataset).
+    '''
+    def __init__(self, data, sample_index, agent_index, time_index, sample_offsets, columns):
+        assert data.shape[0] == len(columns), "The number of channels does not fit the column names."
+        assert data.shape[1] == len(sample_index), "The number of recordings is inconsistent."
+        assert len(sample_index) == len(agent_index) == len(time_index), "The index columns have different lengths."
+        assert sample_offsets[-1] == len(sample_index), "The sample offsets do not cover all recordings."
+
+        self.data           = data
+        self.sample_index   = sample_index
+        self.agent_index    = agent_index
+        self.time_index     = time_index
+        self.sample_offsets = sample_offsets
+        self.columns        = list(columns)
+
+    @property
+    def num_samples(self):
+        return len(self.sample_offsets) - 1
+
+    @property
+    def num_recordings(self):
+        return len(self.sample_index)
+
+    def get_sample_slice(self, sample_index):
+        # Get the recordings belonging to one sample
+        return slice(int(self.sample_offsets[sample_index]), int(self.sample_offsets[sample_index + 1]))
+
+    def to_dataframe(self):
+        # Transform to the sparse pandas dataframe used in older versions of the framework
+        Path = pd.DataFrame(np.asarray(self.data).T, columns = self.columns)
+        Path.insert(0, 'time_index', np.asarray(self.time_index))
+        Path.insert(0, 'agent_index', np.asarray(self.agent_index))
+        Path.insert(0, 'sample_index', np.asarray(self.sample_index))
+        return Path
+
+
+
+def build_columnar_path_data(data, sample_index, agent_index, time_index, num_samples, columns):
+    ''' Sort unordered recordings by sample, agent and time and build the offset table. '''
+    sample_index = np.asarray(sample_index, dtype = np.int32)
+    agent_index  = np.asarray(agent_index, dtype = np.int32)
+    time_index   = np.asarray(time_index, dtype = np.int32)
+    data         = np.asarray(data, dtype = np.float32).reshape(-1, len(columns))
+
+    # Sort the recordings (np.lexsort uses the last key as primary key)
+    order = np.lexsort((time_index, agent_index, sample_index))
+
+    sample_index = sample_index[order]
+    agent_index  = agent_index[order]
+    time_index   = time_index[order]
+    data         = np.ascontiguousarray(data[order].T)
+
+    # Get the CSR-style offsets of each sample
+    sample_offsets = np.zeros(num_samples + 1, np.int64)
+    sample_offsets[1:] = np.cumsum(np.bincount(sample_index, minlength = num_samples))
+
+    return columnar_path_data(data, sample_index, agent_index, time_index, sample_offsets, columns)
+
+
+def columnar_path_data_from_dataframe(Path, num_samples, columns):
+    ''' Transform the sparse pandas dataframe of older versions to the columnar format. '''
+    return build_columnar_path_data(Path[columns].to_numpy().astype(np.float32),
+                                    Path['sample_index'].to_numpy().astype(np.int32),
+                                    Path['agent_index'].to_numpy().astype(np.int32),
+                                    Path['time_index'].to_numpy().astype(np.int32),
+                                    num_samples, columns)
+
+
+def save_columnar_path_data(Path, directory):
+    ''' Save the columnar path data as raw .npy files that can be memory mapped. '''
+    assert isinstance(Path, columnar_path_data), "Only columnar path data can be saved."
+    os.makedirs(directory, exist_ok = True)
+
+    for name in COLUMNAR_FILES:
+        np.save(directory + os.sep + name + '.npy', np.ascontiguousarray(getattr(Path, name)))
+
+    # Save the column names seperately, as they are not numeric
+    np.save(directory + os.sep + 'columns.npy', np.array(Path.columns, str))
+
+
+def load_columnar_path_data(directory, mmap_mode = 'r'):
+    ''' Load the columnar path data, by default as read-only memory maps shared over the page cache. '''
+    if not os.path.isdir(directory):
+        raise FileNotFoundError("The columnar path data directory {} does not exist.".format(directory))
+
+    arrays = {}
+    for name in COLUMNAR_FILES:
+        arrays[name] = np.load(directory + os.sep + name + '.npy', mmap_mode = mmap_mode)
+
+    # Offsets are small and used for every lookup, so keep them in memory
+    arrays['sample_offsets'] = np.array(arrays['sample_offsets'])
+
+    columns = np.load(directory + os.sep + 'columns.npy').tolist()
+    return columnar_path_data(columns = columns, **arrays)
+
+
+def get_dense_path_samples(Path, sample_indices, num_agents, num_timesteps):
+    r'''
+    Transform the recordings of multiple samples into one dense block using a single scatter.
+
+    Parameters
+    ----------
+    Path : columnar_path_data
+        The sparse path data.
+    sample_indices : np.ndarray
+        The indices of the :math:`N_{batch}` samples that should be extracted.
+    num_agents : int
+        The number of agents :math:`N_{agents}` of the dense block.
+    num_timesteps : int
+        The number of timesteps :math:`N_{T}` of the dense block. Recordings at later time 
+        indices are ignored.
+
+    Returns
+    -------
+    Path_dense : np.ndarray
+        The dense path data as a float32 array of shape :math:`\{N_{batch} \times N_{agents} \times N_{T} \times N_{data}\}`,
+        where missing recordings are set to np.nan.
+    '''
+    sample_indices = np.asarray(sample_indices, dtype = np.int64).reshape(-1)
+    num_data = len(Path.columns)
+
+    Path_dense = np.full((len(sample_indices), num_agents, num_timesteps, num_data), np.nan, dtype = np.float32)
+    if len(sample_indices) == 0:
+        return Path_dense
+    
+    # Get the recording ranges of each sample from the offset table
+    starts  = Path.sample_offsets[sample_indices]
+    lengths = Path.sample_offsets[sample_indices + 1] - starts
+    
+    num_recordings = lengths.sum()
+    if num_recordings == 0:
+        return Path_dense
+
+    # Get the position of each needed recording and the sample in the batch it belongs to
+    batch_index = np.repeat(np.arange(len(sample_indices)), lengths)
+    batch_starts = np.cumsum(lengths) - lengths
+    recording_index = starts[batch_index] + np.arange(num_recordings) - batch_starts[batch_index]
+
+    # Sort the recordings (already the case for ascending sample indices) to read memory maps sequentially
+    recording_order = np.argsort(recording_index, kind = 'stable')
+    recording_index = recording_index[recording_order]
+    batch_index     = batch_index[recording_order]
+
+    agent_index = np.asarray(Path.agent_index[recording_index])
+    time_index  = np.asarray(Path.time_index[recording_index])
+    data        = np.asarray(Path.data[:, recording_index]).T
+
+    # Ignore recordings outside the requested block
+    useful = (time_index < num_timesteps) & (agent_index < num_agents)
+
+    Path_dense[batch_index[useful], agent_index[useful], time_index[useful]] = data[useful]
+    return Path_dense
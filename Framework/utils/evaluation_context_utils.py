@@ -0,0 +1,104 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy as sp
+from collections import OrderedDict
+
+
+def get_nbytes(value):
+    # Get the approximate memory used by (nested) numpy arrays and pandas objects
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep = False).sum())
+    elif sp.sparse.issparse(value):
+        return sum(get_nbytes(getattr(value, key, None)) for key in ['data', 'indices', 'indptr', 'row', 'col'])
+    elif isinstance(value, (list, tuple)):
+        return sum(get_nbytes(v) for v in value)
+    elif isinstance(value, dict):
+        return sum(get_nbytes(v) for v in value.values())
+    else:
+        return 0
+
+
+
+class evaluation_cache():
+    r'''
+    This class stores intermediate results of the metric evaluation (such as the true and predicted
+    trajectories), so that they are only calculated once and then shared between all metrics. If the
+    stored results exceed the memory cap, the least recently used entries are removed.
+
+    Parameters
+    ----------
+    max_memory : int
+        The maximum memory (in bytes) used for stored results.
+    '''
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.entries = OrderedDict()
+        self.memory = 0
+
+        self.num_hits   = 0
+        self.num_misses = 0
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+            return self.entries[key][0]
+
+        self.num_misses += 1
+        value = compute()
+        nbytes = get_nbytes(value)
+
+        self.entries[key] = (value, nbytes)
+        self.memory += nbytes
+
+        # Remove the least recently used entries (but keep the newest one)
+        while self.memory > self.max_memory and len(self.entries) > 1:
+            _, (_, nbytes_old) = self.entries.popitem(last = False)
+            self.memory -= nbytes_old
+
+        return value
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.memory = 0
+
+    def get_context(self, Index, file_index):
+        return evaluation_context(self, Index, file_index)
+
+
+
+class evaluation_context():
+    r'''
+    This class gives the metrics access to the results stored in an **evaluation_cache** for one set
+    of evaluated samples.
+
+    Parameters
+    ----------
+    cache : evaluation_cache
+        The cache in which the results are stored.
+    Index : np.ndarray
+        The indices of the evaluated samples.
+    file_index : int
+        The file in which the evaluated samples are saved.
+    '''
+    def __init__(self, cache, Index, file_index):
+        self.cache      = cache
+        self.Index      = Index
+        self.file_index = file_index
+
+        # Get a compact key for the evaluated samples
+        Index = np.ascontiguousarray(np.asarray(Index, np.int64))
+        self.index_key = (len(Index), hashlib.sha1(Index.tobytes()).hexdigest(), int(file_index))
+
+    def matches(self, Index):
+        return np.array_equal(Index, self.Index)
+
+    def get(self, name, compute, *settings):
+        r'''
+        Returns the stored result with the given name and settings, which is calculated
+        with **compute** (a function without arguments) if it is not yet stored.
+        '''
+        return self.cache.get((self.index_key, name, settings), compute)
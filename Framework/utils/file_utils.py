@@ -0,0 +1,26 @@
+import os
+import numpy as np
+
+
+def save_atomic(file, data):
+    r'''
+    This function saves an array like *np.save()*, but writes it to a temporary file first,
+    which then replaces the final file. Other processes therefore either see the complete old
+    file, the complete new file, or no file at all, but never a partially written one.
+
+    Parameters
+    ----------
+    file : str
+        The path of the saved file, including the *.npy* ending.
+    data : np.ndarray
+        The saved array.
+    '''
+    # Each process uses its own temporary file, so that concurrent writers do not interfere
+    file_tmp = file + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(file_tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(file_tmp, file)
+    finally:
+        if os.path.isfile(file_tmp):
+            os.remove(file_tmp)
@@ -0,0 +1,240 @@
+import time
+import contextlib
+import torch
+
+
+INFERENCE_PRECISIONS = ['float32', 'bfloat16', 'int8']
+
+
+def _find_torch_networks(value, owner, key, Locations, visited, depth):
+    if isinstance(value, torch.nn.Module):
+        Locations.append((owner, key, value))
+        return
+
+    if depth == 0 or id(value) in visited:
+        return
+    visited.add(id(value))
+
+    # Search in containers and in the attributes of other objects (but not in data arrays)
+    if isinstance(value, dict):
+        items = list(value.items())
+    elif isinstance(value, (list, tuple)):
+        items = list(enumerate(value))
+    elif hasattr(value, '__dict__') and not isinstance(value, type):
+        if type(value).__module__.split('.')[0] in ['numpy', 'pandas', 'torch']:
+            return
+        items = list(vars(value).items())
+    else:
+        return
+
+    for sub_key, sub_value in items:
+        _find_torch_networks(sub_value, value, sub_key, Locations, visited, depth - 1)
+
+
+def get_torch_networks(model, ignore = ('data_set', 'splitter', 'inference_optimizer'), max_depth = 4):
+    r'''
+    This function finds the torch networks used by a model. Those are either attributes of the
+    model itself (e.g., self.model), or stored in objects, dictionaries, lists, or tuples within
+    the model (e.g., self.MID.model or self.models['decoder']).
+    Networks that are part of other found networks are not returned seperately.
+
+    Parameters
+    ----------
+    model : object
+        The model whose networks are searched.
+    ignore : tuple, optional
+        The attributes of the model that are not searched. The default is
+        ('data_set', 'splitter', 'inference_optimizer').
+    max_depth : int, optional
+        The number of nested objects and containers that are searched. The default is 4.
+
+    Returns
+    -------
+    Locations : list
+        Tuples (owner, key, network), where the torch.nn.Module *network* is either the attribute
+        *key* of *owner* or its element *owner[key]*. The same network can have multiple locations.
+    '''
+    Locations = []
+    visited = set([id(model)])
+    for key, value in vars(model).items():
+        if key in ignore:
+            continue
+        _find_torch_networks(value, model, key, Locations, visited, max_depth)
+
+    # Remove networks that are part of other networks
+    networks = get_unique_networks(Locations)
+    Locations_final = []
+    for location in Locations:
+        net = location[2]
+        is_submodule = False
+        for other in networks:
+            if other is net:
+                continue
+            if any(module is net for module in other.modules()):
+                is_submodule = True
+                break
+        if not is_submodule:
+            Locations_final.append(location)
+    return Locations_final
+
+
+def get_unique_networks(Locations):
+    networks = []
+    for _, _, net in Locations:
+        if not any(net is other for other in networks):
+            networks.append(net)
+    return networks
+
+
+def set_network(owner, key, net):
+    # Replace a network at one of the locations found by get_torch_networks()
+    if isinstance(owner, (dict, list)):
+        owner[key] = net
+    elif not isinstance(owner, tuple):
+        setattr(owner, key, net)
+
+
+
+def quantize_networks_dynamic(networks):
+    r'''
+    This function replaces the linear layers of the given networks with int8 dynamically
+    quantized versions (only usable on the cpu). The original layers are returned, so that
+    they can be put back with *restore_networks()*.
+    '''
+    swapped = []
+    for net in networks:
+        for parent in net.modules():
+            for name, child in parent.named_children():
+                if type(child) == torch.nn.Linear:
+                    swapped.append((parent, name, child))
+
+    for parent, name, child in swapped:
+        # quantize_dynamic only swaps children, so wrap the layer in a container
+        quantized = torch.ao.quantization.quantize_dynamic(torch.nn.Sequential(child), {torch.nn.Linear}, dtype = torch.qint8)
+        setattr(parent, name, quantized[0])
+    return swapped
+
+
+def restore_networks(swapped):
+    for parent, name, child in swapped:
+        setattr(parent, name, child)
+
+
+
+class inference_optimizer():
+    r'''
+    This class applies optional optimizations to the torch networks of a model while it
+    makes predictions, and measures the resulting throughput.
+
+    Parameters
+    ----------
+    device : torch.device
+        The device on which the model is run.
+    inference_mode : bool
+        If True, predictions are made inside torch.inference_mode().
+    compile : bool
+        If True, the networks are compiled with torch.compile (once, kept for later predictions).
+    cpu_threads : int
+        The number of threads used by torch on the cpu. If None, the torch default is kept.
+    precision : str
+        Either 'float32', 'bfloat16' (autocasting), or 'int8' (dynamic quantization of
+        linear layers, only on the cpu).
+    '''
+    def __init__(self, device, inference_mode = False, compile = False, cpu_threads = None, precision = 'float32'):
+        assert precision in INFERENCE_PRECISIONS, "The inference precision has to be in " + str(INFERENCE_PRECISIONS) + "."
+        self.device         = device
+        self.inference_mode = inference_mode
+        self.compile        = compile
+        self.cpu_threads    = cpu_threads
+        self.precision      = precision
+
+        if self.precision == 'int8' and self.device.type != 'cpu':
+            raise ValueError("Dynamic int8 quantization is only available for inference on the cpu.")
+
+        if self.compile and not hasattr(torch, 'compile'):
+            raise ValueError("Compiling networks requires torch.compile (torch 2.0 or newer).")
+
+        # The compiled version of each network, as pairs (network, compiled network)
+        self.compiled_networks = []
+
+        # Throughput of the last prediction
+        self.num_samples = 0
+        self.duration    = 0.0
+
+    @property
+    def active(self):
+        return self.inference_mode or self.compile or (self.cpu_threads is not None) or (self.precision != 'float32')
+
+    def _get_compiled_network(self, net):
+        for net_orig, net_compiled in self.compiled_networks:
+            if net_orig is net:
+                return net_compiled
+
+        # Compile each network only once, so that it is kept for later predictions
+        net_compiled = torch.compile(net)
+        self.compiled_networks.append((net, net_compiled))
+        return net_compiled
+
+    def _compile_networks(self, Locations):
+        # The compiled networks are only used during prediction, so that the original networks
+        # (and their parameter names) are kept everywhere else
+        swapped = []
+        for owner, key, net in Locations:
+            if isinstance(owner, tuple):
+                continue
+            set_network(owner, key, self._get_compiled_network(net))
+            swapped.append((owner, key, net))
+        return swapped
+
+    @contextlib.contextmanager
+    def apply(self, Locations, num_samples):
+        r'''
+        Context manager under which the predictions are made.
+
+        Parameters
+        ----------
+        Locations : list
+            The locations of the torch networks used for the prediction, as returned by
+            *get_torch_networks()*.
+        num_samples : int
+            The number of samples that are predicted, used for the throughput.
+        '''
+        swapped = []
+        swapped_compiled = []
+        num_threads_old = torch.get_num_threads()
+        with contextlib.ExitStack() as stack:
+            if self.cpu_threads is not None:
+                torch.set_num_threads(max(1, int(self.cpu_threads)))
+
+            # Quantize before compiling, as the compiled network wraps the original one
+            if self.precision == 'int8':
+                swapped = quantize_networks_dynamic(get_unique_networks(Locations))
+            elif self.precision == 'bfloat16':
+                stack.enter_context(torch.autocast(device_type = self.device.type, dtype = torch.bfloat16))
+
+            if self.compile:
+                swapped_compiled = self._compile_networks(Locations)
+
+            if self.inference_mode:
+                stack.enter_context(torch.inference_mode())
+
+            t_start = time.time()
+            try:
+                yield self
+            finally:
+                self.duration = time.time() - t_start
+                self.num_samples = num_samples
+
+                for owner, key, net in swapped_compiled:
+                    set_network(owner, key, net)
+                restore_networks(swapped)
+                torch.set_num_threads(num_threads_old)
+
+    def get_throughput(self):
+        # Get the number of predicted samples per second
+        return self.num_samples / max(self.duration, 1e-6)
+
+    def print_throughput(self):
+        print('    Prediction throughput: {:0.2f} samples/s ({} samples in {:0.2f}s)'.format(self.get_throughput(),
+                                                                                              self.num_samples,
+                                                                                              self.duration), flush = True)
@@ -0,0 +1,165 @@
+import itertools
+import numpy as np
+
+
+def _get_row_keys(Rows):
+    # View each row of integers as a single value, which can be sorted and searched
+    Rows = np.ascontiguousarray(Rows, np.int64)
+    return Rows.view(np.dtype((np.void, Rows.dtype.itemsize * Rows.shape[1])))[:, 0]
+
+
+def _are_identical(X, x, tolerance):
+    # Check if the maximum difference (ignoring missing values) is below the tolerance
+    D = np.abs(X - x[np.newaxis])
+    useful = np.isfinite(D)
+    D[~useful] = 0.0
+    return useful.any(1) & (D.max(1) < tolerance)
+
+
+def _select_values(X, num_values, max_rows = 2000):
+    # Select values that differ strongly between samples (and are rarely missing), while
+    # avoiding values that are strongly correlated with the allready selected ones
+    X_test = X[np.random.default_rng(0).permutation(len(X))[:max_rows]]
+    finite = np.isfinite(X_test)
+    useful = finite.sum(0) > 1
+    if not useful.any():
+        return np.zeros(0, int)
+
+    X_test = X_test[:, useful]
+    finite = finite[:, useful]
+    X_mean = np.nanmean(X_test, axis = 0)
+    X_test = np.where(finite, X_test - X_mean[np.newaxis], 0.0)
+    X_std = np.sqrt((X_test ** 2).sum(0) / finite.sum(0))
+    
+    score = X_std * finite.mean(0)
+    candidates = np.argsort(-score)[:8 * num_values]
+    candidates = candidates[score[candidates] > 0]
+    if len(candidates) == 0:
+        return np.zeros(0, int)
+
+    X_norm = X_test[:, candidates] / np.maximum(np.linalg.norm(X_test[:, candidates], axis = 0), 1e-12)[np.newaxis]
+    Corr = np.abs(X_norm.T @ X_norm)
+
+    selected = [0]
+    while len(selected) < min(num_values, len(candidates)):
+        max_corr = Corr[:, selected].max(1)
+        max_corr[selected] = np.inf
+        selected.append(np.argmin(max_corr))
+    return np.where(useful)[0][candidates[selected]]
+
+
+def _get_cells(X, tolerance, num_cell_values):
+    # Sort the samples into cells of the size of the tolerance along a few of their values,
+    # so that identical samples are always in the same or in neighboring cells
+    finite = np.isfinite(X)
+    values = _select_values(X, num_cell_values)
+    Cells = np.floor(np.where(finite[:, values], X[:, values], 0.0) / tolerance).astype(np.int64)
+
+    # Only samples with the same missing values are compared
+    _, pattern = np.unique(np.packbits(finite, axis = 1), axis = 0, return_inverse = True)
+    return np.concatenate((pattern.reshape(-1, 1), Cells), axis = 1)
+
+
+def _get_neighbor_cells(Cells_unique):
+    # Find for each cell all existing cells (including itself) whose coordinates differ by at most one
+    # (the keys are sorted by their bytes, which differs from the order of the integers)
+    Keys = _get_row_keys(Cells_unique)
+    key_order = np.argsort(Keys)
+    Keys_sorted = Keys[key_order]
+    num_cell_values = Cells_unique.shape[1] - 1
+
+    Cell_id = []
+    Neighbor_id = []
+    for shift in itertools.product([-1, 0, 1], repeat = num_cell_values):
+        Keys_shifted = _get_row_keys(Cells_unique + np.array((0,) + shift)[np.newaxis])
+        position = np.minimum(np.searchsorted(Keys_sorted, Keys_shifted), len(Keys_sorted) - 1)
+        exists = Keys_sorted[position] == Keys_shifted
+
+        Cell_id.append(np.where(exists)[0])
+        Neighbor_id.append(key_order[position[exists]])
+
+    Cell_id = np.concatenate(Cell_id)
+    Neighbor_id = np.concatenate(Neighbor_id)
+    order = np.argsort(Cell_id, kind = 'stable')
+    starts = np.searchsorted(Cell_id[order], np.arange(len(Cells_unique) + 1))
+    return Neighbor_id[order], starts
+
+
+def group_identical_samples(X, tolerance = 1e-3, num_cell_values = 4):
+    r'''
+    This function groups samples with identical values, where two samples are considered identical if
+    their maximum absolute difference (ignoring missing values) is smaller than the tolerance. Groups
+    are the connected components of this relation.
+
+    Instead of comparing all pairs of samples, the samples are sorted into cells of the size of the
+    tolerance along a few of their values (those which differ most between samples). Identical samples
+    then always lie in the same or in neighboring cells, so each sample only has to be compared to the
+    samples in those cells. Samples which differ in which values are missing are not grouped.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        The values of the samples, with the samples in the first dimension.
+    tolerance : float
+        The maximum absolute difference of identical values.
+    num_cell_values : int
+        The number of values used for the cells. More values lead to fewer comparisons between
+        distinct samples, but to more neighboring cells that are searched.
+
+    Returns
+    -------
+    labels : np.ndarray
+        The group of each sample, as consecutive integers starting at 0 (in the order in which
+        the groups first appear).
+    '''
+    num_samples = len(X)
+    X = np.asarray(X, np.float64).reshape(num_samples, -1)
+
+    labels = np.full(num_samples, -1, int)
+    if num_samples < 2 or X.shape[1] == 0:
+        labels[:] = np.arange(num_samples)
+        return labels
+
+    # Get the cell of each sample, and the samples in each cell
+    Cells = _get_cells(X, tolerance, num_cell_values)
+    Cells_unique, cell_id = np.unique(Cells, axis = 0, return_inverse = True)
+    cell_id = cell_id.reshape(-1)
+
+    order = np.argsort(cell_id, kind = 'stable')
+    member_starts = np.searchsorted(cell_id[order], np.arange(len(Cells_unique) + 1))
+    Cell_members = [order[member_starts[i]:member_starts[i + 1]] for i in range(len(Cells_unique))]
+
+    Neighbor_cells, neighbor_starts = _get_neighbor_cells(Cells_unique)
+
+    # Grow each group from its first sample, where each newly added sample is compared to all
+    # samples in the neighboring cells that are not yet part of a group
+    num_groups = 0
+    for seed in range(num_samples):
+        if labels[seed] >= 0:
+            continue
+
+        labels[seed] = num_groups
+        added = [seed]
+        while len(added) > 0:
+            i = added.pop()
+            cell = cell_id[i]
+
+            Candidates = []
+            for neighbor in Neighbor_cells[neighbor_starts[cell]:neighbor_starts[cell + 1]]:
+                # Remove samples allready in a group, so that they are not checked again
+                members = Cell_members[neighbor]
+                members = members[labels[members] < 0]
+                Cell_members[neighbor] = members
+                Candidates.append(members)
+
+            Candidates = np.concatenate(Candidates)
+            if len(Candidates) == 0:
+                continue
+
+            Candidates = Candidates[_are_identical(X[Candidates], X[i], tolerance)]
+            labels[Candidates] = num_groups
+            added += list(Candidates)
+
+        num_groups += 1
+
+    return labels
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import traceback
+import multiprocessing
+import torch
+
+
+class job_ledger():
+    r'''
+    This class keeps track of the status of all jobs of an experiment in a json file,
+    so that an interrupted experiment can be resumed without rerunning finished jobs.
+
+    Parameters
+    ----------
+    ledger_file : str
+        The path of the json file.
+    '''
+    def __init__(self, ledger_file):
+        self.ledger_file = ledger_file
+        self.entries = {}
+        if os.path.isfile(self.ledger_file):
+            with open(self.ledger_file, 'r') as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.ledger_file), exist_ok = True)
+
+        # Write to a temporary file first, so that a crash cannot corrupt the ledger
+        with open(self.ledger_file + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent = 1)
+        os.replace(self.ledger_file + '.tmp', self.ledger_file)
+
+    def is_done(self, key):
+        return key in self.entries and self.entries[key]['status'] == 'done'
+
+    def set_status(self, key, status, **info):
+        if key not in self.entries:
+            self.entries[key] = {'status': status, 'attempts': 0}
+        self.entries[key]['status'] = status
+        self.entries[key]['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        if status == 'running':
+            self.entries[key]['attempts'] += 1
+        self.entries[key].update(info)
+        self.save()
+
+
+
+class model_job():
+    r'''
+    A single job, consisting of training a model and evaluating it on all metrics.
+
+    Parameters
+    ----------
+    key : str
+        The unique name of the job in the ledger.
+    create_model : callable
+        A function without arguments that returns the initialized model. The model is only
+        created inside the worker, so that the gpu is not initialized in the parent process.
+    memory : float
+        The memory (in bytes) reserved for this job.
+    uses_gpu : bool
+        Decides if the job needs a gpu.
+    description : str
+        The name of the job used in printed outputs.
+    '''
+    def __init__(self, key, create_model, memory, uses_gpu, description):
+        self.key          = key
+        self.create_model = create_model
+        self.memory       = memory
+        self.uses_gpu     = uses_gpu
+        self.description  = description
+
+        self.process = None
+        self.gpu_id  = None
+
+
+
+def _train_and_evaluate(job, Metrics, print_metric_status):
+    model = job.create_model()
+    model.train()
+    model.predict_and_evaluate(Metrics, print_metric_status)
+
+
+def _run_model_job(job, Metrics, print_metric_status):
+    # Only make the reserved gpu visible (the model uses the first visible gpu)
+    if job.gpu_id is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(job.gpu_id)
+
+    try:
+        _train_and_evaluate(job, Metrics, print_metric_status)
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+
+
+class job_scheduler():
+    r'''
+    This class runs independent model jobs in parallel in forked worker processes, which share
+    the allready loaded data set and splits of the parent process. A job is only started if the
+    reserved memory and gpus of all running jobs allow it.
+
+    Parameters
+    ----------
+    ledger : job_ledger
+        The ledger in which the status of each job is recorded.
+    num_workers : int
+        The maximum number of jobs that are run at the same time.
+    total_memory : float
+        The memory (in bytes) that can be reserved by all jobs together.
+    num_gpus : int
+        The number of available gpus.
+    jobs_per_gpu : int
+        The maximum number of jobs that share one gpu.
+    fork_gpu_jobs : bool
+        Decides if jobs using a gpu can be run in forked processes. This is not possible if cuda
+        was allready initialized in the parent process, in which case such jobs are run one at a
+        time in the parent process itself, while the other jobs continue in their workers. As cuda
+        might be initialized after the scheduler was created (e.g., when importing a model), this
+        is checked again before each job is started.
+    '''
+    def __init__(self, ledger, num_workers, total_memory, num_gpus = 0, jobs_per_gpu = 1, fork_gpu_jobs = True):
+        self.ledger        = ledger
+        self.num_workers   = max(1, int(num_workers))
+        self.total_memory  = total_memory
+        self.num_gpus      = num_gpus
+        self.jobs_per_gpu  = max(1, int(jobs_per_gpu))
+        self.fork_gpu_jobs = fork_gpu_jobs
+
+        self.context = multiprocessing.get_context('fork')
+
+    def _get_free_gpu(self, running):
+        gpu_usage = [0] * self.num_gpus
+        for job in running:
+            if job.gpu_id is not None:
+                gpu_usage[job.gpu_id] += 1
+
+        for gpu_id in range(self.num_gpus):
+            if gpu_usage[gpu_id] < self.jobs_per_gpu:
+                return gpu_id
+        return None
+
+    def _can_start(self, job, running):
+        if len(running) >= self.num_workers:
+            return False
+
+        # A job is always started if nothing else runs, to prevent deadlocks due to large reservations
+        if len(running) == 0:
+            return True
+
+        reserved_memory = sum(job_running.memory for job_running in running)
+        if reserved_memory + job.memory > self.total_memory:
+            return False
+
+        if job.uses_gpu and self.num_gpus > 0 and self._get_free_gpu(running) is None:
+            return False
+        return True
+
+    def _runs_in_parent(self, job):
+        if not job.uses_gpu:
+            return False
+        
+        # Cuda cannot be used in forked processes if it was initialized in this process
+        return (not self.fork_gpu_jobs) or torch.cuda.is_initialized()
+
+    def _run_in_parent(self, job, Metrics, print_metric_status):
+        self.ledger.set_status(job.key, 'running', pid = os.getpid(), gpu = None)
+        print('Started job ' + job.description + ' in the main process.', flush = True)
+        try:
+            _train_and_evaluate(job, Metrics, print_metric_status)
+        except Exception:
+            traceback.print_exc()
+            self.ledger.set_status(job.key, 'failed', exitcode = None)
+            print('Job ' + job.description + ' failed.', flush = True)
+            return False
+
+        self.ledger.set_status(job.key, 'done')
+        print('Finished job ' + job.description + '.', flush = True)
+        return True
+
+    def run(self, Jobs, Metrics, print_metric_status, skip_done = True):
+        r'''
+        Run all given jobs that are not yet marked as done in the ledger.
+
+        Parameters
+        ----------
+        Jobs : list
+            The model_job instances that are run.
+        Metrics : list
+            The metrics on which each model is evaluated.
+        print_metric_status : callable
+            The function used to print the status of each metric.
+        skip_done : bool, optional
+            Decides if jobs marked as done in the ledger are skipped. This has to be False if
+            existing results are supposed to be overwritten. The default is True.
+
+        Returns
+        -------
+        failed_jobs : list
+            The keys of the jobs that did not finish successfully.
+        '''
+        if skip_done:
+            pending = [job for job in Jobs if not self.ledger.is_done(job.key)]
+            for job in Jobs:
+                if self.ledger.is_done(job.key):
+                    print('Job ' + job.description + ' was allready completed.', flush = True)
+        else:
+            pending = list(Jobs)
+        
+        running = []
+        failed_jobs = []
+
+        while len(pending) > 0 or len(running) > 0:
+            # Start all jobs for which resources are available (in the given order), where jobs
+            # that block the parent process are only started after all possible workers
+            for job in sorted(pending, key = self._runs_in_parent):
+                if not self._can_start(job, running):
+                    continue
+
+                if self._runs_in_parent(job):
+                    pending.remove(job)
+                    if not self._run_in_parent(job, Metrics, print_metric_status):
+                        failed_jobs.append(job.key)
+                    break
+
+                if job.uses_gpu and self.num_gpus > 0:
+                    job.gpu_id = self._get_free_gpu(running)
+                    if job.gpu_id is None:
+                        job.gpu_id = 0
+
+                job.process = self.context.Process(target = _run_model_job, args = (job, Metrics, print_metric_status))
+                job.process.start()
+
+                self.ledger.set_status(job.key, 'running', pid = job.process.pid, gpu = job.gpu_id)
+                print('Started job ' + job.description + ' (pid {}).'.format(job.process.pid), flush = True)
+
+                pending.remove(job)
+                running.append(job)
+
+            # Check for finished jobs
+            time.sleep(1.0)
+            for job in list(running):
+                if job.process.is_alive():
+                    continue
+
+                job.process.join()
+                if job.process.exitcode == 0:
+                    self.ledger.set_status(job.key, 'done')
+                    print('Finished job ' + job.description + '.', flush = True)
+                else:
+                    self.ledger.set_status(job.key, 'failed', exitcode = job.process.exitcode)
+                    print('Job ' + job.description + ' failed with exit code {}.'.format(job.process.exitcode), flush = True)
+                    failed_jobs.append(job.key)
+
+                running.remove(job)
+
+        return failed_jobs
@@ -0,0 +1,184 @@
+import time
+import numpy as np
+import pandas as pd
+from utils.memory_utils import get_used_memory
+
+
+class kde_scoring_engine():
+    r'''
+    This class evaluates fitted density estimators (such as ROME) on large sets of samples.
+    Identical samples (e.g., the ground truth trajectory repeated for every prediction) are only
+    scored once, and the remaining samples are scored in chunks whose size is bounded by the
+    available memory.
+
+    In the optional approximate mode, samples that fall into the same cell of a regular grid
+    are scored only once, using the first of those samples as representative. The cells are scaled
+    with the spread of each feature. Starting with a coarse grid, the grid is refined until the
+    approximation error on a random validation subset of the samples is below the given tolerance
+    (otherwise, exact scoring is used). This is a heuristic, so the error of samples outside the
+    validation subset is not guaranteed to be below the tolerance.
+
+    Parameters
+    ----------
+    total_memory : int
+        The total memory (in bytes) available to the framework.
+    tolerance : float, optional
+        The maximum absolute error of the log likelihoods of the validation samples in the approximate mode.
+        If None, all samples are scored exactly. The default is None.
+    memory_fraction : float, optional
+        The part of the available memory that can be used for scoring a chunk. The default is 0.1.
+    '''
+    def __init__(self, total_memory, tolerance = None, memory_fraction = 0.1):
+        self.total_memory    = total_memory
+        self.tolerance       = tolerance
+        self.memory_fraction = memory_fraction
+
+        # Settings of the approximate mode (the grid size is relative to the standard deviation of each feature)
+        self.initial_grid_size  = 0.5
+        self.num_refinements    = 8
+        self.num_validation     = 200
+
+        # Timing of the evaluation
+        self.timing     = {}
+        self.score_time = 0.0
+
+
+    def get_settings_key(self):
+        r'''
+        Returns a string describing all settings that change the resulting log likelihoods
+        (which the chunking does not), so that saved results can be matched to them.
+        '''
+        if self.tolerance is None:
+            return 'exact'
+
+        return 'approx_tol{:g}_g{:g}_std_r{}_v{}'.format(self.tolerance, self.initial_grid_size,
+                                                          self.num_refinements, self.num_validation)
+
+
+    def get_chunk_size(self, num_features, num_train_samples = None):
+        # Assume that the pairwise kernel values with all training samples are evaluated at once
+        if num_train_samples is None:
+            num_train_samples = 3000
+
+        required_memory = 4 * 8 * max(num_train_samples, num_features)
+        available_memory = max(self.total_memory - get_used_memory(), 100 * 2**20)
+
+        return max(1, int(self.memory_fraction * available_memory / required_memory))
+
+
+    def _score_chunked(self, kde, X, num_train_samples = None):
+        chunk_size = self.get_chunk_size(X.shape[1], num_train_samples)
+
+        log_probs = np.zeros(len(X), np.float64)
+        for i_start in range(0, len(X), chunk_size):
+            log_probs[i_start : i_start + chunk_size] = kde.score_samples(X[i_start : i_start + chunk_size])
+
+        return log_probs
+
+
+    def _get_representatives(self, X, grid_size = None, X_scale = None):
+        # Get the samples that are actually scored, and the representative of each sample
+        if grid_size is None:
+            X_keys = X
+        else:
+            X_keys = np.floor(X / (grid_size * X_scale[np.newaxis])).astype(np.int64)
+
+        _, rep_index, rep_inverse = np.unique(X_keys, axis = 0, return_index = True, return_inverse = True)
+        return rep_index, rep_inverse.reshape(-1)
+
+
+    def score_samples(self, kde, X, num_train_samples = None):
+        r'''
+        This function returns the log likelihoods of the samples under the fitted density estimator.
+
+        Parameters
+        ----------
+        kde : object
+            The fitted density estimator, which has to provide the method *score_samples()*.
+        X : np.ndarray
+            The samples that are to be scored, with shape :math:`\{N_{samples} \times N_{features}\}`.
+        num_train_samples : int, optional
+            The number of samples used for fitting **kde**, needed for the memory estimate.
+            The default is None.
+
+        Returns
+        -------
+        log_probs : np.ndarray
+            The log likelihoods of the samples, with shape :math:`N_{samples}`.
+        '''
+        t_start = time.time()
+        X = np.asarray(X)
+
+        if len(X) == 0:
+            return np.zeros(0, np.float64)
+
+        # Exactly identical samples are only scored once
+        rep_index, rep_inverse = self._get_representatives(X)
+
+        if self.tolerance is not None:
+            # Get the validation samples
+            rng = np.random.RandomState(0)
+            num_validation = min(self.num_validation, len(rep_index))
+            val_index = rep_index[rng.choice(len(rep_index), num_validation, replace = False)]
+            log_probs_val = None
+
+            # Scale the grid with the spread of each feature, so that high dimensional samples can still be merged
+            X_scale = np.nanstd(X[rep_index], axis = 0)
+            X_scale[~np.isfinite(X_scale) | (X_scale <= 0)] = 1.0
+
+            grid_size = self.initial_grid_size
+            for _ in range(self.num_refinements):
+                rep_index_grid, rep_inverse_grid = self._get_representatives(X, grid_size, X_scale)
+
+                # Check if the approximation is worth it
+                if len(rep_index_grid) > 0.5 * len(rep_index):
+                    break
+
+                if log_probs_val is None:
+                    log_probs_val = self._score_chunked(kde, X[val_index], num_train_samples)
+
+                # Get the representatives of the validation samples
+                val_rep_index = rep_index_grid[rep_inverse_grid[val_index]]
+                log_probs_val_approx = self._score_chunked(kde, X[val_rep_index], num_train_samples)
+
+                error = np.abs(log_probs_val_approx - log_probs_val)
+                error = error[np.isfinite(error)]
+                if len(error) == 0 or error.max() <= self.tolerance:
+                    rep_index, rep_inverse = rep_index_grid, rep_inverse_grid
+                    break
+
+                grid_size /= 2
+
+        log_probs = self._score_chunked(kde, X[rep_index], num_train_samples)[rep_inverse]
+
+        self.score_time += time.time() - t_start
+        return log_probs
+
+
+    def start_timing(self, task, subgroup):
+        return [task, subgroup, time.time(), self.score_time]
+
+
+    def stop_timing(self, timer, print_output = True):
+        task, subgroup, t_start, score_time_start = timer
+
+        total_time = time.time() - t_start
+        score_time = self.score_time - score_time_start
+
+        if task not in self.timing.keys():
+            self.timing[task] = {}
+        self.timing[task][subgroup] = [total_time, score_time]
+
+        if print_output:
+            print('        Time: {:0.2f}s (scoring: {:0.2f}s)'.format(total_time, score_time), flush = True)
+
+
+    def get_timing(self, task):
+        r'''
+        Returns a pandas.DataFrame with the overall time and the time spent on scoring
+        samples for each subgroup evaluated during the given task.
+        '''
+        if task not in self.timing.keys():
+            return pd.DataFrame(np.zeros((0, 2)), columns = ['total', 'scoring'])
+
+        return pd.DataFrame.from_dict(self.timing[task], orient = 'index', columns = ['total', 'scoring'])
@@ -0,0 +1,167 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+def get_map_raster_directory(image_file):
+    # Get the directory of the map rasters belonging to a saved --Images file
+    return image_file[:-4] + '--Map_rasters'
+
+
+def get_number_of_pyramid_levels(image_shape):
+    # Downsampled levels are only computed until one side has a single pixel
+    return int(np.floor(np.log2(max(min(image_shape[:2]), 1))))
+
+
+def _get_level_file(directory, map_index, level):
+    return directory + os.sep + 'Map_' + str(map_index).zfill(4) + '_Level_' + str(level).zfill(2) + '.npy'
+
+
+def _save_downsampled_level(image_prev, level_file, max_chunk_size = 2 ** 26):
+    # Average over blocks of 2 x 2 pixels, where the image is processed in chunks of rows,
+    # so that the float version of large maps never has to be held in memory completely
+    height_new, width_new = image_prev.shape[0] // 2, image_prev.shape[1] // 2
+    num_channels = int(np.prod(image_prev.shape[2:]))
+    image_new = np.lib.format.open_memmap(level_file, mode = 'w+', dtype = np.float32,
+                                          shape = (height_new, width_new, num_channels))
+
+    rows_per_chunk = max(1, int(max_chunk_size / max(1, 2 * image_prev.shape[1] * num_channels * 4)))
+    for i_start in range(0, height_new, rows_per_chunk):
+        i_end = min(i_start + rows_per_chunk, height_new)
+        chunk = np.asarray(image_prev[2 * i_start:2 * i_end, :2 * width_new]).astype(np.float32)
+        chunk = chunk.reshape(i_end - i_start, 2, width_new, 2, -1).mean((1,3))
+        image_new[i_start:i_end] = chunk
+
+    image_new.flush()
+    del image_new
+
+
+
+def save_map_rasters(Images, directory, image_file = None):
+    r'''
+    This function saves the maps of a dataset as raw .npy files that can be memory mapped,
+    together with all downsampled versions of each map (each halving the resolution of the
+    previous one, with the pixels being the float32 means over blocks of 2 x 2 pixels).
+
+    The files are first written to a temporary directory, which is then renamed, so that
+    other processes only ever see completely written map rasters.
+
+    Parameters
+    ----------
+    Images : pandas.DataFrame
+        The images of the dataset, with the columns 'Image' and 'Target_MeterPerPx'.
+    directory : str
+        The directory in which the map rasters are saved.
+    image_file : str, optional
+        The file from which the images were loaded. If given, map rasters that another process
+        saved for this file in the meantime are kept. The default is None.
+    '''
+    directory_tmp = directory + '--tmp_' + str(os.getpid())
+    if os.path.isdir(directory_tmp):
+        shutil.rmtree(directory_tmp)
+    os.makedirs(directory_tmp)
+
+    Num_levels = np.zeros(len(Images), int)
+    Max_values = np.zeros(len(Images), float)
+    for map_index, location in enumerate(Images.index):
+        image = np.ascontiguousarray(Images.Image.loc[location])
+        np.save(_get_level_file(directory_tmp, map_index, 0), image)
+        
+        # Save the value range, so that it can be checked without reading the whole map
+        Max_values[map_index] = image.max() if image.size > 0 else 0.0
+
+        Num_levels[map_index] = get_number_of_pyramid_levels(image.shape)
+        image_prev = image
+        for level in range(1, Num_levels[map_index] + 1):
+            level_file = _get_level_file(directory_tmp, map_index, level)
+            _save_downsampled_level(image_prev, level_file)
+            image_prev = np.load(level_file, mmap_mode = 'r')
+        del image_prev
+
+    # Save the index last
+    Target_MeterPerPx = Images.Target_MeterPerPx.to_numpy().astype(float)
+    index_data = np.array([list(Images.index), Target_MeterPerPx, Num_levels, Max_values, 0], object)
+    np.save(directory_tmp + os.sep + 'Map_index.npy', index_data)
+
+    # Keep the rasters if another process has just finished saving the same ones
+    if (image_file is not None) and map_rasters_are_up_to_date(directory, image_file):
+        shutil.rmtree(directory_tmp, ignore_errors = True)
+        return
+    
+    # Move outdated rasters out of the way first (processes still using them keep their memory maps)
+    if os.path.isdir(directory):
+        directory_old = directory + '--old_' + str(os.getpid())
+        try:
+            os.rename(directory, directory_old)
+            shutil.rmtree(directory_old, ignore_errors = True)
+        except OSError:
+            pass
+    
+    try:
+        os.rename(directory_tmp, directory)
+    except OSError:
+        # Another process has replaced the outdated rasters at the same time
+        shutil.rmtree(directory_tmp, ignore_errors = True)
+
+
+def map_rasters_are_up_to_date(directory, image_file):
+    index_file = directory + os.sep + 'Map_index.npy'
+    if not (os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(image_file)):
+        return False
+    
+    # Rasters saved without the value range of the maps have to be saved again
+    return len(np.load(index_file, allow_pickle = True)) == 5
+
+
+
+class map_raster_store():
+    r'''
+    This class provides the map rasters saved by *save_map_rasters()* as read-only memory maps.
+    As the operating system keeps only one copy of mapped files in the page cache, the maps are
+    shared between all processes on a node, and only the parts of the maps that are actually
+    sampled have to be read from disk.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which the map rasters are saved.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        [Locations, Target_MeterPerPx, Num_levels, Max_values, _] = np.load(directory + os.sep + 'Map_index.npy', allow_pickle = True)
+
+        # Open the full resolution maps (which only maps the files, without reading them)
+        Image_column = np.empty(len(Locations), object)
+        for map_index in range(len(Locations)):
+            Image_column[map_index] = np.load(_get_level_file(directory, map_index, 0), mmap_mode = 'r')
+
+        self.Images = pd.DataFrame(np.zeros((len(Locations), 2), object), index = Locations,
+                                   columns = ['Image', 'Target_MeterPerPx'])
+        self.Images['Image'] = Image_column
+        self.Images['Target_MeterPerPx'] = Target_MeterPerPx
+
+        self.Map_index = pd.Series(np.arange(len(Locations)), index = Locations)
+        self.Num_levels = pd.Series(Num_levels, index = Locations)
+        self.Max_values = pd.Series(Max_values, index = Locations)
+
+        # The downsampled maps are only opened when needed
+        self.Pyramids = {}
+
+    def get_level(self, location, level):
+        r'''
+        Returns the map at the given location, downsampled *level* times, as a read-only memory map
+        with shape :math:`\{H_{map} / 2^{level} \times W_{map} / 2^{level} \times C\}`.
+        '''
+        if level == 0:
+            return self.Images.Image.loc[location]
+
+        assert level <= self.Num_levels.loc[location], "The map has not been downsampled that often."
+        if location not in self.Pyramids.keys():
+            self.Pyramids[location] = {}
+
+        Pyramid = self.Pyramids[location]
+        if level not in Pyramid.keys():
+            level_file = _get_level_file(self.directory, self.Map_index.loc[location], level)
+            Pyramid[level] = np.load(level_file, mmap_mode = 'r')
+        return Pyramid[level]
@@ -0,0 +1,244 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Names of the files in a dense prediction directory
+DENSE_PREDICTION_FILES = ['index', 'agent_index', 'num_steps', 'paths', 'log_probs']
+
+
+class dense_path_predictions():
+    r'''
+    This class holds predicted trajectories of multiple samples in dense arrays, instead of
+    pandas.DataFrames whose cells contain a numpy array for each agent.
+
+    Parameters
+    ----------
+    index : np.ndarray
+        The indices of the :math:`N_{samples}` samples in the dataset, as an int64 array.
+    agent_index : np.ndarray
+        The position of each predicted agent in **columns**, as an int16 array of shape
+        :math:`\{N_{samples} \times N_{agents}\}`. Unused entries are set to -1.
+    num_steps : np.ndarray
+        The number of predicted timesteps of each agent, as an int32 array of shape
+        :math:`\{N_{samples} \times N_{agents}\}`.
+    paths : np.ndarray
+        The predicted trajectories, as a float16 or float32 array of shape
+        :math:`\{N_{samples} \times N_{preds} \times N_{agents} \times N_{O} \times 2\}`.
+        Timesteps after **num_steps** are set to np.nan.
+    log_probs : np.ndarray
+        The predicted log likelihoods, as a float32 array of shape
+        :math:`\{N_{samples} \times N_{agents} \times N_{probs}\}`. If no log likelihoods
+        are available for an agent, all values are np.nan.
+    columns : list
+        The names of all possible agents (i.e., data_set.Agents).
+    '''
+    def __init__(self, index, agent_index, num_steps, paths, log_probs, columns):
+        assert len(index) == len(agent_index) == len(num_steps) == len(paths) == len(log_probs), "The number of samples is inconsistent."
+        assert agent_index.shape == num_steps.shape == log_probs.shape[:2], "The agent arrays have different shapes."
+        assert paths.shape[2] == agent_index.shape[1], "The number of agents is inconsistent."
+
+        self.index       = index
+        self.agent_index = agent_index
+        self.num_steps   = num_steps
+        self.paths       = paths
+        self.log_probs   = log_probs
+        self.columns     = list(columns)
+
+    @property
+    def num_samples(self):
+        return len(self.index)
+
+    def get_rows(self, Index):
+        # Get the rows in which the given samples are saved
+        row_lookup = pd.Series(np.arange(self.num_samples), index = np.asarray(self.index))
+        return row_lookup.loc[Index].to_numpy()
+
+    def select(self, Index):
+        r'''
+        Returns a new object only containing the given samples. For memory mapped arrays,
+        only the rows of those samples are read.
+        '''
+        rows = self.get_rows(Index)
+
+        # Read the rows in ascending order, so that memory maps are read sequentially
+        order = np.argsort(rows, kind = 'stable')
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        rows_sorted = rows[order]
+
+        arrays = {}
+        for name in DENSE_PREDICTION_FILES:
+            arrays[name] = np.asarray(getattr(self, name)[rows_sorted])[inverse]
+        return dense_path_predictions(columns = self.columns, **arrays)
+
+    def pad(self, num_agents, num_preds, num_timesteps, num_probs):
+        # Pad all arrays to the given sizes
+        N = self.num_samples
+        agent_index = np.full((N, num_agents), -1, np.int16)
+        num_steps   = np.zeros((N, num_agents), np.int32)
+        paths       = np.full((N, num_preds, num_agents, num_timesteps, 2), np.nan, self.paths.dtype)
+        log_probs   = np.full((N, num_agents, num_probs), np.nan, np.float32)
+
+        A, P, T, L = self.agent_index.shape[1], self.paths.shape[1], self.paths.shape[3], self.log_probs.shape[2]
+        agent_index[:, :A] = self.agent_index
+        num_steps[:, :A]   = self.num_steps
+        paths[:, :P, :A, :T] = self.paths
+        log_probs[:, :A, :L] = self.log_probs
+        return dense_path_predictions(self.index, agent_index, num_steps, paths, log_probs, self.columns)
+
+    def to_dataframes(self, Index = None):
+        r'''
+        Transforms the predictions into the pandas.DataFrames used by the framework.
+
+        Parameters
+        ----------
+        Index : np.ndarray, optional
+            The samples that should be returned. The default is None, in which case all samples are used.
+
+        Returns
+        -------
+        Output_path_pred : pandas.DataFrame
+            The predicted trajectories, with one numpy array of shape :math:`\{N_{preds} \times N_{O} \times 2\}`
+            per predicted agent.
+        Output_path_pred_probs : pandas.DataFrame
+            The predicted log likelihoods, with one numpy array of length :math:`N_{probs}` per agent
+            for which they are available.
+        '''
+        if Index is None:
+            data = self
+        else:
+            data = self.select(Index)
+
+        paths_values = np.empty((data.num_samples, len(data.columns)), object)
+        probs_values = np.empty((data.num_samples, len(data.columns)), object)
+
+        # The saved float16 values are returned as float32 arrays
+        paths = data.paths
+        if paths.dtype != np.float32:
+            paths = paths.astype(np.float32)
+
+        has_log_probs = np.isfinite(data.log_probs).any(-1)
+
+        rows, agents = np.where(data.agent_index >= 0)
+        for row, agent in zip(rows, agents):
+            column = data.agent_index[row, agent]
+            paths_values[row, column] = paths[row, :, agent, :data.num_steps[row, agent]]
+            if has_log_probs[row, agent]:
+                probs_values[row, column] = data.log_probs[row, agent]
+
+        Output_path_pred = pd.DataFrame(paths_values, columns = data.columns, index = data.index)
+        Output_path_pred_probs = pd.DataFrame(probs_values, columns = data.columns, index = data.index)
+        return Output_path_pred, Output_path_pred_probs
+
+
+
+def dense_path_predictions_from_dataframes(Output_path_pred, Output_path_pred_probs, columns, dtype = np.float32):
+    ''' Transform the pandas.DataFrames of predicted trajectories and log likelihoods into dense arrays. '''
+    Output_path_pred = Output_path_pred[columns]
+    Output_path_pred_probs = Output_path_pred_probs[columns]
+
+    index = Output_path_pred.index.to_numpy().astype(np.int64)
+    paths_values = Output_path_pred.to_numpy()
+    probs_values = Output_path_pred_probs.to_numpy()
+
+    has_path  = Output_path_pred.notna().to_numpy()
+    has_probs = Output_path_pred_probs.notna().to_numpy() & has_path
+
+    # Get the agents of each sample, predicted agents first
+    num_agents = int(has_path.sum(1).max()) if len(index) > 0 else 0
+    agent_sort = np.argsort(~has_path, axis = 1, kind = 'stable')[:, :num_agents]
+    agent_used = np.take_along_axis(has_path, agent_sort, axis = 1)
+
+    agent_index = np.where(agent_used, agent_sort, -1).astype(np.int16)
+
+    # Get the sizes of the arrays
+    rows, agents = np.where(agent_used)
+    columns_used = agent_sort[rows, agents]
+    path_shapes = np.array([paths_values[row, column].shape[:2] for row, column in zip(rows, columns_used)], int).reshape(-1, 2)
+
+    num_preds     = path_shapes[:,0].max() if len(path_shapes) > 0 else 0
+    num_timesteps = path_shapes[:,1].max() if len(path_shapes) > 0 else 0
+    assert (path_shapes[:,0] == num_preds).all(), "The number of predictions differs between agents."
+
+    probs_rows = has_probs[rows, columns_used]
+    if probs_rows.any():
+        num_probs = max(len(probs_values[row, column]) for row, column in zip(rows[probs_rows], columns_used[probs_rows]))
+    else:
+        num_probs = 0
+
+    num_steps = np.zeros(agent_index.shape, np.int32)
+    paths     = np.full((len(index), num_preds, num_agents, num_timesteps, 2), np.nan, dtype)
+    log_probs = np.full((len(index), num_agents, num_probs), np.nan, np.float32)
+
+    for i, (row, agent, column) in enumerate(zip(rows, agents, columns_used)):
+        n_steps = path_shapes[i, 1]
+        num_steps[row, agent] = n_steps
+        paths[row, :, agent, :n_steps] = paths_values[row, column][..., :2]
+
+        if probs_rows[i]:
+            probs = probs_values[row, column]
+            log_probs[row, agent, :len(probs)] = probs
+
+    return dense_path_predictions(index, agent_index, num_steps, paths, log_probs, columns)
+
+
+def merge_dense_path_predictions(old, new):
+    ''' Combine two sets of predictions, where the predictions in **new** overwrite the ones in **old**. '''
+    assert old.columns == new.columns, "The predictions use different agent names."
+
+    # Pad to common sizes
+    num_agents    = max(old.agent_index.shape[1], new.agent_index.shape[1])
+    num_preds     = max(old.paths.shape[1], new.paths.shape[1])
+    num_timesteps = max(old.paths.shape[3], new.paths.shape[3])
+    num_probs     = max(old.log_probs.shape[2], new.log_probs.shape[2])
+
+    old = old.pad(num_agents, num_preds, num_timesteps, num_probs)
+    new = new.pad(num_agents, num_preds, num_timesteps, num_probs)
+
+    # Overwrite existing samples, and append the remaining ones
+    overwrite = np.isin(new.index, old.index)
+    if overwrite.any():
+        rows = old.get_rows(new.index[overwrite])
+        for name in DENSE_PREDICTION_FILES:
+            getattr(old, name)[rows] = getattr(new, name)[overwrite]
+
+    arrays = {}
+    for name in DENSE_PREDICTION_FILES:
+        old_values = getattr(old, name)
+        new_values = getattr(new, name)[~overwrite].astype(old_values.dtype)
+        arrays[name] = np.concatenate([old_values, new_values], axis = 0)
+
+    return dense_path_predictions(columns = old.columns, **arrays)
+
+
+def save_dense_path_predictions(Pred, directory):
+    ''' Save the predictions as raw .npy files that can be memory mapped. '''
+    assert isinstance(Pred, dense_path_predictions), "Only dense predictions can be saved."
+    os.makedirs(directory, exist_ok = True)
+
+    for name in DENSE_PREDICTION_FILES:
+        # Write to a temporary file first, so that existing memory maps of the old file stay valid
+        file = directory + os.sep + name + '.npy'
+        with open(file + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(getattr(Pred, name)))
+        os.replace(file + '.tmp', file)
+
+    # Save the agent names seperately, as they are not numeric
+    np.save(directory + os.sep + 'columns.npy', np.array(Pred.columns, str))
+
+
+def load_dense_path_predictions(directory, mmap_mode = 'r'):
+    ''' Load the saved predictions, by default with the large arrays as read-only memory maps. '''
+    if not os.path.isdir(directory):
+        raise FileNotFoundError("The prediction directory {} does not exist.".format(directory))
+
+    arrays = {}
+    for name in DENSE_PREDICTION_FILES:
+        arrays[name] = np.load(directory + os.sep + name + '.npy', mmap_mode = mmap_mode)
+
+    # The index table is small and used for every lookup, so keep it in memory
+    for name in ['index', 'agent_index', 'num_steps']:
+        arrays[name] = np.array(arrays[name])
+
+    columns = np.load(directory + os.sep + 'columns.npy').tolist()
+    return dense_path_predictions(columns = columns, **arrays)
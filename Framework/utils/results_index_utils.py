@@ -0,0 +1,114 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+
+
+def get_results_index_file(path):
+    # Get the index file in the Results folder of the framework at the given path
+    return path + os.sep + 'Results' + os.sep + 'Results_index.db'
+
+
+def get_configuration_key(*settings):
+    r'''
+    This function returns a compact key for the given settings (e.g., the dictionaries describing
+    the dataset, data parameters, splitter, model and metric of an experiment).
+    '''
+    return hashlib.md5(repr(settings).encode()).hexdigest()
+
+
+
+class results_index():
+    r'''
+    This class stores the small metric results of all experiments in a single sqlite database, so
+    that they can be read without loading any datasets or models. Besides the results themselves,
+    it stores which result files belong to which experiment settings.
+
+    As sqlite handles the locking of the database, multiple processes can write to it at the same time.
+
+    Parameters
+    ----------
+    index_file : str
+        The path of the database. All stored file paths are saved relative to the surrounding
+        *Results* folder, so that the whole folder can be moved.
+    '''
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.results_path = os.path.dirname(index_file) + os.sep
+
+        os.makedirs(os.path.dirname(self.index_file), exist_ok = True)
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS results '
+                               '(result_file TEXT PRIMARY KEY, results BLOB, time REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS configurations '
+                               '(configuration_key TEXT PRIMARY KEY, result_file TEXT, train_loss_file TEXT, figure_file TEXT)')
+        connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.index_file, timeout = 60)
+
+    def _relative(self, file):
+        if file is None:
+            return None
+        if file.startswith(self.results_path):
+            return file[len(self.results_path):]
+        return file
+
+    def _absolute(self, file):
+        if file is None:
+            return None
+        if os.path.isabs(file):
+            return file
+        return self.results_path + file
+
+    def set_results(self, result_file, Results):
+        r'''
+        Save the results of a metric file, i.e., the list [train_results, test_results].
+        '''
+        values = (self._relative(result_file), pickle.dumps(list(Results)), time.time())
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', values)
+        connection.close()
+
+    def get_results(self, result_file):
+        r'''
+        Returns the saved list [train_results, test_results], or None if the file is not indexed.
+        '''
+        connection = self._connect()
+        row = connection.execute('SELECT results FROM results WHERE result_file = ?',
+                                 (self._relative(result_file),)).fetchone()
+        connection.close()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def set_configurations(self, Configurations):
+        r'''
+        Save the files belonging to experiment settings.
+
+        Parameters
+        ----------
+        Configurations : list
+            Each entry is a tuple (configuration_key, result_file, train_loss_file, figure_file).
+        '''
+        values = [(key, self._relative(result_file), self._relative(train_loss_file), self._relative(figure_file))
+                  for key, result_file, train_loss_file, figure_file in Configurations]
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO configurations VALUES (?, ?, ?, ?)', values)
+        connection.close()
+
+    def get_configurations(self, configuration_keys):
+        r'''
+        Returns a dictionary, which maps each found configuration key to the tuple
+        (result_file, train_loss_file, figure_file).
+        '''
+        Configurations = {}
+        connection = self._connect()
+        for key in configuration_keys:
+            row = connection.execute('SELECT result_file, train_loss_file, figure_file FROM configurations ' +
+                                     'WHERE configuration_key = ?', (key,)).fetchone()
+            if row is not None:
+                Configurations[key] = tuple(self._absolute(file) for file in row)
+        connection.close()
+        return Configurations